@@ -9,8 +9,13 @@ class InputRI(Input):
         super(InputRI, self).__init__(fconf, "InputRI")
 
     def input(self):
-        for id, file in enumerate(sorted(os.listdir(self.input_path))):
-            yield(os.path.join(self.input_prefix, file), id)
+        return self.resume(0)
+
+    def resume(self, position):
+        files = sorted(os.listdir(self.input_path))
+
+        for id in xrange(position, len(files)):
+            yield(os.path.join(self.input_prefix, files[id]), id)
 
 class MasterRI(Master):
     def __init__(self, nick, fconf):
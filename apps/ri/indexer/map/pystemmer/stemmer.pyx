@@ -3,18 +3,104 @@ cimport libc.stdlib
 
 cimport cstemmer
 
+# Positions inside a link of the LRU list
+DEF PREV = 0
+DEF NEXT = 1
+DEF KEY = 2
+DEF STEM = 3
+
 cdef class Stemmer:
     cdef cstemmer.sb_stemmer *_c_stemmer
 
-    def __cinit__(self, lang="english", encoding="UTF_8"):
+    # word => [prev, next, word, stem] links of a circular list ordered from
+    # the least to the most recently used word
+    cdef dict cache
+    cdef list root
+
+    cdef public Py_ssize_t cache_size
+    cdef public unsigned long hits
+    cdef public unsigned long misses
+
+    def __cinit__(self, lang="english", encoding="UTF_8", cache_size=65536):
         self._c_stemmer = cstemmer.sb_stemmer_new(lang, encoding)
         if self._c_stemmer is NULL:
           raise MemoryError()
 
+        self.cache_size = cache_size
+        self.clear_cache()
+
     def __dealloc__(self):
         if self._c_stemmer is not NULL:
           cstemmer.sb_stemmer_delete(self._c_stemmer)
 
+    cdef object _stem(self, s):
+        out = cstemmer.sb_stemmer_stem(self._c_stemmer, s, len(s))
+        return out[:cstemmer.sb_stemmer_length(self._c_stemmer)]
+
+    cdef object _cached_stem(self, s):
+        cdef list link, last
+
+        link = self.cache.get(s)
+
+        if link is not None:
+          # Move the word to the most recently used end
+          link[PREV][NEXT] = link[NEXT]
+          link[NEXT][PREV] = link[PREV]
+
+          last = self.root[PREV]
+          last[NEXT] = self.root[PREV] = link
+          link[PREV] = last
+          link[NEXT] = self.root
+
+          self.hits += 1
+          return link[STEM]
+
+        self.misses += 1
+        stem = self._stem(s)
+
+        if self.cache_size <= 0:
+          return stem
+
+        if len(self.cache) >= self.cache_size:
+          # Evict the least recently used word
+          link = self.root[NEXT]
+          self.root[NEXT] = link[NEXT]
+          link[NEXT][PREV] = self.root
+          del self.cache[link[KEY]]
+
+        last = self.root[PREV]
+        link = [last, self.root, s, stem]
+        last[NEXT] = self.root[PREV] = link
+        self.cache[s] = link
+
+        return stem
+
     def stem(self, s):
-      out = cstemmer.sb_stemmer_stem(self._c_stemmer, s, len(s))
-      return out[:cstemmer.sb_stemmer_length(self._c_stemmer)]
+      return self._cached_stem(s)
+
+    def stem_many(self, words):
+      """
+      Stem a list of UTF-8 encoded words with a single call
+      @return the list of the stems
+      """
+      cdef list stems = []
+
+      for word in words:
+        stems.append(self._cached_stem(word))
+
+      return stems
+
+    def clear_cache(self):
+      "Drop the cached stems and reset the counters"
+      self.cache = {}
+      self.root = []
+      self.root.extend([self.root, self.root, None, None])
+
+      self.hits = 0
+      self.misses = 0
+
+    property hit_rate:
+      "The fraction of the words whose stem was found in the cache"
+      def __get__(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
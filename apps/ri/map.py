@@ -1,32 +1,142 @@
+import re
 import time
+import zipfile
 import subprocess
 from pomegranate.utils import get_id
-from pomegranate.mapper import Mapper as BaseMapper
+from pomegranate.mapper import PostingMapper
 
-class MapperRI(BaseMapper):
+try:
+    from stemmer import Stemmer
+    STEMMER_AVAILABLE = True
+except ImportError:
+    STEMMER_AVAILABLE = False
+
+# Words are made of letters, digits, hyphens and underscores like in the C
+# parser, which also truncates them to MAXWORD + 1 characters
+RE_WORD = re.compile(r'[\w-]+', re.UNICODE)
+MAXWORD = 64
+
+# Archive members are named doc-<docid>-<title>
+RE_DOCID = re.compile(r'doc-(\d+)')
+
+# Stemmer of the queries served by the server, created on the first query
+QUERY_STEMMER = None
+
+def analyze(text):
+    """
+    Turn the text of a query into terms the same way the documents are indexed
+    @param text a str
+    @return a list of stemmed terms
+    """
+    global QUERY_STEMMER
+
+    if not STEMMER_AVAILABLE:
+        raise Exception("You need to build the stemmer module in " \
+                        "apps/ri/indexer/map/pystemmer in order to serve " \
+                        "queries")
+
+    if QUERY_STEMMER is None:
+        QUERY_STEMMER = Stemmer("english", "UTF_8", 65536)
+
+    text = text.decode('utf-8', 'ignore').lower()
+    words = [word[:MAXWORD + 1].encode('utf-8')
+             for word in RE_WORD.findall(text)]
+
+    return QUERY_STEMMER.stem_many(words)
+
+class MapperRI(PostingMapper):
     def __init__(self, conf):
         super(MapperRI, self).__init__(conf, "MapperRI")
 
-        self.map_exec = conf["map-executable"]
-        self.num_reducer = conf["num-reducer"]
-        self.limit_size = int(conf["limit-size"])
+        # Either the C mapper executable or the Python tokenizer
+        self.engine = conf.get("map-engine", "c")
+        self.map_exec = conf.get("map-executable")
+
+        self.info("Limit size is %d" % (self.limit_size / 1024))
+
+        if self.engine == "python":
+            if not STEMMER_AVAILABLE:
+                raise Exception("You need to build the stemmer module in " \
+                                "apps/ri/indexer/map/pystemmer in order to " \
+                                "use the Python map engine")
+
+            self.stemmer = Stemmer("english", "UTF_8",
+                                   int(conf.get("stem-cache-size", 65536)))
+
+    @classmethod
+    def supports_ranges(cls, conf):
+        # Only the Python tokenizer reads single archive members
+        return conf.get("map-engine", "c") == "python"
+
+    def parse(self, fname, start=0, stop=None):
+        archive = zipfile.ZipFile(fname)
+        members = []
+
+        for info in archive.infolist()[start:stop]:
+            match = RE_DOCID.match(info.filename)
+
+            if match is not None:
+                members.append((int(match.group(1)), info))
+
+        # Postings have to be added sorted by docid
+        members.sort(key=lambda member: member[0])
 
-        self.info("Limit size is %d" % self.limit_size)
+        for docid, info in members:
+            text = archive.read(info).decode('utf-8', 'ignore').lower()
+            words = {}
+
+            for word in RE_WORD.findall(text):
+                word = word[:MAXWORD + 1]
+                words[word] = words.get(word, 0) + 1
+
+            # Every distinct word of the document is stemmed once
+            words = words.items()
+            stems = self.stemmer.stem_many([word.encode('utf-8')
+                                            for word, _ in words])
+            terms = {}
+
+            for stem, (_, occ) in zip(stems, words):
+                terms[stem] = terms.get(stem, 0) + occ
+
+            self.add_document(docid, terms)
+
+        archive.close()
+
+        self.info("Stemmer cache: %d hits, %d misses (%.1f%%)" % \
+                  (self.stemmer.hits, self.stemmer.misses,
+                   self.stemmer.hit_rate * 100))
 
     def execute(self, inp):
-        archive, archiveid = self.vfs.pull_remote_file(inp)
+        if self.engine == "python":
+            return super(MapperRI, self).execute(inp)
+
+        start = time.time()
+        results = []
 
+        for archive, first, last in self.pull_parts(inp):
+            if first != 0 or last is not None:
+                raise Exception("The C mapper cannot process ranges of " \
+                                "archive members. Use the python map-engine")
+
+            results.extend(self.__run(archive, inp[1]))
+
+        totsize = sum(fsize for _, _, fsize in results)
+
+        return ((totsize, time.time() - start), results)
+
+    def __run(self, archive, archiveid):
+        """
+        Execute the C mapper on an archive
+        @return a list of (ridx, fid, fsize) tuples
+        """
         args = [self.map_exec,
                 str(self.vfs.master_id), str(self.vfs.worker_id),
                 str(self.num_reducer), archive, self.output_path,
-                str(self.limit_size)]
+                str(self.limit_size / 1024)]
 
         self.info("Processing archive ID=%d name=%s" % (archiveid, archive))
         self.info("Executing %s" % str(' '.join(args)))
 
-        totsize = 0
-        start = time.time()
-
         process = subprocess.Popen(args, shell=False,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.STDOUT)
@@ -43,7 +153,6 @@ class MapperRI(BaseMapper):
             rid = int(rid)
             fsize = int(fsize)
 
-            totsize += fsize
             filenames.append(fname)
             results.append((rid, get_id(fname), fsize))
 
@@ -52,6 +161,6 @@ class MapperRI(BaseMapper):
         for fname in filenames:
             self.vfs.push_local_file(fname, True)
 
-        return ((totsize, time.time() - start), results)
+        return results
 
 Mapper = MapperRI
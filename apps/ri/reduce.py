@@ -1,15 +1,26 @@
 import time
 import subprocess
 from pomegranate.utils import get_id
-from pomegranate.reducer import Reducer as BaseReducer
+from pomegranate.reducer import PostingReducer
 
-class ReducerRI(BaseReducer):
+class ReducerRI(PostingReducer):
     def __init__(self, conf):
         super(ReducerRI, self).__init__(conf, "ReducerRI")
 
-        self.reduce_exec = conf["reduce-executable"]
+        # Either the C reducer executable or the Python heap based merge
+        self.engine = conf.get("reduce-engine", "c")
+        self.reduce_exec = conf.get("reduce-executable")
+
+        if self.engine != "python" and \
+           conf.get("posting-format", "raw") != "raw":
+            raise Exception("The C reducer only reads raw posting files. " \
+                            "Set reduce-engine to python")
 
     def execute(self, files):
+        # The scoring stage is always run in process
+        if self.engine == "python" or len(files) > 2:
+            return super(ReducerRI, self).execute(files)
+
         reduce_idx = files[0]
         files      = files[1]
 
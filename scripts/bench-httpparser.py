@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark for the incremental parser used by the masters to read the
+replies of the server. A stream of synthetic pipelined responses is fed to
+the parser in chunks as large as the recv size of the client.
+
+scripts $ python bench-httpparser.py [responses] [payload-files] [chunk-size]
+
+The payload-files argument controls the number of (fid, fsize) tuples in the
+synthetic reduce-recovery replies, mimicking large recovery payloads.
+"""
+
+import sys
+import json
+import time
+
+from pomegranate.httptransport import HTTPResponseParser
+
+def build_stream(responses, nfiles):
+    files = [(100000000 + i, 4096 + i) for i in xrange(nfiles)]
+    body = json.dumps({'type': 'reduce-recovery', 'nick': '',
+                       'data': [files, files]})
+    reply = "HTTP/1.1 200 OK\r\n"                \
+            "Content-type: application/json\r\n" \
+            "Connection: keep-alive\r\n"         \
+            "Content-Length: %d\r\n\r\n%s" % (len(body), body)
+    return reply * responses
+
+def main(responses, nfiles, chunk):
+    stream = build_stream(responses, nfiles)
+    parsed = [0]
+
+    def on_response(response):
+        parsed[0] += 1
+
+    parser = HTTPResponseParser(on_response, None, 4 * chunk)
+
+    start = time.time()
+
+    for pos in xrange(0, len(stream), chunk):
+        parser.feed(stream[pos:pos + chunk])
+
+    elapsed = time.time() - start
+
+    assert parsed[0] == responses
+
+    print("%d responses, %.2f MBs in %.3f secs: %.2f MBs/sec, %.0f resp/sec" % \
+          (responses, len(stream) / (1024.0 ** 2), elapsed,
+           len(stream) / (1024.0 ** 2 * elapsed), responses / elapsed))
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [2000, 5000, 65536]
+    main(*(args + defaults[len(args):]))
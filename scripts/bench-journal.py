@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the write-ahead journal of the server (see input-cursor). It
+simulates the life of a number of maps, each one extracted, assigned and
+acknowledged with a file for every reducer, groups reducing their files
+like with a threshold-nfile of 4, and then replays the journal like a
+restarted server.
+
+scripts $ python bench-journal.py [maps] [reducers] [sync-interval-ms] \\
+                                  [snapshot-records]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from pomegranate.cursor import InputCursor
+
+def simulate(cursor, nmaps, nreducers, threshold=4):
+    """
+    @return the number of records appended
+    """
+    groups = {} # nick => [[fid, ..] for every reducer]
+    records = 0
+    fid = 0
+
+    for tag in xrange(1, nmaps + 1):
+        nick = "group-%d" % (tag % 8)
+        lists = groups.setdefault(nick, [[] for _ in xrange(nreducers)])
+
+        cursor.extracted(tag, ("inputs/coll-%06d.zip" % tag, tag), True)
+        cursor.assigned(tag, nick)
+
+        files = []
+        for rid in xrange(nreducers):
+            fid += 1
+            files.append((rid, fid, 65536))
+            lists[rid].append(fid)
+
+        cursor.mapped(tag, nick, files)
+        records += 3
+
+        # Groups reduce the files of a reducer as soon as they are threshold
+        for rid, fids in enumerate(lists):
+            if len(fids) >= threshold:
+                fid += 1
+                cursor.reduced(nick, rid, (fid, 65536 * threshold), fids)
+                lists[rid] = [fid]
+                records += 1
+
+    return records
+
+def main(nmaps, nreducers, sync_interval, snapshot_records):
+    path = tempfile.mkdtemp()
+    fname = os.path.join(path, "journal")
+
+    try:
+        cursor = InputCursor(fname, sync_interval / 1000.0, snapshot_records)
+
+        start = time.time()
+        records = simulate(cursor, nmaps, nreducers)
+        elapsed = time.time() - start
+
+        size = os.path.getsize(fname)
+        cursor.close()
+
+        if os.path.exists(fname + ".snapshot"):
+            size += os.path.getsize(fname + ".snapshot")
+
+        print("%d maps in %.2f secs: %.1f usecs/map (extract, assign, ack), "
+              "%.1f usecs/record, %d bytes on disk" % \
+              (nmaps, elapsed, elapsed * 1e6 / nmaps,
+               elapsed * 1e6 / records, size))
+
+        start = time.time()
+        cursor = InputCursor(fname, sync_interval / 1000.0, snapshot_records)
+        elapsed = time.time() - start
+
+        print("Replayed in %.3f secs: %d inputs consumed, %d pending, "
+              "%d partial files" % \
+              (elapsed, cursor.position, len(cursor.pending),
+               len(cursor.files)))
+
+        cursor.close()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [100000, 8, 50, 100000]
+    main(*(args + defaults[len(args):]))
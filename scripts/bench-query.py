@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the query engine serving the final outputs through /query. It
+writes a number of synthetic posting files with their dictionaries, each one
+holding the postings of a disjoint set of documents like the outputs of the
+ri application, and runs random queries against them.
+
+scripts $ python bench-query.py [files] [terms] [queries] [cache-size]
+
+Queries are run twice in order to measure both cold and warm cache latency.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from pomegranate.postings import PostingWriter
+from pomegranate.index import IndexWriter
+from pomegranate.query import QueryEngine
+
+def build_files(path, nfiles, nterms):
+    rnd = random.Random(42)
+    vocabulary = sorted("term%08d" % i for i in xrange(nterms))
+    fnames = []
+
+    for fid in xrange(nfiles):
+        fname = os.path.join(path, "output-%06d" % fid)
+        writer = PostingWriter(open(fname, 'wb'))
+        index = IndexWriter(fname)
+
+        for rank, term in enumerate(vocabulary):
+            # Zipfian document frequencies
+            ndocs = max(1, 100000 / (rank + 1) / nfiles)
+            docids = sorted(rnd.sample(xrange(100000), ndocs))
+
+            postings = []
+            for docid in docids:
+                postings.extend((docid * nfiles + fid, rnd.randint(1, 10)))
+
+            index.add(term, writer.write(term, postings), postings)
+
+        writer.file.close()
+        index.close()
+        fnames.append(fname)
+
+    return fnames, vocabulary
+
+def main(nfiles, nterms, nqueries, cache_size):
+    path = tempfile.mkdtemp()
+
+    try:
+        fnames, vocabulary = build_files(path, nfiles, nterms)
+        engine = QueryEngine(fnames, cache_size)
+
+        rnd = random.Random(0)
+        queries = [rnd.sample(vocabulary, rnd.randint(1, 3))
+                   for _ in xrange(nqueries)]
+
+        for label in ("cold", "warm"):
+            for conjunctive in (False, True):
+                start = time.time()
+
+                for terms in queries:
+                    engine.search(terms, 10, conjunctive)
+
+                elapsed = time.time() - start
+
+                print("%s %s: %d queries in %.2f secs: %.2f msecs/query, "
+                      "cache %d/%d" % \
+                      (label, "and" if conjunctive else "or ", nqueries,
+                       elapsed, elapsed * 1000 / nqueries,
+                       engine.cache.hits, engine.cache.misses))
+
+        engine.close()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [8, 20000, 1000, 4096]
+    main(*(args + defaults[len(args):]))
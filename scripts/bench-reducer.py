@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the heap based k-way merge of the Python reduce engine. It
+writes a number of synthetic posting files sharing a vocabulary, each one
+covering a disjoint range of documents like the outputs of different maps,
+and merges them measuring the throughput for an increasing fan-in.
+
+scripts $ python bench-reducer.py [files] [terms] [postings-per-term] [compact]
+
+The merge is repeated with 2, 4, .. up to files inputs. If compact is 1 both
+the inputs and the outputs are stored in the compact zlib format.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from pomegranate.postings import open_posting_reader, create_posting_writer, \
+                                 merge_postings
+
+def build_files(path, nfiles, nterms, npostings, conf):
+    rnd = random.Random(42)
+    vocabulary = sorted("term%08d" % i for i in xrange(nterms))
+    fnames = []
+
+    for fid in xrange(nfiles):
+        fname = os.path.join(path, "input-%06d" % fid)
+        writer = create_posting_writer(open(fname, 'wb'), conf)
+        base = fid * nterms * npostings
+
+        for term in vocabulary:
+            if rnd.random() < 0.5:
+                continue
+
+            postings = []
+            for docid in xrange(npostings):
+                postings.extend((base + docid, rnd.randint(1, 10)))
+
+            writer.write(term, postings)
+
+        writer.close()
+        fnames.append(fname)
+
+    return fnames
+
+def main(nfiles, nterms, npostings, compact):
+    conf = {'posting-format': 'compact' if compact else 'raw'}
+    path = tempfile.mkdtemp()
+
+    try:
+        fnames = build_files(path, nfiles, nterms, npostings, conf)
+        fanin = 2
+
+        while fanin <= nfiles:
+            inputs = fnames[:fanin]
+            size = sum(os.path.getsize(fname) for fname in inputs)
+
+            start = time.time()
+            output = os.path.join(path, "output")
+            writer = create_posting_writer(open(output, 'wb'), conf)
+            readers = map(open_posting_reader, inputs)
+
+            for term, postings in merge_postings(readers):
+                writer.write(term, postings)
+
+            writer.close()
+            elapsed = time.time() - start
+
+            print("fan-in %4d: %8d postings in %.2f secs: %.2f MBs/sec, "
+                  "%.2f usecs/posting, %.2f bytes/posting" % \
+                  (fanin, writer.postings, elapsed,
+                   size / (1024.0 ** 2 * elapsed),
+                   elapsed * 1e6 / writer.postings,
+                   os.path.getsize(output) / float(writer.postings)))
+
+            fanin *= 2
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [256, 5000, 4, 0]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the LRU cache of the stemmer module built from
+apps/ri/indexer/map/pystemmer. Words are taken from an archive produced by
+wiki-extractor.py or, if no archive is given, from a synthetic Zipfian
+sample. They are stemmed one at a time without the cache, one at a time with
+the cache and document by document through stem_many().
+
+scripts $ python bench-stemmer.py [words] [cache-size] [archive.zip]
+"""
+
+import re
+import sys
+import time
+import random
+import zipfile
+
+try:
+    from stemmer import Stemmer
+except ImportError:
+    print("You need to build the stemmer module in "
+          "apps/ri/indexer/map/pystemmer first")
+    sys.exit(1)
+
+# Same tokenization of the Python map engine (see apps/ri/map.py)
+RE_WORD = re.compile(r'[\w-]+', re.UNICODE)
+MAXWORD = 64
+
+def archive_documents(fname, nwords):
+    "@return a list of documents, each one a list of UTF-8 encoded words"
+    archive = zipfile.ZipFile(fname)
+    documents = []
+    total = 0
+
+    for info in archive.infolist():
+        text = archive.read(info).decode('utf-8', 'ignore').lower()
+        words = [word[:MAXWORD + 1].encode('utf-8')
+                 for word in RE_WORD.findall(text)]
+
+        documents.append(words[:nwords - total])
+        total += len(documents[-1])
+
+        if total >= nwords:
+            break
+
+    archive.close()
+    return documents
+
+def synthetic_documents(nwords, vocabulary=200000, doclen=500):
+    "@return a list of documents with Zipfian distributed words"
+    rnd = random.Random(42)
+    suffixes = ["", "s", "ing", "ed", "ly", "ness", "ation"]
+    documents = []
+
+    for start in xrange(0, nwords, doclen):
+        words = []
+
+        for _ in xrange(min(doclen, nwords - start)):
+            rank = int(rnd.paretovariate(1.0)) % vocabulary
+            words.append("word%d%s" % (rank / len(suffixes),
+                                       suffixes[rank % len(suffixes)]))
+
+        documents.append(words)
+
+    return documents
+
+def run(label, stemmer, documents, batch):
+    start = time.time()
+    total = 0
+
+    for words in documents:
+        if batch:
+            stemmer.stem_many(words)
+        else:
+            for word in words:
+                stemmer.stem(word)
+
+        total += len(words)
+
+    elapsed = time.time() - start
+
+    print("%s: %d words in %.2f secs: %.0f words/sec, hit rate %.1f%%" % \
+          (label, total, elapsed, total / max(elapsed, 1e-9),
+           stemmer.hit_rate * 100))
+
+def main(nwords, cache_size, archive=None):
+    if archive is not None:
+        documents = archive_documents(archive, nwords)
+    else:
+        documents = synthetic_documents(nwords)
+
+    run("stem, no cache ", Stemmer("english", "UTF_8", 0), documents, False)
+    run("stem           ", Stemmer("english", "UTF_8", cache_size),
+        documents, False)
+    run("stem_many      ", Stemmer("english", "UTF_8", cache_size),
+        documents, True)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:3])
+    defaults = [1000000, 65536]
+    main(*(args + defaults[len(args):] + sys.argv[3:4]))
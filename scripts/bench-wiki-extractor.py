@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of wiki-extractor.py on a synthetic dump. Pages are made of random
+words mixed with the markup removed by filter_wiki (templates, links,
+references, tables, comments). The dump is extracted with 1, 2, 4, .. up to
+processes processes and the archives are compared with the serial ones.
+
+scripts $ python bench-wiki-extractor.py [pages] [processes] [batch-size]
+"""
+
+import os
+import sys
+import imp
+import time
+import random
+import shutil
+import zipfile
+import tempfile
+
+from xml.sax.saxutils import escape
+
+extractor = imp.load_source('wiki_extractor', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'wiki-extractor.py'))
+
+MARKUP = [
+    "{{Infobox %s|name=%s}}",
+    "[[%s|%s]]",
+    "<ref name=\"%s\">%s</ref>",
+    "\n{| class=\"wikitable\"\n|-\n| %s || %s\n|}\n",
+    "<!-- %s %s -->",
+    "[http://example.org/%s %s]",
+]
+
+def build_dump(fname, npages):
+    rnd = random.Random(42)
+    words = ["word%d" % i for i in xrange(5000)]
+
+    with open(fname, 'w') as f:
+        f.write("<mediawiki>\n")
+
+        for page in xrange(npages):
+            text = []
+
+            for _ in xrange(rnd.randint(50, 600)):
+                if rnd.random() < 0.1:
+                    text.append(rnd.choice(MARKUP) % \
+                                (rnd.choice(words), rnd.choice(words)))
+                else:
+                    text.append(rnd.choice(words))
+
+            f.write("<page><title>Page %d</title><revision><text>%s</text>"
+                    "</revision></page>\n" % (page, escape(' '.join(text))))
+
+        f.write("</mediawiki>\n")
+
+def read_archives(path):
+    "@return a sorted list of (archive, [(member, content), ..]) tuples"
+    result = []
+
+    for fname in sorted(os.listdir(path)):
+        archive = zipfile.ZipFile(os.path.join(path, fname))
+        result.append((fname, [(name, archive.read(name))
+                               for name in archive.namelist()]))
+        archive.close()
+
+    return result
+
+def main(npages, nprocesses, batch_size):
+    path = tempfile.mkdtemp()
+
+    try:
+        dump = os.path.join(path, "dump.xml")
+        build_dump(dump, npages)
+
+        size = os.path.getsize(dump)
+        expected = None
+        processes = 1
+
+        while processes <= nprocesses:
+            output = os.path.join(path, "out-%d" % processes)
+            os.mkdir(output)
+
+            start = time.time()
+            with open(dump) as stream:
+                writer = extractor.extract(stream, output, 1048576,
+                                           processes, batch_size)
+            elapsed = time.time() - start
+
+            archives = read_archives(output)
+
+            if expected is None:
+                expected = archives
+
+            print("%2d processes: %d pages, %d archives in %.2f secs: "
+                  "%.2f MBs/sec, %.0f pages/sec, %s" % \
+                  (processes, writer.num_articles, len(archives), elapsed,
+                   size / (1024.0 ** 2 * elapsed), npages / elapsed,
+                   "same output" if archives == expected else "DIFFERENT"))
+
+            processes *= 2
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [5000, 4, 64]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the scheduling structures of the server. It simulates the
+assignment and the acknowledgement of a large number of maps spread over
+several groups, each one keeping a window of maps in flight which are acked
+in random order. A fraction of the works is faulted and pushed back in the
+WorkQueue in order to exercise the dead queue as well.
+
+scripts $ python bench-workqueue.py [maps] [groups] [window]
+"""
+
+import sys
+import time
+import random
+import logging
+
+from pomegranate.server import WorkQueue, PendingWorks
+
+def main(maps, groups, window):
+    queue = WorkQueue(logging.getLogger("bench"),
+                      ((str(i), i) for i in xrange(maps)))
+    pending = PendingWorks()
+    inflight = dict(("group-%d" % i, []) for i in xrange(groups))
+
+    assigned = acked = faulted = 0
+    start = time.time()
+
+    while True:
+        for nick, tags in inflight.items():
+            while len(tags) < window:
+                wstatus = queue.pop()
+
+                if wstatus is None:
+                    break
+
+                pending.add(nick, wstatus)
+                tags.append(wstatus.tag)
+                assigned += 1
+
+            if not tags:
+                continue
+
+            # Ack a random work of the window
+            pos = random.randrange(len(tags))
+            tags[pos], tags[-1] = tags[-1], tags[pos]
+            wstatus = pending.remove(nick, tags.pop())
+
+            if random.random() < 0.001:
+                queue.push(wstatus.state)
+                faulted += 1
+            else:
+                acked += 1
+
+        if not len(pending):
+            break
+
+    elapsed = time.time() - start
+
+    assert acked == maps
+
+    print("%d assignments, %d acks, %d faults in %.2f secs: %.2f usecs/map" % \
+          (assigned, acked, faulted, elapsed, elapsed * 1e6 / assigned))
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [1000000, 64, 64]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Write the term dictionary of posting files which do not have one yet, like
+the outputs of the C reducer, and optionally run a conjunctive query on
+them.
+
+scripts $ python build-index.py <file> [<file> ..] [-- term [term ..]]
+"""
+
+import sys
+import time
+
+from pomegranate.index import InvertedIndex, build_index, get_index_name
+
+def main(args):
+    terms = []
+
+    if '--' in args:
+        pos = args.index('--')
+        args, terms = args[:pos], args[pos + 1:]
+
+    for fname in args:
+        start = time.time()
+        index = build_index(fname)
+
+        print("%s: %d terms, %d lists with skip pointers written to %s in "
+              "%.2f secs" % (fname, len(index.terms), len(index.skips),
+                             get_index_name(fname), time.time() - start))
+
+        if not terms:
+            continue
+
+        start = time.time()
+        index = InvertedIndex(fname)
+        results = index.conjunctive(terms)
+        index.close()
+
+        print("%s: %d documents match %s in %.2f msecs" % \
+              (fname, len(results), ' '.join(terms),
+               (time.time() - start) * 1000))
+
+        for docid, occurrences in results[:10]:
+            print("  %d %s" % (docid, occurrences))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Check that a client reading its reply slowly neither blocks the asyncore
+loop of the HTTP server nor loses data. A slow client requests a big reply
+and reads it in small chunks while another client keeps sending small
+requests, which must all be answered quickly. The big reply is finally
+compared with the expected one.
+
+scripts $ python check-httpserver.py [reply-size-kb] [requests]
+"""
+
+import sys
+import time
+import socket
+import hashlib
+import asyncore
+
+from threading import Thread, Event
+from pomegranate.httpserver import RequestHandler, Server
+
+# Maximum seconds to answer a small request while the slow client is reading
+MAX_LATENCY = 0.5
+
+def payload(size):
+    "@return a deterministic str of size bytes"
+    block = ''.join(chr(i % 251) for i in xrange(65536))
+    return (block * (size / len(block) + 1))[:size]
+
+class Handler(RequestHandler):
+    def do_GET(self):
+        body = self.server.big if self.path == '/big' else 'pong'
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def read_reply(sock, delay=0, chunk=65536):
+    "@return the body of the reply read from sock"
+    data = ''
+
+    while '\r\n\r\n' not in data:
+        data += sock.recv(chunk)
+
+    headers, body = data.split('\r\n\r\n', 1)
+    length = int([line.split(':')[1] for line in headers.split('\r\n')
+                  if line.lower().startswith('content-length')][0])
+
+    while len(body) < length:
+        if delay:
+            time.sleep(delay)
+
+        data = sock.recv(min(chunk, length - len(body)))
+
+        if not data:
+            break
+
+        body += data
+
+    return body
+
+def connect(port, rcvbuf=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+    sock.connect(('127.0.0.1', port))
+    return sock
+
+def main(size_kb, nrequests):
+    server = Server('127.0.0.1', 0, Handler)
+    server.big = payload(size_kb * 1024)
+    port = server.socket.getsockname()[1]
+
+    stop = Event()
+
+    def serve():
+        while not stop.is_set():
+            asyncore.loop(timeout=0.1, count=1)
+
+    loop = Thread(target=serve)
+    loop.start()
+
+    errors = []
+
+    # The slow client asks for the big reply and reads just a few bytes
+    slow = connect(port, 4096)
+    slow.sendall('GET /big HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    time.sleep(0.2)
+
+    fast = connect(port)
+    latencies = []
+
+    for _ in xrange(nrequests):
+        start = time.time()
+        fast.sendall('GET /ping HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        fast.settimeout(MAX_LATENCY * 10)
+
+        try:
+            body = read_reply(fast)
+        except socket.timeout:
+            errors.append("Small request timed out")
+            break
+
+        latencies.append(time.time() - start)
+
+        if body != 'pong':
+            errors.append("Unexpected reply %r" % body[:16])
+
+    if latencies and max(latencies) > MAX_LATENCY:
+        errors.append("Small requests took up to %.3f secs" % max(latencies))
+
+    # Now read the rest of the big reply slowly
+    slow.settimeout(30)
+    body = read_reply(slow, 0.001, 16384)
+
+    if hashlib.md5(body).digest() != hashlib.md5(server.big).digest():
+        errors.append("Big reply corrupted: %d bytes of %d received" % \
+                      (len(body), len(server.big)))
+
+    print("%d small requests served in %.2f msecs at most while a client "
+          "was reading %d KB slowly" % \
+          (len(latencies), max(latencies or [0]) * 1000, size_kb))
+
+    for error in errors:
+        print("ERROR: %s" % error)
+
+    slow.close()
+    fast.close()
+
+    stop.set()
+    loop.join()
+    server.close()
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [16384, 200]
+    sys.exit(main(*(args + defaults[len(args):])))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Check that the InputSplitter resumes where it stopped, like a server
+restarted with its input-cursor. A mix of small files and zip archives to
+split is enumerated and, after every task, the position journaled by the
+cursor is marshalled and given to resume(): the tasks left must be the same
+and the wrapped Input must be resumed from the inputs it did not produce
+yet instead of being enumerated again.
+
+scripts $ python check-input-resume.py [files] [split-size]
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import marshal
+import zipfile
+import tempfile
+
+from pomegranate.input import Input, InputSplitter
+
+class ListInput(Input):
+    "The sorted files of the input directory, counting the inputs yielded"
+    def __init__(self, fconf):
+        super(ListInput, self).__init__(fconf, "ListInput")
+        self.yielded = 0
+
+    def input(self):
+        return self.resume(0)
+
+    def resume(self, position):
+        files = sorted(os.listdir(self.input_path))
+
+        for fid in xrange(position, len(files)):
+            self.yielded += 1
+            yield (os.path.join(self.input_prefix, files[fid]), fid)
+
+def build_inputs(path, nfiles, split_size):
+    "Write small files and, every few of them, an archive to split"
+    rnd = random.Random(11)
+
+    for fid in xrange(nfiles):
+        fname = os.path.join(path, "inputs", "input-%04d" % fid)
+
+        if fid % 5 == 3:
+            archive = zipfile.ZipFile(fname, 'w')
+
+            for member in xrange(rnd.randint(4, 20)):
+                archive.writestr("doc-%d" % member,
+                                 os.urandom(rnd.randint(split_size / 4,
+                                                        split_size / 2)))
+            archive.close()
+        else:
+            with open(fname, 'wb') as f:
+                f.write('x' * rnd.randint(1, split_size / 2))
+
+def main(nfiles, split_size):
+    path = tempfile.mkdtemp()
+    errors = 0
+
+    try:
+        os.makedirs(os.path.join(path, "inputs"))
+        build_inputs(path, nfiles, split_size)
+
+        fconf = os.path.join(path, "conf.json")
+        with open(fconf, 'w') as f:
+            json.dump({"datadir": path, "input-prefix": "inputs"}, f)
+
+        splitter = InputSplitter(ListInput(fconf), split_size)
+        tasks, positions = [], []
+
+        for task in splitter.input():
+            tasks.append(task)
+            positions.append(marshal.loads(marshal.dumps(splitter.position)))
+
+        for count, position in enumerate(positions, 1):
+            inp = ListInput(fconf)
+            left = list(InputSplitter(inp, split_size).resume(position))
+
+            if left != tasks[count:]:
+                print("ERROR: %d tasks resumed after %d instead of %d" % \
+                      (len(left), count, len(tasks) - count))
+                errors += 1
+
+            if inp.yielded != nfiles - position[0]:
+                print("ERROR: %d inputs enumerated again after %d tasks "
+                      "instead of %d" % (inp.yielded, count,
+                                         nfiles - position[0]))
+                errors += 1
+
+        print("%d files in %d tasks, resumed after every task, %d errors" % \
+              (nfiles, len(tasks), errors))
+    finally:
+        shutil.rmtree(path)
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [60, 65536]
+    sys.exit(main(*(args + defaults[len(args):])))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Check that the in-process mappers report the time actually spent on a map,
+for plain inputs as well as for inputs split by the InputSplitter. The
+reported duration feeds the throughput statistics and the speculation of
+stragglers.
+
+scripts $ python check-mapper-timing.py [documents]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from pomegranate.mapper import PostingMapper, StreamingMapper
+
+class VFS(object):
+    "Local replacement of the worker, without any DFS"
+    master_id = 0
+    worker_id = 0
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+
+    def pull_remote_file(self, inp):
+        return (os.path.join(self.datadir, inp[0]), inp[1])
+
+    def push_local_file(self, fname, push=False):
+        pass
+
+class DocumentMapper(PostingMapper):
+    "Every line of an input is a document made of its words"
+    def parse(self, fname, start=0, stop=None):
+        with open(fname) as f:
+            lines = f.readlines()[start:stop]
+
+        for docid, line in enumerate(lines):
+            terms = {}
+            for word in line.split():
+                terms[word] = terms.get(word, 0) + 1
+
+            self.add_document(docid, terms)
+
+class WordMapper(StreamingMapper):
+    "Every line of an input is a member, whose ranges are supported"
+    map_ranges = True
+
+    def map(self, inp):
+        with open(inp[0]) as f:
+            lines = f.readlines()
+
+        if len(inp) > 2:
+            lines = lines[inp[2]:inp[3]]
+
+        for word in ''.join(lines).split():
+            self.emit(word, 1)
+
+def check(mapper, inp):
+    "@return an error message or None"
+    start = time.time()
+    info, results = mapper.execute(inp)
+    elapsed = time.time() - start
+
+    if not 0 <= info[1] <= elapsed:
+        return "%s reported %.3f secs for a map lasting %.3f secs" % \
+               (mapper.__class__.__name__, info[1], elapsed)
+
+    if not results:
+        return "%s produced no file" % mapper.__class__.__name__
+
+    return None
+
+def main(ndocs):
+    path = tempfile.mkdtemp()
+
+    try:
+        os.makedirs(os.path.join(path, "inputs"))
+        os.makedirs(os.path.join(path, "outputs"))
+
+        for name in ("a", "b"):
+            with open(os.path.join(path, "inputs", name), "w") as f:
+                for docid in xrange(ndocs):
+                    f.write("word%d common term%d\n" % (docid % 7, docid))
+
+        conf = {"datadir": path, "input-prefix": "inputs",
+                "output-prefix": "outputs", "num-reducer": 2,
+                "limit-size": 1024}
+
+        inputs = [("inputs/a", 0),
+                  ("inputs/a", 1, (("inputs/a", 0, None),
+                                   ("inputs/b", 0, None)))]
+        errors = []
+
+        for cls in (DocumentMapper, WordMapper):
+            mapper = cls(conf)
+            mapper.setup(VFS(path))
+
+            for inp in inputs:
+                error = check(mapper, inp)
+
+                if error is not None:
+                    errors.append(error)
+
+        # A range of members of an archive
+        for cls in (DocumentMapper, WordMapper):
+            mapper = cls(conf)
+            mapper.setup(VFS(path))
+            error = check(mapper, ("inputs/a", 2, (("inputs/a", 1, 10),)))
+
+            if error is not None:
+                errors.append(error)
+
+        for error in errors:
+            print("ERROR: %s" % error)
+
+        print("%d errors" % len(errors))
+        return 1 if errors else 0
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [1000]
+    sys.exit(main(*(args + defaults[len(args):])))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Validate posting files produced by the mappers and the reducers of the ri
+application and print some statistics about them. Files are read through
+mmap, without copying the posting lists when NumPy is available. Compact
+files are decoded and checked in the same way.
+
+scripts $ python check-postings.py <file> [<file> ..]
+"""
+
+import sys
+
+from pomegranate.postings import MmapPostingReader, CompactPostingReader, \
+                                 is_compact
+
+def check_compact(fname):
+    "@return a (terms, postings, errors) tuple"
+    terms = postings = 0
+    errors = []
+    last = None
+
+    for term, lst in CompactPostingReader(fname):
+        terms += 1
+        postings += len(lst) / 2
+
+        if last is not None and term <= last:
+            errors.append("Term %r follows %r" % (term, last))
+
+        last = term
+        docids = lst[::2]
+
+        if not all(a < b for a, b in zip(docids, docids[1:])):
+            errors.append("Postings of %r are not sorted" % term)
+
+    return terms, postings, errors
+
+def check_raw(fname):
+    "@return a (terms, postings, errors) tuple"
+    reader = MmapPostingReader(fname)
+    terms = postings = 0
+
+    try:
+        for term, offset, count in reader.terms():
+            terms += 1
+            postings += count
+
+        return terms, postings, reader.validate()
+    finally:
+        reader.close()
+
+def main(fnames):
+    failed = 0
+
+    for fname in fnames:
+        terms = postings = 0
+
+        try:
+            if is_compact(fname):
+                terms, postings, errors = check_compact(fname)
+            else:
+                terms, postings, errors = check_raw(fname)
+        except Exception, exc:
+            errors = [str(exc)]
+
+        print("%s: %d terms, %d postings, %d errors" % \
+              (fname, terms, postings, len(errors)))
+
+        for error in errors[:10]:
+            print("  %s" % error)
+
+        failed += bool(errors)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Check the vectorized TF-IDF scoring stage against a straightforward pure
+Python implementation. A number of synthetic posting files, each one
+holding the postings of a disjoint set of documents like the outputs of
+the ri application, are scored in small batches and every weight of the
+scored files is compared with the expected one. The document frequencies
+go through a frequencies file and the ScorePlan is checked to hand out the
+task computing them before the scoring ones.
+
+scripts $ python check-scoring.py [files] [terms] [batch-size]
+"""
+
+import os
+import sys
+import math
+import time
+import random
+import shutil
+import tempfile
+
+from array import array
+from pomegranate.postings import UINT, PostingWriter
+from pomegranate.index import IndexWriter
+from pomegranate.scoring import global_frequencies, idf_weights, \
+                                save_frequencies, load_frequencies, \
+                                TfIdfScorer, ScorePlan, FREQUENCIES
+
+def build_files(path, nfiles, nterms):
+    "@return the list of the files and a dictionary term => [postings]"
+    rnd = random.Random(7)
+    vocabulary = sorted("term%06d" % i for i in xrange(nterms))
+    fnames = []
+    lists = []
+
+    for fid in xrange(nfiles):
+        fname = os.path.join(path, "output-%06d" % fid)
+        writer = PostingWriter(open(fname, 'wb'))
+        index = IndexWriter(fname)
+        postings = {}
+
+        for rank, term in enumerate(vocabulary):
+            ndocs = max(1, 2000 / (rank + 1))
+            docids = sorted(rnd.sample(xrange(2000), ndocs))
+
+            lst = []
+            for docid in docids:
+                lst.extend((docid * nfiles + fid, rnd.randint(1, 20)))
+
+            postings[term] = lst
+            index.add(term, writer.write(term, lst), lst)
+
+        writer.file.close()
+        index.close()
+
+        fnames.append(fname)
+        lists.append(postings)
+
+    return fnames, lists
+
+def expected_weights(lists):
+    "@return a list of dictionaries (term, docid) => weight, one per file"
+    df = {}
+    documents = 0
+
+    for postings in lists:
+        for term, lst in postings.iteritems():
+            df[term] = df.get(term, 0) + len(lst) / 2
+
+            if lst:
+                documents = max(documents, lst[-2] + 1)
+
+    results = []
+
+    for postings in lists:
+        weights = {}
+        norms = {}
+
+        for term, lst in postings.iteritems():
+            idf = math.log(float(max(documents, df[term])) / df[term]) + 1
+
+            for i in xrange(0, len(lst), 2):
+                weight = (1 + math.log(max(lst[i + 1], 1))) * idf
+                weights[(term, lst[i])] = weight
+                norms[lst[i]] = norms.get(lst[i], 0) + weight * weight
+
+        for (term, docid), weight in weights.items():
+            weights[(term, docid)] = weight / math.sqrt(norms[docid])
+
+        results.append(weights)
+
+    return results
+
+def read_scored(fname):
+    "@return a dictionary (term, docid) => weight"
+    weights = {}
+
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+
+    while offset < len(data):
+        length, = UINT.unpack_from(data, offset)
+        offset += UINT.size
+        term = data[offset:offset + length]
+        offset += length
+        count, = UINT.unpack_from(data, offset)
+        offset += UINT.size
+
+        docids = array('I', data[offset:offset + 8 * count])[::2]
+        scores = array('f', data[offset:offset + 8 * count])[1::2]
+        offset += 8 * count + 1
+
+        for docid, score in zip(docids, scores):
+            weights[(term, docid)] = score
+
+    return weights
+
+def check_plan(nfiles):
+    "@return the number of errors found in the order of the ScorePlan tasks"
+    files = [(reduce_idx, 100 + reduce_idx) for reduce_idx in xrange(nfiles)]
+    plan = ScorePlan(files)
+    errors = 0
+
+    first = plan.assign('a', nfiles)
+
+    if first != [(0, FREQUENCIES)] or plan.assign('b', nfiles):
+        print("ERROR: plan: %r assigned before the frequencies" % first)
+        errors += 1
+
+    plan.complete('a', 0, (1, 10))
+    tasks = plan.assign('b', nfiles)
+
+    if plan.frequencies != (1, 10) or tasks != files:
+        print("ERROR: plan: %r assigned after the frequencies" % tasks)
+        errors += 1
+
+    for reduce_idx, fid in tasks:
+        plan.complete('b', reduce_idx, (fid, 0))
+
+    if not plan.finished() or len(plan.completed) != nfiles:
+        print("ERROR: plan: not finished after scoring every file")
+        errors += 1
+
+    return errors
+
+def main(nfiles, nterms, batch_size):
+    path = tempfile.mkdtemp()
+    errors = 0
+
+    try:
+        fnames, lists = build_files(path, nfiles, nterms)
+        expected = expected_weights(lists)
+
+        errors += check_plan(nfiles)
+
+        start = time.time()
+        frequencies = os.path.join(path, "frequencies")
+
+        with open(frequencies, 'wb') as output:
+            save_frequencies(output, *global_frequencies(fnames))
+
+        terms, df, documents = load_frequencies(frequencies)
+        scorer = TfIdfScorer(terms, idf_weights(df, documents), batch_size)
+
+        for fname, weights in zip(fnames, expected):
+            with open(fname + ".scored", 'wb') as output:
+                scorer.score(fname, output)
+
+            scored = read_scored(fname + ".scored")
+
+            if set(scored) != set(weights):
+                print("ERROR: %s: %d weights written, %d expected" % \
+                      (fname, len(scored), len(weights)))
+                errors += 1
+                continue
+
+            for key, weight in weights.iteritems():
+                if abs(scored[key] - weight) > 1e-5 * max(weight, 1e-3):
+                    print("ERROR: %s: weight of %r is %.7f instead of %.7f" % \
+                          (fname, key, scored[key], weight))
+                    errors += 1
+
+        print("%d files scored in %.2f secs with batches of %d postings, "
+              "%d weights checked, %d errors" % \
+              (nfiles, time.time() - start, batch_size,
+               sum(len(weights) for weights in expected), errors))
+    finally:
+        shutil.rmtree(path)
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    args = map(int, sys.argv[1:])
+    defaults = [4, 2000, 5000]
+    sys.exit(main(*(args + defaults[len(args):])))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Simulator of the merge policies of the masters. It replays a stream of map
+outputs and reports for every policy the number of bytes read by the merges
+executed during the map phase and by the final merge of every reducer.
+
+scripts $ python merge-simulator.py [trace-file|maps] [reducers] [nfile] [max-mb]
+
+The trace file contains one map output per line in the form "rid fid fsize",
+for example as extracted from the map-ack messages of a previous run. If an
+integer is given instead a synthetic stream of maps is generated, each one
+producing a file of random size for every reducer.
+"""
+
+import sys
+import random
+
+from pomegranate.merge import POLICIES
+
+def load_trace(fname):
+    outputs = []
+
+    with open(fname) as f:
+        for line in f:
+            if line.strip():
+                outputs.append(tuple(map(int, line.split())))
+
+    return outputs
+
+def synthetic_trace(maps, reducers):
+    rnd = random.Random(42)
+    outputs = []
+
+    for i in xrange(maps):
+        for rid in xrange(reducers):
+            size = int(rnd.lognormvariate(15, 1.5))
+            outputs.append((rid, i * reducers + rid, size))
+
+    return outputs
+
+def simulate(policy, outputs):
+    """
+    Every merge is considered instantaneous and its output as large as the
+    sum of its inputs.
+    @return a tuple (merges, bytes merged in the map phase, final bytes,
+             maximum number of files merged by a final reduce)
+    """
+    reducing_files = {}
+    next_fid = max(fid for _, fid, _ in outputs) + 1
+    merges = merged = 0
+
+    for rid, fid, fsize in outputs:
+        files = reducing_files.setdefault(rid, [])
+        files.append((fid, fsize))
+
+        # The master asks the policy again as soon as a worker is available
+        while True:
+            assigned = policy.select(files)
+
+            if not assigned:
+                break
+
+            selected = set(fid for fid, _ in assigned)
+            size = sum(fsize for _, fsize in assigned)
+
+            files[:] = [f for f in files if f[0] not in selected]
+            files.append((next_fid, size))
+
+            next_fid += 1
+            merges += 1
+            merged += size
+
+    final = fanin = 0
+
+    for files in reducing_files.values():
+        if policy.select(files, True):
+            final += sum(fsize for _, fsize in files)
+            fanin = max(fanin, len(files))
+
+    return merges, merged, final, fanin
+
+def main(source, reducers, nfile, max_mb):
+    try:
+        outputs = synthetic_trace(int(source), reducers)
+    except ValueError:
+        outputs = load_trace(source)
+
+    total = sum(fsize for _, _, fsize in outputs)
+    MB = 1024.0 ** 2
+
+    print("%d map outputs, %.2f MBs produced" % (len(outputs), total / MB))
+
+    for name in sorted(POLICIES):
+        policy = POLICIES[name](nfile, max_mb * 1024 * 1024)
+        merges, merged, final, fanin = simulate(policy, outputs)
+
+        print("%-15s %6d merges, %10.2f MBs merged, %10.2f MBs final "
+              "(fan-in %d), %10.2f MBs total (%.2fx)" % \
+              (name, merges, merged / MB, final / MB, fanin,
+               (merged + final) / MB, (merged + final) / float(total)))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    defaults = ['10000', 2, 4, 0]
+    args = args[:1] + map(int, args[1:])
+    main(*(args + defaults[len(args):]))
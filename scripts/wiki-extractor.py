@@ -21,6 +21,13 @@ sys	3m8.468s
 It took 3h and 27m to decompress the entire wikipedia dump (7GB) and to create
 81 intermediate files (5.1GB cumulative output) on a Intel(R) Core(TM)2 Duo CPU
 T7500 @2.20GHz. Totally 3504258 pages are taken in consideration.
+
+Most of the time is spent in filter_wiki. Passing the number of processes
+the SAX parser only slices the dump in pages, which are filtered in batches
+by a pool of processes. The archives produced are the same:
+
+scripts $ bzcat ~/enwiki-latest-pages-articles.xml.bz2 | python
+          wiki-extractor.py /media/storage/collection/ 66060288 4 64
 """
 
 import re
@@ -28,6 +35,9 @@ import os
 import sys
 import zipfile
 import tempfile
+import multiprocessing
+
+from collections import deque
 
 from xml.sax import make_parser
 from xml.sax.handler import ContentHandler
@@ -140,25 +150,87 @@ def filter_wiki(raw):
     text = text.replace('[', '').replace(']', '') # promote all remaining markup to plain text
     return text
 
-class WikiPageHandler(ContentHandler):
-    def __init__(self, output_dir, threshold):
-        ContentHandler.__init__(self)
+def filter_batch(batch):
+    """
+    Filter a batch of pages inside a worker process of the pool
+    @param batch a list of (title, raw) tuples
+    @return a list of (title, text) tuples. text is None for the pages which
+            are too short to be collected
+    """
+    results = []
 
-        self.level = 0
-        self.in_title = True
-        self.title = None
+    for title, raw in batch:
+        text = filter_wiki(raw)
+        results.append((title, text if len(text) > ARTICLE_MIN_CHARS else None))
 
+    return results
+
+class ArchiveWriter(object):
+    """
+    Store the filtered pages in coll-NNNNNN-MMMMMM.zip archives of about
+    threshold bytes. Pages must be written in the order of the dump since
+    their position is their docid.
+    """
+    def __init__(self, output_dir, threshold):
         self.num_articles = 0
         self.collected = 0
         self.num_outputs = 0
 
         self.threshold = threshold
-        self.buffer = []
         self.file = None
         self.output_dir = os.path.abspath(output_dir)
 
         self.new_file()
 
+    def write(self, title, text):
+        if text is None or len(text) <= ARTICLE_MIN_CHARS:
+            return
+
+        self.num_articles += 1
+        self.collected += 1
+
+        filename  = "doc-{:d}-{:s}".format(self.num_articles,
+                                           title.encode("utf-8"))
+        self.file.writestr(filename, text.encode("utf-8"))
+
+        if self.file.fp.tell() > self.threshold:
+            self.close_file()
+            self.new_file()
+
+    def new_file(self):
+        handle = tempfile.NamedTemporaryFile(prefix='out-', suffix='.zip',
+                                             dir=self.output_dir, delete=False)
+        self.file = zipfile.ZipFile(handle.name, mode='w',
+                                    compression=zipfile.ZIP_DEFLATED)
+
+    def close_file(self):
+        self.file.close()
+
+        if self.collected == 0:
+            os.unlink(self.file.filename)
+            return
+
+        dst = os.path.join(self.output_dir, 'coll-{:06d}-{:06d}.zip'.format(
+                           self.num_outputs, self.collected))
+        os.rename(self.file.filename, dst)
+        self.num_outputs += 1
+        self.collected = 0
+
+class WikiPageHandler(ContentHandler):
+    """
+    SAX handler slicing the dump in pages. Every page is filtered in process
+    and written to the ArchiveWriter.
+    """
+    def __init__(self, writer):
+        ContentHandler.__init__(self)
+
+        self.level = 0
+        self.in_title = True
+        self.title = None
+
+        self.buffer = []
+        self.writer = writer
+
     def startElement(self, name, attrs):
         if name == "text":
             self.level += 1
@@ -170,7 +242,8 @@ class WikiPageHandler(ContentHandler):
             self.level -= 1
 
             if self.level == 0:
-                self.filter_wiki()
+                self.add_page(self.title, ''.join(self.buffer))
+                self.buffer = []
         if name == "title" and self.level == 0:
             self.in_title = False
 
@@ -180,55 +253,93 @@ class WikiPageHandler(ContentHandler):
         elif self.level > 0:
             self.buffer.append(ch)
 
-    def filter_wiki(self):
-        text = filter_wiki(''.join(self.buffer))
-        self.buffer = []
+    def add_page(self, title, raw):
+        self.writer.write(title, filter_wiki(raw))
 
-        if len(text) > ARTICLE_MIN_CHARS:
-            self.num_articles += 1
-            self.collected += 1
+    def close(self):
+        self.writer.close_file()
 
-            filename  = "doc-{:d}-{:s}".format(self.num_articles,
-                                               self.title.encode("utf-8"))
-            self.file.writestr(filename, text.encode("utf-8"))
+class ParallelWikiPageHandler(WikiPageHandler):
+    """
+    SAX handler which only slices the dump: batches of pages are filtered by
+    a pool of processes. Results are written back in the order of the dump,
+    keeping at most 2 batches per process in flight.
+    """
+    def __init__(self, writer, processes, batch_size=64):
+        WikiPageHandler.__init__(self, writer)
 
-            if self.file.fp.tell() > self.threshold:
-                self.close_file()
-                self.new_file()
+        self.pool = multiprocessing.Pool(processes)
+        self.batch_size = batch_size
+        self.max_pending = 2 * processes
 
-    def new_file(self):
-        handle = tempfile.NamedTemporaryFile(prefix='out-', suffix='.zip',
-                                             dir=self.output_dir, delete=False)
-        self.file = zipfile.ZipFile(handle.name, mode='w',
-                                    compression=zipfile.ZIP_DEFLATED)
+        self.batch = []
+        self.pending = deque()
 
-    def close_file(self):
-        self.file.close()
+    def add_page(self, title, raw):
+        self.batch.append((title, raw))
 
-        if self.collected == 0:
-            os.unlink(self.file.filename)
-            return
+        if len(self.batch) >= self.batch_size:
+            self.submit()
 
-        dst = os.path.join(self.output_dir, 'coll-{:06d}-{:06d}.zip'.format(
-                           self.num_outputs, self.collected))
-        os.rename(self.file.filename, dst)
-        self.num_outputs += 1
-        self.collected = 0
+    def submit(self):
+        if self.batch:
+            self.pending.append(self.pool.apply_async(filter_batch,
+                                                      (self.batch, )))
+            self.batch = []
 
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: {:s} <output-dir> " \
-              "<bytes-soft-threshold>".format(sys.argv[0]))
-        sys.exit(-1)
+        while len(self.pending) > self.max_pending:
+            self.write_batch()
+
+    def write_batch(self):
+        for title, text in self.pending.popleft().get():
+            self.writer.write(title, text)
+
+    def close(self):
+        try:
+            self.submit()
+
+            while self.pending:
+                self.write_batch()
+        finally:
+            self.pool.terminate()
+            WikiPageHandler.close(self)
+
+def extract(stream, output_dir, threshold, processes=1, batch_size=64):
+    """
+    Extract the pages of a dump into zip archives
+    @param stream the file object of the XML dump
+    @param output_dir the directory where the archives are created
+    @param threshold the soft limit in bytes of every archive
+    @param processes the number of processes filtering the pages. 1 filters
+                     them in the process parsing the dump
+    @param batch_size the number of pages sent at once to a process
+    @return the ArchiveWriter used
+    """
+    writer = ArchiveWriter(output_dir, threshold)
+
+    if processes > 1:
+        handler = ParallelWikiPageHandler(writer, processes, batch_size)
+    else:
+        handler = WikiPageHandler(writer)
 
     parser = make_parser()
-    handler = WikiPageHandler(sys.argv[1], int(sys.argv[2]))
     parser.setContentHandler(handler)
 
     try:
-        parser.parse(sys.stdin)
+        parser.parse(stream)
     finally:
-        handler.close_file()
+        handler.close()
+
+    return writer
+
+def main():
+    if len(sys.argv) not in (3, 4, 5):
+        print("Usage: {:s} <output-dir> <bytes-soft-threshold> " \
+              "[processes] [batch-size]".format(sys.argv[0]))
+        sys.exit(-1)
+
+    args = map(int, sys.argv[2:])
+    extract(sys.stdin, sys.argv[1], *args)
 
 if __name__ == "__main__":
     main()
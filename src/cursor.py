@@ -0,0 +1,206 @@
+"""
+This module holds the input cursor used by the server to resume a job after
+a restart without enumerating again or mapping again the inputs already
+processed.
+
+The cursor is a write-ahead journal (see journal.py) of the transitions of
+the scheduling state of the server:
+
+    (REC_INPUT, tag, state, fresh[, pos])  a work extracted from the
+                                           WorkQueue. fresh is True if it
+                                           was produced by the input generator
+                                           whose position after it is pos, if
+                                           the input keeps one
+    (REC_ASSIGN, tag, nick)                a work assigned to a group,
+                                           possibly as a speculative copy
+    (REC_MAP, tag, nick, files)            a map acknowledged by a group with
+                                           the (rid, fid, fsize) files produced
+    (REC_REDUCE, nick, ridx, output, fids) a reduce or a merge replacing the
+                                           files fids of reducer ridx with the
+                                           (fid, fsize) output
+    (REC_DEATH, nick)                      a group died
+
+Replaying the journal gives back the position of the input generator, that
+is the number of inputs consumed unless the input keeps its own, the works
+never acknowledged and the partial files of every group, that is the content
+of reduce_dict and dead_reduce_dict. The merge plan is computed again from
+the partial files.
+"""
+
+from journal import Journal
+
+REC_INPUT = 0
+REC_MAP = 1
+REC_REDUCE = 2
+REC_ASSIGN = 3
+REC_DEATH = 4
+
+class InputCursor(Journal):
+    """
+    Persist the scheduling state of the server and replay it on startup
+    """
+    def __init__(self, fname, sync_interval=0.05, snapshot_records=100000):
+        """
+        Open the journal, replaying it if it already exists
+        @param fname the path to the log
+        @param sync_interval the maximum number of seconds between two syncs
+        @param snapshot_records the number of records between two snapshots
+        """
+        # Position of the generator given to the resume() of the input: the
+        # number of inputs extracted unless the input keeps its own
+        self.position = 0
+        self.last_tag = 0
+
+        # tag => [state, [nick, ..]] of the works not acknowledged yet. Plain
+        # dictionaries are used since tags are increasing
+        self.pending = {}
+
+        # state => tag of the pending works not owned by any group
+        self.orphans = {}
+
+        # (ridx, fid) => (nick, fsize) of the partial files
+        self.files = {}
+
+        super(InputCursor, self).__init__(fname, sync_interval,
+                                          snapshot_records, "InputCursor")
+
+        # Groups have to register again after a restart
+        for tag, work in self.pending.items():
+            work[1] = []
+            self.orphans[work[0]] = tag
+
+        self.info("Input position %s, %d pending, %d partial files" % \
+                  (str(self.position), len(self.pending), len(self.files)))
+
+    def apply(self, record):
+        if record[0] == REC_INPUT:
+            tag, state, fresh = record[1:4]
+
+            if fresh and len(record) > 4:
+                self.position = record[4]
+            elif fresh:
+                self.position += 1
+            else:
+                # A work given back by a dead group is extracted again
+                self.pending.pop(self.orphans.pop(state, None), None)
+
+            self.pending[tag] = [state, []]
+            self.last_tag = max(self.last_tag, tag)
+
+        elif record[0] == REC_ASSIGN:
+            _, tag, nick = record
+
+            if tag in self.pending:
+                self.pending[tag][1].append(nick)
+
+        elif record[0] == REC_MAP:
+            _, tag, nick, files = record
+            work = self.pending.pop(tag, None)
+
+            if work is not None and self.orphans.get(work[0]) == tag:
+                del self.orphans[work[0]]
+
+            for rid, fid, fsize in files:
+                self.files[(rid, fid)] = (nick, fsize)
+
+        elif record[0] == REC_REDUCE:
+            _, nick, ridx, output, fids = record
+
+            for fid in fids:
+                self.files.pop((ridx, fid), None)
+
+            self.files[(ridx, output[0])] = (nick, output[1])
+
+        elif record[0] == REC_DEATH:
+            _, nick = record
+
+            for tag, (state, owners) in self.pending.items():
+                if nick in owners:
+                    owners.remove(nick)
+
+                    if not owners:
+                        self.orphans[state] = tag
+
+    def dump(self):
+        return (self.position, self.last_tag,
+                [(tag, state, owners)
+                 for tag, (state, owners) in self.pending.items()],
+                self.orphans.items(),
+                [(ridx, fid, nick, fsize)
+                 for (ridx, fid), (nick, fsize) in self.files.items()])
+
+    def load(self, state):
+        self.position, self.last_tag, pending, orphans, files = state
+
+        self.pending = dict((tag, [inp, list(owners)])
+                            for tag, inp, owners in pending)
+        self.orphans = dict(orphans)
+        self.files = dict(((ridx, fid), (nick, fsize))
+                          for ridx, fid, nick, fsize in files)
+
+    def extracted(self, tag, state, fresh, position=None):
+        """
+        Record a work extracted from the WorkQueue
+        @param tag the tag of the work
+        @param state the input of the map
+        @param fresh True if the input comes from the generator
+        @param position the position of the generator after the input, if
+                        the input keeps one
+        """
+        if position is None:
+            self.append((REC_INPUT, tag, state, bool(fresh)))
+        else:
+            self.append((REC_INPUT, tag, state, bool(fresh), position))
+
+    def assigned(self, tag, nick):
+        """
+        Record a work assigned to a group
+        @param tag the tag of the work
+        @param nick the nick of the group
+        """
+        self.append((REC_ASSIGN, tag, nick))
+
+    def mapped(self, tag, nick, files):
+        """
+        Record an acknowledged map
+        @param tag the tag of the work
+        @param nick the nick of the group
+        @param files a list of (rid, fid, fsize) tuples
+        """
+        self.append((REC_MAP, tag, nick, [tuple(item) for item in files]))
+
+    def reduced(self, nick, ridx, output, fids):
+        """
+        Record a reduce replacing some partial files with its output
+        @param nick the nick of the group
+        @param ridx the reducer ID
+        @param output the (fid, fsize) tuple of the output
+        @param fids the list of the IDs of the files replaced
+        """
+        self.append((REC_REDUCE, nick, ridx, tuple(output), list(fids)))
+
+    def died(self, nick):
+        """
+        Record the death of a group
+        @param nick the nick of the group
+        """
+        self.append((REC_DEATH, nick))
+
+    def works(self):
+        "@return the inputs of the pending works sorted by tag"
+        return [self.pending[tag][0] for tag in sorted(self.pending)]
+
+    def groups(self, num_reducer):
+        """
+        @return a dictionary nick => [[(fid, fsize), ..] for every reducer]
+                holding the partial files replayed
+        """
+        groups = {}
+
+        for (ridx, fid), (nick, fsize) in sorted(self.files.items()):
+            if nick not in groups:
+                groups[nick] = [[] for _ in xrange(num_reducer)]
+
+            groups[nick][ridx].append((fid, fsize))
+
+        return groups
@@ -0,0 +1,66 @@
+"""
+This module holds the definition of the compact binary framing that can be
+used on the control channel between the masters and the server in place of
+the JSON over HTTP messages.
+
+The framing is negotiated at registration time. From then on every message
+is a frame made of a 4 bytes big endian length followed by the marshalled
+tuple (code, type, nick, data).
+
+The marshal module is not secure against maliciously constructed data, so
+the framing must only be enabled on a trusted network. The length and the
+structure of the frames are nevertheless checked in order to reject corrupted
+ones.
+"""
+
+import struct
+import marshal
+
+FRAMING_BINARY = 'binary'
+
+FRAME_HEADER = struct.Struct('!I')
+MARSHAL_VERSION = 2
+
+# Frames larger than this are rejected before being buffered
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+def encode_frame(type, nick, data, code=200):
+    """
+    Serialize a message into a frame
+    @param type a string representing the type of the message
+    @param nick the nick to use
+    @param data payload of the message
+    @param code the status code of the message (mimics HTTP response codes)
+    @return a str containing the frame
+    """
+    payload = marshal.dumps((code, type, nick, data), MARSHAL_VERSION)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def check_frame_size(size):
+    """
+    Validate the length read from the header of a frame
+    @param size the length of the payload
+    @return size
+    """
+    if size > MAX_FRAME_SIZE:
+        raise Exception("Frame of %d bytes exceeds the limit of %d bytes" % \
+                        (size, MAX_FRAME_SIZE))
+
+    return size
+
+def decode_frame(payload):
+    """
+    Deserialize the payload of a frame
+    @param payload a str containing the frame without the length header
+    @return a tuple (code, type, nick, data)
+    """
+    try:
+        frame = marshal.loads(payload)
+    except (ValueError, EOFError, TypeError):
+        raise Exception("Malformed frame of %d bytes" % len(payload))
+
+    if not isinstance(frame, tuple) or len(frame) != 4 or \
+       not isinstance(frame[0], int) or not isinstance(frame[1], str):
+        raise Exception("Malformed frame of %d bytes" % len(payload))
+
+    return frame
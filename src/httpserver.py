@@ -29,52 +29,33 @@ After that, the handle_data() method is called and the connection is closed
 Subclasses of RequestHandler only have to override the handle_data() method
 """
 
-import asynchat, asyncore, socket, SimpleHTTPServer, select
+import asynchat, asyncore, socket, SimpleHTTPServer
 import sys, cStringIO, traceback, shutil
 
 class SocketStream:
-    def __init__(self, sock, handler):
-        """Initiate a socket (non-blocking) and a buffer"""
-        self.sock = sock
+    def __init__(self, handler):
+        """Initiate a file-like object writing on the handler producer fifo"""
         self.handler = handler
-        self.buffer = cStringIO.StringIO()
-        self.closed = 1
 
     def write(self, data):
-        """Buffer the input, then send as many bytes as possible"""
-        self.buffer.write(data)
-
-        if self.writable():
-            buff = self.buffer.getvalue()
-
-            try:
-                sent = self.sock.send(buff)
-                self.buffer = cStringIO.StringIO()
-                self.buffer.write(buff[sent:])
-            except Exception:
-                self.handler.handle_error()
+        """Queue the data on the producer fifo of the handler. asynchat sends
+        as many bytes as possible right away and the rest whenever the socket
+        becomes writable again, without ever blocking the asyncore loop"""
+        if data:
+            self.handler.push(data)
 
     def finish(self):
-        """When all data has been received, send what remains in the buffer"""
-        data = self.buffer.getvalue()
-        while len(data):
-            while not self.writable():
-                pass
-            try:
-                sent = self.sock.send(data)
-                data = data[sent:]
-            except Exception:
-                self.handler.handle_error()
-
-    def writable(self):
-        """Used as a flag to know if something can be sent to the socket"""
-        return select.select([], [self.sock], [])[1]
+        """Nothing to flush: pending data is sent by the asyncore loop"""
+        pass
 
 class RequestHandler(asynchat.async_chat,
     SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     protocol_version = "HTTP/1.1"
 
+    # Send the producer fifo in large chunks
+    ac_out_buffer_size = 65536
+
     def __init__(self, conn, addr, server):
         asynchat.async_chat.__init__(self, conn)
         self.client_address = addr
@@ -90,7 +71,7 @@ class RequestHandler(asynchat.async_chat,
         self.found_terminator = self.handle_request_line
         self.rfile = cStringIO.StringIO()
         self.request_version = "HTTP/1.1"
-        # buffer the response and headers to avoid several calls to select()
+        # buffer the response and headers to avoid several pushes
         self.wfile = cStringIO.StringIO()
 
     def collect_incoming_data(self, data):
@@ -138,16 +119,16 @@ class RequestHandler(asynchat.async_chat,
             self.send_error(501, "Unsupported method (%s)" %self.command)
 
     def end_headers(self):
-        """Send the blank line ending the MIME headers, send the buffered
-        response and headers on the connection, then set self.wfile to
-        this connection
-        This is faster than sending the response line and each header
-        separately because of the calls to select() in SocketStream"""
+        """Send the blank line ending the MIME headers, push the buffered
+        response and headers on the producer fifo, then set self.wfile to
+        a SocketStream so that the body is queued on the fifo as well
+        This is faster than pushing the response line and each header
+        separately"""
         if self.request_version != 'HTTP/0.9':
             self.wfile.write("\r\n")
         try:
             self.start_resp = cStringIO.StringIO(self.wfile.getvalue())
-            self.wfile = SocketStream(self.connection, self)
+            self.wfile = SocketStream(self)
             self.copyfile(self.start_resp, self.wfile)
         except Exception, exc:
             pass
@@ -161,14 +142,14 @@ class RequestHandler(asynchat.async_chat,
         self.close()
 
     def finish(self):
-        """Send data, then close"""
+        """Queue the remaining data, then get ready for the next request"""
         try:
             self.wfile.finish()
         except AttributeError:
             # if end_headers() wasn't called, wfile is a StringIO
             # this happens for error 404 in self.send_head() for instance
             self.wfile.seek(0)
-            self.copyfile(self.wfile, SocketStream(self.connection, self))
+            self.copyfile(self.wfile, SocketStream(self))
 
         self.reset()
 
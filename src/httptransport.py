@@ -4,94 +4,230 @@ This module contains classes used for interacting with the http server
 
 import json
 import socket
-import StringIO
-import mimetools
 import threading
 
 import asyncore
 
+from framing import FRAME_HEADER, check_frame_size, decode_frame
+
 class HTTPRequest(object):
     """
     A simple class representing an HTTP response/request
     """
-    def __init__(self, callback):
-        self.callback = callback
-        self.reset()
-
-    def parse_headers(self, status, headers):
+    def __init__(self, head):
         """
-        Called whenever the header terminator string is encountered
-        @param status the HTTP status as 3-triple ('HTTP/1.1', '200', 'OK')
-        @param headers a string representing the http headers
+        Parse the status line and the headers of the response
+        @param head a string containing the status line and the headers
+                    without the terminating blank line
         """
-        self.got_header = True
-        self.protocol, self.reply_code, self.reply_status = status
-        self.reply_code = int(self.reply_code)
-        self.headers = headers
+        lines = head.split("\r\n")
+
+        self.protocol, self.reply_code, self.reply_status = \
+            (lines[0].split(" ", 2) + ["", ""])[:3]
 
         try:
-            self.clen = int(self.headers.getheader("content-length"))
-        except:
+            self.reply_code = int(self.reply_code)
+        except ValueError:
+            self.reply_code = 400
+
+        self.headers = {}
+
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            self.headers[key.strip().lower()] = value.strip()
+
+        try:
+            self.clen = int(self.headers["content-length"])
+        except (KeyError, ValueError):
             self.clen = 0
 
-    def reset(self):
-        "Reset the status of the request object"
-        self.body = ""
-        self.got_header = False
-        self.headers = None
-        self.buffer = []
-        self.length = 0
         self.payload = ""
 
-        self.protocol = ""
-        self.reply_code = 400
-        self.reply_status = ""
+    def getheader(self, name, default=None):
+        "@return the value of the given header or default"
+        return self.headers.get(name.lower(), default)
+
+    def get_reply(self):
+        "@return the deserialzied JSON payload. Can throws exceptions"
+        return json.loads(self.payload)
+
+class ReadBuffer(object):
+    """
+    A growable bytearray in which data can be received directly from the
+    socket. Consumed bytes are not discarded immediately: the pending data is
+    moved back to the beginning of the buffer only when more room is needed.
+    """
+    def __init__(self, size):
+        """
+        @param size the initial size in bytes of the buffer
+        """
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
 
-        self.headers = None
-        self.clen = 0
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        """
+        Make room for at least size bytes after the pending data
+        @param size the number of bytes you want to write
+        @return a memoryview over the free space of the buffer
+        """
+        if len(self.data) - self.end < size:
+            pending = self.end - self.start
+
+            if pending + size > len(self.data):
+                data = bytearray(max(2 * len(self.data), pending + size))
+                data[:pending] = self.data[self.start:self.end]
+                self.data = data
+            else:
+                self.data[:pending] = self.data[self.start:self.end]
+
+            self.start, self.end = 0, pending
+
+        return memoryview(self.data)[self.end:]
+
+    def commit(self, size):
+        "Mark size bytes written in the space returned by reserve as pending"
+        self.end += size
+
+    def consume(self, size):
+        "Discard the first size pending bytes"
+        self.start += size
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def find(self, sub, offset=0):
+        """
+        @return the position of sub relative to the pending data starting the
+                search at offset or -1 if not found
+        """
+        pos = self.data.find(sub, self.start + offset, self.end)
+        return pos if pos < 0 else pos - self.start
+
+    def tostring(self, start, stop):
+        "@return a str copy of the pending data between start and stop"
+        return memoryview(self.data)[self.start + start:
+                                     self.start + stop].tobytes()
+
+class HTTPResponseParser(object):
+    """
+    Incremental parser for a stream of pipelined HTTP responses. Once the
+    binary framing has been negotiated the same stream is parsed as a
+    sequence of frames. All the complete messages available in the buffer are
+    dispatched in a single pass.
+    """
+    def __init__(self, on_response, on_frame, bufsize=65536):
+        """
+        @param on_response callback called with an HTTPRequest object for
+                           every complete response
+        @param on_frame callback called with (code, type, nick, data) for
+                        every complete frame
+        @param bufsize the initial size in bytes of the read buffer
+        """
+        self.on_response = on_response
+        self.on_frame = on_frame
+
+        self.buffer = ReadBuffer(bufsize)
+        self.framed = False
+
+        # Offset from which the scan for the end of the headers is resumed
+        # and the response whose body is still being received
+        self.scan = 0
+        self.response = None
 
     def feed(self, data):
         """
-        Feed the request object with new data
+        Copy data into the buffer and parse it
         @param data a string representing new data read from a socket
         """
-        needed = max(0, self.clen - len(self.payload))
+        view = self.buffer.reserve(len(data))
+        view[:len(data)] = data
+        del view
 
-        if needed == 0:
-            self.callback(self)
-            self.reset()
-            return data
-        else:
-            tstr = data[:needed]
-            self.buffer.append(tstr)
-            self.length += len(tstr)
+        self.commit(len(data))
 
-            if self.length == self.clen:
-                buff, self.buffer = self.buffer, None
-                self.payload = "".join(buff)
+    def commit(self, size):
+        """
+        Parse the size bytes just received in the space returned by
+        self.buffer.reserve()
+        """
+        self.buffer.commit(size)
 
-                self.callback(self)
-                self.reset()
+        while self.__parse_frame() if self.framed else self.__parse_response():
+            pass
 
-            return data[needed:]
+    def __parse_response(self):
+        "@return True if a response has been dispatched"
+        buff = self.buffer
 
-    def get_reply(self):
-        "@return the deserialzied JSON payload. Can throws exceptions"
-        return json.loads(self.payload)
+        if self.response is None:
+            # The terminator might straddle two reads
+            pos = buff.find("\r\n\r\n", max(0, self.scan - 3))
+
+            if pos < 0:
+                self.scan = len(buff)
+                return False
+
+            self.scan = 0
+            self.response = HTTPRequest(buff.tostring(0, pos))
+            buff.consume(pos + 4)
+
+        if len(buff) < self.response.clen:
+            return False
+
+        response, self.response = self.response, None
+        response.payload = buff.tostring(0, response.clen)
+        buff.consume(response.clen)
+
+        self.on_response(response)
+        return True
+
+    def __parse_frame(self):
+        "@return True if a frame has been dispatched"
+        buff = self.buffer
+
+        if len(buff) < FRAME_HEADER.size:
+            return False
+
+        size = check_frame_size(
+            FRAME_HEADER.unpack_from(buff.data, buff.start)[0])
+
+        if len(buff) < FRAME_HEADER.size + size:
+            return False
+
+        payload = buff.tostring(FRAME_HEADER.size, FRAME_HEADER.size + size)
+        buff.consume(FRAME_HEADER.size + size)
+
+        self.on_frame(*decode_frame(payload))
+        return True
 
 class HTTPClient(asyncore.dispatcher):
     """
     Simple asyncore http client
     """
-    def __init__(self):
+    def __init__(self, recv_size=65536):
+        """
+        @param recv_size the maximum number of bytes read from the socket in
+                         a single call
+        """
         asyncore.dispatcher.__init__(self)
 
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__inbuffer = ""
-        self.__request = HTTPRequest(self.__request_ready)
+        self.recv_size = recv_size
+        self.__parser = HTTPResponseParser(self.__request_ready,
+                                           self.__frame_ready,
+                                           4 * recv_size)
         self.__requests = []
         self.__requests_lock = threading.Lock()
 
+    @property
+    def framed(self):
+        "True once the binary framing has been negotiated with the server"
+        return self.__parser.framed
+
     def run(self):
         asyncore.loop()
 
@@ -115,19 +251,43 @@ class HTTPClient(asyncore.dispatcher):
         if method is not None:
             method.__call__(*args)
 
+    def _start_framing(self):
+        """
+        Switch the connection to the binary framing. Every byte received after
+        the reply currently being parsed will be interpreted as a frame.
+        """
+        self.__parser.framed = True
+
     def __request_ready(self, request):
         """
-        Callback triggered by the HTTPRequest object whenever a request is
-        ready to be parsed.
+        Callback triggered by the HTTPResponseParser object whenever a
+        response is ready to be parsed.
         @param request the HTTPRequest object
         """
         if request.reply_code != 200:
-            self.__call('_on_request_error', request)
+            try:
+                reply = request.get_reply()
+            except ValueError:
+                reply = {}
+
+            self.__call('_on_request_error', reply.get('nick'),
+                        (request.reply_code, reply.get('type'),
+                         reply.get('data')))
         else:
             data = request.get_reply()
             self.__call('_on_' + data['type'].replace('-', '_'),
                         data['nick'], data['data'])
 
+    def __frame_ready(self, code, type, nick, data):
+        """
+        Callback triggered by the HTTPResponseParser object whenever a frame
+        is complete.
+        """
+        if code != 200:
+            self.__call('_on_request_error', nick, (code, type, data))
+        else:
+            self.__call('_on_' + type.replace('-', '_'), nick, data)
+
     ##########################################################################
     # Following methods are public but just because they need to be for the
     # asyncore API
@@ -148,21 +308,21 @@ class HTTPClient(asyncore.dispatcher):
                     self.__requests[0] = request[sent:]
 
     def handle_read(self):
-        data = self.recv(2048)
+        # Receive directly into the parser buffer avoiding intermediate strings
+        view = self.__parser.buffer.reserve(self.recv_size)
 
-        if not self.__request.got_header:
-            self.__inbuffer += data
-            buff = self.__inbuffer
-
-            i = buff.find("\r\n\r\n")
-
-            if i < 0:
+        try:
+            size = self.socket.recv_into(view, self.recv_size)
+        except socket.error, why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
                 return
+            raise
+        finally:
+            del view
 
-            fp = StringIO.StringIO(buff[:i + 4])
-            self.__request.parse_headers(fp.readline().split(" ", 2),
-                                         mimetools.Message(fp))
+        if size == 0:
+            self.handle_close()
+            return
 
-            self.__inbuffer = self.__request.feed(buff[i + 4:])
-        else:
-            self.__inbuffer = self.__request.feed(data)
+        self.__parser.commit(size)
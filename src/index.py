@@ -0,0 +1,298 @@
+"""
+This module holds the term dictionary written next to the posting files of
+the ri application and the query API built on top of it.
+
+The dictionary of a posting file is stored in a sidecar file with the same
+name plus the .idx suffix. It contains the sorted terms of the file together
+with the offset and the number of postings of every list. The offset points
+to the list itself for raw files and to the block holding the list for
+compact files (see postings.py).
+
+Long lists of raw files also get sparse skip pointers: the docid of one
+posting every skip-interval postings. Since raw postings have a fixed size a
+query can seek directly to the chunk of a list which may hold a docid
+without reading the rest of the list.
+"""
+
+import os
+import bisect
+import marshal
+
+from array import array
+from postings import UINT, MmapPostingReader, CompactPostingReader, \
+                     decode_block, is_compact
+
+INDEX_VERSION = 2
+INDEX_SUFFIX = '.idx'
+MARSHAL_VERSION = 2
+
+def get_index_name(fname):
+    "@return the path of the dictionary of the posting file fname"
+    return fname + INDEX_SUFFIX
+
+class IndexWriter(object):
+    """
+    Collect the dictionary of a posting file while it is being written
+    """
+    def __init__(self, fname, fmt='raw', skip_interval=128):
+        """
+        @param fname the path to the posting file
+        @param fmt the format of the posting file: raw or compact
+        @param skip_interval the number of postings between two skip pointers
+        """
+        self.fname = fname
+        self.index_name = get_index_name(fname)
+        self.fmt = fmt
+        self.skip_interval = skip_interval
+
+        self.terms = []
+        self.offsets = []
+        self.counts = []
+        self.skips = {}
+        self.max_docid = -1
+
+    def add(self, term, offset, postings):
+        """
+        Add a posting list to the dictionary. Lists must be added sorted by
+        term
+        @param term a str
+        @param offset the value returned by the write() method of the writer
+        @param postings the flat posting list of the term
+        """
+        count = len(postings) / 2
+
+        self.terms.append(term)
+        self.offsets.append(offset)
+        self.counts.append(count)
+
+        if count > 0:
+            self.max_docid = max(self.max_docid, postings[-2])
+
+        if self.fmt == 'raw' and count > self.skip_interval:
+            self.skips[term] = list(postings[::2 * self.skip_interval])
+
+    def close(self):
+        "Store the dictionary in the sidecar file"
+        # Several workers may index the same file during the scoring stage
+        tmp = "%s.tmp%d" % (self.index_name, os.getpid())
+
+        with open(tmp, 'wb') as f:
+            marshal.dump((INDEX_VERSION, self.fmt, self.skip_interval,
+                          self.terms, self.offsets, self.counts, self.skips,
+                          self.max_docid),
+                         f, MARSHAL_VERSION)
+
+        os.rename(tmp, self.index_name)
+
+def build_index(fname, skip_interval=128):
+    """
+    Write the dictionary of an existing posting file, for example one
+    produced by the C reducer
+    @param fname the path to the posting file
+    @param skip_interval the number of postings between two skip pointers
+    @return the IndexWriter used
+    """
+    if is_compact(fname):
+        index = IndexWriter(fname, 'compact', skip_interval)
+        reader = CompactPostingReader(fname)
+
+        for offset, data in reader.blocks():
+            for term, postings in decode_block(data):
+                index.add(term, offset, postings)
+    else:
+        index = IndexWriter(fname, 'raw', skip_interval)
+        reader = MmapPostingReader(fname)
+
+        for term, offset, count in reader.terms():
+            index.add(term, offset - 2 * UINT.size - len(term),
+                      reader.postings(offset, count))
+
+    reader.close()
+    index.close()
+
+    return index
+
+class InvertedIndex(object):
+    """
+    Answer queries over a posting file through its dictionary. The
+    dictionary is loaded the first time it is needed and posting lists are
+    read with seeks.
+    """
+    def __init__(self, fname):
+        """
+        @param fname the path to the posting file
+        """
+        self.fname = fname
+        self.index_name = get_index_name(fname)
+
+        self.file = None
+        self.reader = None
+
+        # Last decoded block of a compact file
+        self.block = (None, None)
+
+    def __load(self):
+        if self.file is not None or self.reader is not None:
+            return
+
+        if not os.path.exists(self.index_name):
+            raise Exception("No dictionary found for %s. Use " \
+                            "scripts/build-index.py to create it" % self.fname)
+
+        with open(self.index_name, 'rb') as f:
+            data = marshal.load(f)
+
+        if data[0] != INDEX_VERSION:
+            raise Exception("Unsupported version %d of dictionary %s. Use " \
+                            "scripts/build-index.py to build it again" % \
+                            (data[0], self.index_name))
+
+        self.fmt, self.skip_interval, self.terms, self.offsets, \
+            self.counts, self.skips, self.max_docid = data[1:]
+
+        if self.fmt == 'compact':
+            self.reader = CompactPostingReader(self.fname)
+        else:
+            self.file = open(self.fname, 'rb')
+
+    def __find(self, term):
+        "@return the position of term in the dictionary or -1"
+        self.__load()
+        pos = bisect.bisect_left(self.terms, term)
+
+        if pos < len(self.terms) and self.terms[pos] == term:
+            return pos
+
+        return -1
+
+    def __len__(self):
+        self.__load()
+        return len(self.terms)
+
+    def dictionary(self):
+        "@return a (terms, counts) tuple of sorted lists"
+        self.__load()
+        return self.terms, self.counts
+
+    def documents(self):
+        "@return an upper bound to the number of documents of the file"
+        self.__load()
+        return self.max_docid + 1
+
+    def frequency(self, term):
+        "@return the number of documents holding term"
+        pos = self.__find(term)
+        return self.counts[pos] if pos >= 0 else 0
+
+    def __read(self, pos, start, count):
+        """
+        Read count postings of a raw list starting from the start-th
+        @return a flat array
+        """
+        term = self.terms[pos]
+        self.file.seek(self.offsets[pos] + 2 * UINT.size + len(term) +
+                       2 * UINT.size * start)
+
+        postings = array('I')
+        postings.fromstring(self.file.read(2 * UINT.size * count))
+        return postings
+
+    def lookup(self, term):
+        "@return the flat posting list of term, empty if it is missing"
+        pos = self.__find(term)
+
+        if pos < 0:
+            return array('I')
+
+        if self.fmt != 'compact':
+            return self.__read(pos, 0, self.counts[pos])
+
+        offset = self.offsets[pos]
+
+        if self.block[0] != offset:
+            self.block = (offset,
+                          dict(decode_block(self.reader.block_at(offset))))
+
+        return self.block[1][term]
+
+    def __probe(self, pos, docids):
+        """
+        Look for docids in a raw list through its skip pointers
+        @return a dictionary mapping the docids found to their occurrences
+        """
+        skips = self.skips[self.terms[pos]]
+        interval = self.skip_interval
+        count = self.counts[pos]
+
+        found = {}
+        current = -1
+
+        for docid in docids:
+            chunk = bisect.bisect_right(skips, docid) - 1
+
+            if chunk < 0:
+                continue
+
+            if chunk != current:
+                current = chunk
+                start = chunk * interval
+                postings = self.__read(pos, start,
+                                       min(interval, count - start))
+                chunk_docids = postings[::2]
+
+            idx = bisect.bisect_left(chunk_docids, docid)
+
+            if idx < len(chunk_docids) and chunk_docids[idx] == docid:
+                found[docid] = postings[2 * idx + 1]
+
+        return found
+
+    def conjunctive(self, terms):
+        """
+        Find the documents holding all the terms. Lists are intersected from
+        the shortest one, probing long raw lists through skip pointers.
+        @param terms a list of str
+        @return a list of (docid, [occurrences of every term]) tuples sorted
+                by docid
+        """
+        positions = [self.__find(term) for term in terms]
+
+        if not positions or min(positions) < 0:
+            return []
+
+        order = sorted(xrange(len(terms)),
+                       key=lambda i: self.counts[positions[i]])
+
+        first = self.lookup(terms[order[0]])
+        results = [(first[i], {order[0]: first[i + 1]})
+                   for i in xrange(0, len(first), 2)]
+
+        for i in order[1:]:
+            if not results:
+                break
+
+            pos = positions[i]
+            docids = [docid for docid, _ in results]
+
+            if self.terms[pos] in self.skips and \
+               len(docids) * self.skip_interval < self.counts[pos]:
+                found = self.__probe(pos, docids)
+            else:
+                postings = self.lookup(terms[i])
+                found = dict(zip(postings[::2], postings[1::2]))
+
+            results = [(docid, occs) for docid, occs in results
+                       if docid in found]
+
+            for docid, occs in results:
+                occs[i] = found[docid]
+
+        return [(docid, [occs[i] for i in xrange(len(terms))])
+                for docid, occs in results]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+        if self.reader is not None:
+            self.reader.close()
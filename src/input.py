@@ -5,7 +5,9 @@ stream that should feed the map-reduce computation
 
 import json
 import os.path
-from utils import Logger
+import zipfile
+import itertools
+from utils import Logger, load_module
 
 class Input(Logger):
     """
@@ -35,3 +37,192 @@ class Input(Logger):
         @return yields a tuple (fname, docid)
         """
         raise Exception("Not implemented")
+
+    def resume(self, position):
+        """
+        Return the input generator skipping the inputs already consumed. The
+        default implementation enumerates them again: override it if the
+        inputs can be reached directly.
+        @param position the number of inputs to skip
+        @return a generator like input()
+        """
+        return itertools.islice(self.input(), position, None)
+
+def input_files(inp):
+    """
+    @param inp an input as yielded by Input.input() or InputSplitter.input()
+    @return the list of the paths of the files it refers to
+    """
+    if len(inp) > 2:
+        return [fname for fname, _, _ in inp[2]]
+
+    return [inp[0]]
+
+class InputSplitter(Logger):
+    """
+    Wrap an Input in order to produce map tasks of about split-size bytes.
+    Consecutive small files are coalesced into a single task while zip
+    archives bigger than split-size are split into ranges of members of
+    similar compressed size.
+
+    Inputs made of a single whole file keep the (fname, id) form. The others
+    are in the form (fname, id, parts) where fname is the first file and
+    parts a tuple of (fname, start, stop) tuples: the members of the archive
+    fname to process are infolist()[start:stop], stop being None for whole
+    files.
+    """
+    def __init__(self, inp, split_size):
+        """
+        @param inp the Input instance to wrap
+        @param split_size the target number of bytes of a map task
+        """
+        super(InputSplitter, self).__init__("InputSplitter")
+
+        self.inp = inp
+        self.datadir = inp.datadir
+        self.split_size = split_size
+
+        # State of the generator after the last task extracted, which can be
+        # given to resume()
+        self.position = (0, 0, [], 0, [])
+
+    def ranges(self, path):
+        """
+        Split an archive in ranges of members
+        @param path the path to the archive
+        @return a list of (start, stop) tuples
+        """
+        archive = zipfile.ZipFile(path)
+        sizes = [info.compress_size for info in archive.infolist()]
+        archive.close()
+
+        total = sum(sizes)
+        count = max(1, int(round(float(total) / self.split_size)))
+
+        ranges = []
+        start = cumulative = 0
+
+        for pos, size in enumerate(sizes):
+            cumulative += size
+
+            # Cut as soon as the k-th fraction of the archive is reached
+            if cumulative * count >= total * (len(ranges) + 1) and \
+               len(ranges) < count - 1:
+                ranges.append((start, pos + 1))
+                start = pos + 1
+
+        if start < len(sizes) or not ranges:
+            ranges.append((start, len(sizes)))
+
+        return ranges
+
+    def __task(self, tid, parts):
+        if len(parts) == 1 and parts[0][1:] == (0, None):
+            return (parts[0][0], tid)
+
+        return (parts[0][0], tid, tuple(parts))
+
+    def input(self):
+        """
+        @return yields (fname, id) or (fname, id, parts) tuples
+        """
+        return self.__tasks(self.inp.input(), 0, 0, [], 0, [])
+
+    def resume(self, position):
+        """
+        Return the generator skipping the tasks already consumed. The wrapped
+        Input is resumed through its own resume() and the splitter starts
+        again from the state it had when the last task was extracted
+        @param position the position attribute read after the last task
+                        extracted, or the number of tasks to skip, in which
+                        case they are computed again
+        """
+        if isinstance(position, (int, long)):
+            return itertools.islice(self.input(), position, None)
+
+        consumed, tid, parts, size, queued = position
+        return self.__tasks(self.inp.resume(consumed), consumed, tid,
+                            [tuple(part) for part in parts], size,
+                            [[tuple(part) for part in ready]
+                             for ready in queued])
+
+    def __tasks(self, inputs, consumed, tid, parts, size, queued):
+        """
+        Generate the tasks keeping in the position attribute the state
+        needed to resume after the last one yielded: the number of inputs
+        consumed, the next task ID, the parts being coalesced with their
+        size and the parts of the tasks ready to be yielded
+        @param inputs the generator of the wrapped Input
+        """
+        while True:
+            while queued:
+                task = self.__task(tid, queued.pop(0))
+                tid += 1
+
+                self.position = (consumed, tid, list(parts), size,
+                                 [list(ready) for ready in queued])
+                yield task
+
+            try:
+                inp = inputs.next()
+            except StopIteration:
+                break
+
+            consumed += 1
+            fname = inp[0]
+            path = os.path.join(self.datadir, fname)
+            fsize = os.path.getsize(path)
+
+            if fsize > self.split_size and zipfile.is_zipfile(path):
+                ranges = self.ranges(path)
+
+                if len(ranges) > 1:
+                    self.info("Splitting %s (%d bytes) in %d ranges" % \
+                              (fname, fsize, len(ranges)))
+
+                    # Keep the order of the inputs
+                    if parts:
+                        queued.append(parts)
+                        parts, size = [], 0
+
+                    queued.extend([(fname, start, stop)]
+                                  for start, stop in ranges)
+                    continue
+
+            if parts and size + fsize > self.split_size:
+                queued.append(parts)
+                parts, size = [], 0
+
+            parts.append((fname, 0, None))
+            size += fsize
+
+        if parts:
+            task = self.__task(tid, parts)
+            self.position = (consumed, tid + 1, [], 0, [])
+            yield task
+
+def create_input(conf, fconf):
+    """
+    Instantiate the Input class of input-module, wrapped by an InputSplitter
+    if input-split-size is given. The Mapper class of map-module must then
+    be able to process ranges of archive members.
+    @param conf the configuration dictionary
+    @param fconf the path to the configuration file
+    @return an object exposing the input() generator
+    """
+    cls = getattr(load_module(conf['input-module']), 'Input')
+    inp = cls(fconf)
+    split_size = int(conf.get('input-split-size', 0))
+
+    if split_size > 0:
+        mapper = getattr(load_module(conf['map-module']), 'Mapper')
+
+        if not mapper.supports_ranges(conf):
+            raise Exception("The Mapper of %s cannot process the archives " \
+                            "split by input-split-size. Disable it or " \
+                            "change the map configuration" % \
+                            conf['map-module'])
+
+        return InputSplitter(inp, split_size)
+
+    return inp
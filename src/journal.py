@@ -0,0 +1,202 @@
+"""
+This module holds the write-ahead journal used by the server to persist its
+scheduling state (see cursor.py).
+
+A journal is made of two files. The log is append-only and holds marshalled
+records, each one preceded by its length. Records are flushed to the
+operating system as soon as they are appended, which is enough to survive a
+crash of the server, while the log is synced to disk at most every
+sync-interval seconds in order to amortize the cost of fsync over many
+records.
+
+Every snapshot-records records the whole state is written to the snapshot
+file and a new log is started. The first record of a log holds the
+generation of the snapshot it follows, so that a log left behind by a crash
+happening right after a snapshot is recognized and discarded. On startup
+the snapshot is loaded and the log replayed on top of it. A record torn by a
+crash is discarded.
+"""
+
+import os
+import time
+import struct
+import marshal
+
+from threading import Lock
+from utils import Logger
+
+RECORD_HEADER = struct.Struct('=I')
+MARSHAL_VERSION = 2
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+# First record of every log
+REC_GENERATION = -1
+
+class Journal(Logger):
+    """
+    Base class of the journals. Subclasses hold the state, initialize it
+    before calling the constructor and implement apply(), dump() and load().
+    """
+    def __init__(self, fname, sync_interval=0.05, snapshot_records=100000,
+                 name="Journal"):
+        """
+        Open the journal, replaying it if it already exists
+        @param fname the path to the log
+        @param sync_interval the maximum number of seconds between two syncs
+                             of the log. 0 syncs every record
+        @param snapshot_records the number of records after which a snapshot
+                                is taken. 0 disables the snapshots
+        @param name name to assign to the logger
+        """
+        super(Journal, self).__init__(name)
+
+        self.fname = fname
+        self.snapshot_name = fname + SNAPSHOT_SUFFIX
+        self.sync_interval = sync_interval
+        self.snapshot_records = snapshot_records
+
+        # The log is synced by the hearthbeat thread as well
+        self.lock = Lock()
+
+        self.generation = 0
+        self.records = 0
+        self.dirty = False
+        self.last_sync = time.time()
+
+        start = time.time()
+
+        if os.path.exists(self.snapshot_name):
+            with open(self.snapshot_name, 'rb') as f:
+                self.generation, state = marshal.load(f)
+
+            self.load(state)
+
+        offset = 0
+
+        if os.path.exists(fname):
+            offset = self.__replay()
+
+        self.file = open(fname, 'ab')
+        self.file.truncate(offset)
+
+        if offset == 0:
+            self.__write((REC_GENERATION, self.generation))
+            self.__sync()
+
+        self.info("Journal %s generation %d replayed in %.3f secs" % \
+                  (fname, self.generation, time.time() - start))
+
+    def __replay(self):
+        "@return the offset following the last record to keep"
+        with open(self.fname, 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        records = []
+
+        while offset + RECORD_HEADER.size <= len(data):
+            length, = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+
+            if end > len(data):
+                break
+
+            try:
+                records.append(
+                    marshal.loads(data[offset + RECORD_HEADER.size:end]))
+            except (EOFError, ValueError, TypeError):
+                break
+
+            offset = end
+
+        if not records:
+            return 0
+
+        if records[0][0] != REC_GENERATION:
+            raise Exception("%s is not a journal" % self.fname)
+
+        # The snapshot already includes the records of an older log
+        if records[0][1] != self.generation:
+            self.warning("Discarding log %s of generation %d" % \
+                         (self.fname, records[0][1]))
+            return 0
+
+        if offset < len(data):
+            self.warning("Discarding %d bytes at the end of %s" % \
+                         (len(data) - offset, self.fname))
+
+        for record in records[1:]:
+            self.apply(record)
+
+        self.records = len(records) - 1
+        return offset
+
+    def __write(self, record):
+        payload = marshal.dumps(record, MARSHAL_VERSION)
+        self.file.write(RECORD_HEADER.pack(len(payload)) + payload)
+        self.file.flush()
+
+    def __sync(self):
+        os.fsync(self.file.fileno())
+        self.dirty = False
+        self.last_sync = time.time()
+
+    def append(self, record):
+        """
+        Apply a record to the state and append it to the log
+        @param record a tuple whose first element is the type of the record
+        """
+        with self.lock:
+            self.apply(record)
+            self.__write(record)
+            self.dirty = True
+            self.records += 1
+
+            if time.time() - self.last_sync >= self.sync_interval:
+                self.__sync()
+
+        if self.snapshot_records and self.records >= self.snapshot_records:
+            self.checkpoint()
+
+    def sync(self):
+        "Sync the records appended since the last sync"
+        with self.lock:
+            if self.dirty:
+                self.__sync()
+
+    def checkpoint(self):
+        "Write a snapshot of the state and start a new log"
+        with self.lock:
+            tmp = self.snapshot_name + '.tmp'
+
+            with open(tmp, 'wb') as f:
+                marshal.dump((self.generation + 1, self.dump()), f,
+                             MARSHAL_VERSION)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp, self.snapshot_name)
+            self.generation += 1
+
+            self.file.truncate(0)
+            self.__write((REC_GENERATION, self.generation))
+            self.__sync()
+
+            self.records = 0
+
+    def apply(self, record):
+        "This method must be overriden. Update the state with a record"
+        raise Exception("Not implemented")
+
+    def dump(self):
+        "This method must be overriden. @return the state as marshal objects"
+        raise Exception("Not implemented")
+
+    def load(self, state):
+        "This method must be overriden. Restore the state returned by dump()"
+        raise Exception("Not implemented")
+
+    def close(self):
+        self.sync()
+        self.file.close()
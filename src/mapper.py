@@ -3,8 +3,16 @@ This module holds the definition for the mapper class computing the some
 function exploiting some degree of data locality
 """
 
+import os
+import sys
+import time
 import os.path
-from utils import Logger
+
+from array import array
+from records import RecordWriter
+from postings import create_posting_writer
+from partitioner import create_partitioner
+from utils import Logger, create_file, get_id
 
 class Mapper(Logger):
     def __init__(self, conf, name="Mapper"):
@@ -28,6 +36,31 @@ class Mapper(Logger):
     def setup(self, vfs):
         self.vfs = vfs
 
+    @classmethod
+    def supports_ranges(cls, conf):
+        """
+        Override it if the mapper cannot process ranges of archive members,
+        which are produced by an InputSplitter (see input.py)
+        @param conf a dictionary corresponding to the parsed json conf file
+        @return True if the mapper can process ranges of archive members
+        """
+        return True
+
+    def pull_parts(self, inp):
+        """
+        Pull the files of an input, which may have been split or coalesced by
+        an InputSplitter (see input.py)
+        @param inp a tuple (fname, id) or (fname, id, parts)
+        @return a list of (local path, start, stop) tuples where start and
+                stop delimit the members of the archive to process, stop being
+                None for whole files
+        """
+        if len(inp) < 3:
+            return [(self.vfs.pull_remote_file(inp)[0], 0, None)]
+
+        return [(self.vfs.pull_remote_file((fname, inp[1]))[0], start, stop)
+                for fname, start, stop in inp[2]]
+
     def execute(self, inp):
         """
         This method must be overriden. The method must return a tuple in the
@@ -41,6 +74,10 @@ class Mapper(Logger):
                 - time_taken is the time expressed in seconds in order to
                   compute the assignment
 
+            Optionally the tuple can be extended with two more integers
+            (totsize, time_taken, records_in, records_out) reporting the
+            number of records before and after the combiner.
+
         The second element is a list of 3-tuples. Each 3-tuple contains:
             1. ridx telling to which reducer the file produced is referred to
             2. fid integer describing the unique identifier of the file
@@ -51,3 +88,282 @@ class Mapper(Logger):
         @return a tuple
         """
         raise Exception("Not implemented")
+
+class StreamingMapper(Mapper):
+    """
+    A Mapper executing the map function directly inside the worker process.
+    Subclasses implement map() and call emit() for every (key, value) pair
+    produced. Pairs are grouped in memory by partition and key, and spilled
+    to record files sorted by key (see records.py) whenever the estimated
+    memory usage exceeds the spill-size configuration parameter.
+
+    Subclasses may also define a combine(key, values) method returning a
+    shorter list of values. The combiner is applied to a partition as soon
+    as it exceeds partition-spill-size bytes, which is spilled only if this
+    does not free at least half of its memory, and to every key before it
+    is written to disk. As the combiner may see its own outputs it has to
+    be re-appliable like the reduce function.
+    """
+
+    # Override with a method combine(self, key, values) returning a list
+    combine = None
+
+    # Set it to True if map() is able to process a range of the members of
+    # an archive, produced by an InputSplitter (see input.py)
+    map_ranges = False
+
+    def __init__(self, conf, name="StreamingMapper"):
+        super(StreamingMapper, self).__init__(conf, name)
+
+        self.num_reducer = int(self.conf['num-reducer'])
+        self.spill_size = int(self.conf.get('spill-size', 64 * 1024 * 1024))
+        self.partition_size = int(self.conf.get('partition-spill-size',
+                                  self.spill_size / self.num_reducer))
+
+        # Decides the reducer of every key. See partitioner.py
+        self.partitioner = create_partitioner(self.conf)
+
+        self.partitions = None
+        self.sizes = None
+        self.buffered = 0
+        self.results = []
+
+        # Number of pairs emitted and of values written after the combiner
+        self.records_in = 0
+        self.records_out = 0
+
+    @classmethod
+    def supports_ranges(cls, conf):
+        return cls.map_ranges
+
+    def map(self, inp):
+        """
+        This method must be overriden. It is called once for every input and
+        it is expected to call emit() for every pair produced.
+        @param inp a tuple (fname, docid) where fname is the path to a local
+                   copy of the input. If map_ranges is True a range of
+                   archive members is given as (fname, docid, start, stop)
+                   where stop is None for the last member
+        """
+        raise Exception("Not implemented")
+
+    def partition(self, key):
+        "@return the reducer ID the key has to be sent to"
+        return self.partitioner.partition(key)
+
+    def emit(self, key, value):
+        """
+        Produce an intermediate pair
+        @param key the key. It must be an object supported by marshal
+        @param value the value. It must be an object supported by marshal
+        """
+        ridx = self.partition(key)
+        partition = self.partitions[ridx]
+        values = partition.get(key)
+        size = sys.getsizeof(value) + 8
+
+        if values is None:
+            partition[key] = [value]
+            size += sys.getsizeof(key) + 64
+        else:
+            values.append(value)
+
+        self.records_in += 1
+        self.sizes[ridx] += size
+        self.buffered += size
+
+        if self.sizes[ridx] >= self.partition_size:
+            self.__compact(ridx)
+
+        if self.buffered >= self.spill_size:
+            self.spill()
+
+    def spill(self):
+        "Write all the buffered pairs to one sorted file per partition"
+        for ridx in xrange(self.num_reducer):
+            self.__spill_partition(ridx)
+
+    def __compact(self, ridx):
+        "Free the memory of a partition exceeding its limit"
+        if self.combine is not None:
+            size = 0
+
+            for key, values in self.partitions[ridx].iteritems():
+                if len(values) > 1:
+                    values[:] = self.combine(key, values)
+
+                size += sys.getsizeof(key) + 64 + \
+                        sum(sys.getsizeof(value) + 8 for value in values)
+
+            self.buffered -= self.sizes[ridx] - size
+            self.sizes[ridx] = size
+
+            if size < self.partition_size / 2:
+                return
+
+        self.__spill_partition(ridx)
+
+    def __spill_partition(self, ridx):
+        "Write the buffered pairs of a partition to a new sorted file"
+        partition = self.partitions[ridx]
+
+        if not partition:
+            return
+
+        handle = create_file(self.output_path, ridx,
+                             self.vfs.master_id, self.vfs.worker_id)
+        writer = RecordWriter(handle)
+
+        for key in sorted(partition):
+            values = partition[key]
+
+            if self.combine is not None and len(values) > 1:
+                values = self.combine(key, values)
+
+            writer.write(key, values)
+            self.records_out += len(values)
+
+        handle.close()
+
+        fname = handle.name
+        fsize = os.path.getsize(fname)
+
+        self.results.append((ridx, get_id(fname), fsize))
+        self.vfs.push_local_file(os.path.basename(fname), True)
+
+        self.partitions[ridx] = {}
+        self.buffered -= self.sizes[ridx]
+        self.sizes[ridx] = 0
+
+    def execute(self, inp):
+        start = time.time()
+
+        self.partitions = [{} for _ in xrange(self.num_reducer)]
+        self.sizes = [0] * self.num_reducer
+        self.buffered = 0
+        self.results = []
+        self.records_in = self.records_out = 0
+
+        for fname, first, last in self.pull_parts(inp):
+            if first == 0 and last is None:
+                self.map((fname, inp[1]))
+            elif self.map_ranges:
+                self.map((fname, inp[1], first, last))
+            else:
+                raise Exception("This StreamingMapper cannot process ranges " \
+                                "of archive members. Raise input-split-size")
+
+        self.spill()
+
+        results, self.results = self.results, []
+        totsize = sum(fsize for _, _, fsize in results)
+
+        self.info("Map finished. Combiner %d -> %d records. Result is %s" % \
+                  (self.records_in, self.records_out, str(results)))
+
+        return ((totsize, time.time() - start,
+                 self.records_in, self.records_out), results)
+
+class PostingMapper(Mapper):
+    """
+    A Mapper building posting lists directly inside the worker process.
+    Subclasses implement parse() and call add_document() with the terms of
+    every document. Postings are partitioned by document like the C mapper
+    of the ri application does and written to posting files (see
+    postings.py) whenever the estimated memory usage exceeds limit-size KB.
+    Documents must be added in increasing docid order.
+    """
+
+    # Estimated bytes used by a term in the dictionary besides its postings
+    TERM_OVERHEAD = 96
+
+    # Bytes used by a (docid, occurrences) posting
+    POSTING_SIZE = 8
+
+    def __init__(self, conf, name="PostingMapper"):
+        super(PostingMapper, self).__init__(conf, name)
+
+        self.num_reducer = int(self.conf['num-reducer'])
+        self.limit_size = int(self.conf['limit-size']) * 1024
+
+        self.partitions = None
+        self.buffered = 0
+        self.results = []
+
+    def parse(self, fname, start=0, stop=None):
+        """
+        This method must be overriden. It is called once for every file of an
+        input and it is expected to call add_document() for every document.
+        @param fname the path to a local copy of the file
+        @param start the index of the first archive member to process
+        @param stop the index following the last member to process or None
+        """
+        raise Exception("Not implemented")
+
+    def add_document(self, docid, terms):
+        """
+        Add the postings of a document
+        @param docid the document ID
+        @param terms a dictionary term => occurrences
+        """
+        partition = self.partitions[docid % self.num_reducer]
+        size = self.POSTING_SIZE * len(terms)
+
+        for term, occ in terms.iteritems():
+            postings = partition.get(term)
+
+            if postings is None:
+                postings = partition[term] = array('I')
+                size += self.TERM_OVERHEAD + len(term)
+
+            postings.append(docid)
+            postings.append(occ)
+
+        self.buffered += size
+
+        if self.buffered >= self.limit_size:
+            self.spill()
+
+    def spill(self):
+        "Write one posting file for every partition holding postings"
+        for ridx, partition in enumerate(self.partitions):
+            if not partition:
+                continue
+
+            handle = create_file(self.output_path, ridx,
+                                 self.vfs.master_id, self.vfs.worker_id)
+            writer = create_posting_writer(handle, self.conf)
+
+            for term in sorted(partition):
+                writer.write(term, partition[term])
+
+            writer.close()
+
+            fname = handle.name
+            fsize = os.path.getsize(fname)
+
+            self.results.append((ridx, get_id(fname), fsize))
+            self.vfs.push_local_file(os.path.basename(fname), True)
+
+            self.partitions[ridx] = {}
+
+        self.buffered = 0
+
+    def execute(self, inp):
+        start = time.time()
+
+        self.partitions = [{} for _ in xrange(self.num_reducer)]
+        self.buffered = 0
+        self.results = []
+
+        for fname, first, last in self.pull_parts(inp):
+            self.parse(fname, first, last)
+
+        self.spill()
+
+        results, self.results = self.results, []
+        totsize = sum(fsize for _, _, fsize in results)
+
+        self.info("Map finished. Result is %s" % str(results))
+
+        return ((totsize, time.time() - start), results)
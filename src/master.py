@@ -13,9 +13,12 @@ import urlparse
 from mpi4py import MPI
 
 from mux import Muxer
+from merge import create_policy
 from status import MasterStatus
 from httptransport import HTTPClient
+from framing import FRAMING_BINARY, encode_frame
 from threading import Lock, Thread, Semaphore, Timer, Event
+from collections import deque
 from utils import Logger, count_machines
 from message import *
 
@@ -62,6 +65,24 @@ class Master(Logger, HTTPClient):
         self.url = self.conf['master-url']
         self.sleep_inter = self.conf['sleep-interval']
 
+        # If True the binary framing is proposed to the server at registration
+        self.binary_protocol = self.conf.get('binary-protocol', False)
+
+        # The DFS nodes of the workers are advertised to the server in order
+        # to receive maps whose input is already stored on one of them. Every
+        # worker reports its node with its first request. worker_id => node
+        self.use_dfs = self.conf['dfs-enabled']
+        self.nodes = {}
+
+        # The boundaries of the range partitioner received at registration and
+        # the IDs of the workers they were already sent to with a map
+        self.boundaries = None
+        self.boundaries_sent = set()
+
+        # True if the server speculates stragglers, which requires the start
+        # of every map to be reported
+        self.speculation = False
+
         # Generic lock to synchronize the access to the instance variables of
         # the object itself. Its use should be minimized.
         self.lock = Lock()
@@ -72,7 +93,7 @@ class Master(Logger, HTTPClient):
 
         # Simple queue of WorkerStatus(TYPE_MAP, ..) objects. Filled whenever
         # the server returns us a compute-map message.
-        self.map_queue = []
+        self.map_queue = deque()
 
         # An event that whenever is set marks the end of the computation, set
         # upon reception of the plz-die message
@@ -82,6 +103,9 @@ class Master(Logger, HTTPClient):
         # one row. Usually should be set to the MAX_FD of the system.
         self.threshold_nfile = int(self.conf["threshold-nfile"])
 
+        # Decides which partial files are merged together. See merge.py
+        self.merge_policy = create_policy(self.conf)
+
         # Simple lock that synchronize access to reduc* instance variables.
         self.reduce_lock = Lock()
 
@@ -107,10 +131,26 @@ class Master(Logger, HTTPClient):
             self.reduce_started.append(False)
             self.reducing_files.append([])
 
+        # Outputs of the maps waiting for the server to confirm that they
+        # have not been superseded by a speculative copy. tag => result
+        self.unconfirmed = {}
+
         # The timer will be used to unlock the semaphore that is used as
-        # bounding mechanism for requesting new jobs to the server.
+        # bounding mechanism for requesting new jobs to the server. Every
+        # permit is either a map being executed or a map waiting in the
+        # map_queue, therefore we have twice the slots of the workers alive in
+        # order to keep a prefetch buffer as large as the number of workers.
+        # The permits are added once the workers are spawned. The permits of
+        # the killed workers still held by a request are owed and withheld
+        # from the next ones given back.
         self.timer = None
-        self.num_pending_request = Semaphore(self.n_machines)
+        self.try_later_permits = 0
+        self.owed_permits = 0
+        self.num_pending_request = Semaphore(0)
+
+        # Maximum number of maps requested to the server in a single round
+        # trip. Zero means as many as the workers currently alive.
+        self.batch_size = int(self.conf.get('work-batch-size', 0))
 
         # Here we start two simple thread one in charge of executing requests
         # and the other which is in charge of executing the main loop. There is
@@ -134,6 +174,7 @@ class Master(Logger, HTTPClient):
                     self.units_to_kill += data
         else:
             self.communicators.spawn_more(data)
+            self.__give_permits(2 * data)
 
             total = self.communicators.get_total()
 
@@ -152,26 +193,46 @@ class Master(Logger, HTTPClient):
     def _on_try_later(self, nick, data):
         #self.info("Waiting 1 second before unblocking requester.")
 
-        if self.timer is None:
-            self.timer = Timer(1, self._unblock_requester)
-            self.timer.start()
+        # The payload is the number of permits taken by the work-request
+        with self.lock:
+            self.try_later_permits += data or 1
+
+            if self.timer is None:
+                self.timer = Timer(1, self._unblock_requester)
+                self.timer.start()
 
     def _unblock_requester(self):
-        self.num_pending_request.release()
-        self.timer = None
+        with self.lock:
+            permits, self.try_later_permits = self.try_later_permits, 0
+            self.timer = None
+
+        self.__give_permits(permits)
 
     def _on_request_error(self, nick, data):
-        self.error("Error in request")
+        # The payload is a tuple (code, type, data) of the failed reply
+        self.error("Error in request: %s" % str(data))
 
     def _on_connected(self):
         self.info("Succesfully connected to the server. Trying registration.")
-        self.__send_req('registration', immediate=True)
+        self.__send_registration()
 
     def _on_reduce_recovery(self, nick, data):
         self.info("We need to recover something %s" % str(data))
         self.reducing_files = data
 
     def _on_registration_ok(self, nick, data):
+        if isinstance(data, dict) and 'framing' in data:
+            # The server accepted the binary framing. Everything following
+            # this reply will be exchanged as frames.
+            self.info("Switching to %s framing" % data['framing'])
+            self._start_framing()
+
+        if isinstance(data, dict):
+            # Boundaries of the range partitioner, if it is used
+            self.boundaries = data.get('boundaries')
+            self.speculation = data.get('speculation', False)
+            data = data['id']
+
         with self.lock:
             if self.registered:
                 self.error("Already registered")
@@ -186,15 +247,79 @@ class Master(Logger, HTTPClient):
         self.warning("Nick already used. Randomizing nick for your fun")
         self.nick = MPI.Get_processor_name() + str(random.randint(0, 100))
         self.warning("Your new nick is %s" % self.nick)
-        self.__send_req('registration', immediate=True)
+        self.__send_registration()
+
+    def _on_registration_needed(self, nick, data):
+        self.error("The server does not know us anymore")
+
+        # The payload of a reply to a work-request is the number of permits
+        if isinstance(data, int):
+            self.__give_permits(data or 1)
 
     def _on_end_of_stream(self, nick, data):
         with self.lock:
             self.end_of_stream = True
 
+        # The payload is the number of permits taken by the work-request
+        if isinstance(data, int):
+            self.__give_permits(data or 1)
+
     def _on_compute_map(self, nick, data):
+        # Only sent to requests of a single map, whose permit is now taken by
+        # the map itself
         self.__push_work(WorkerStatus(TYPE_MAP, nick, data))
 
+    def _on_compute_map_batch(self, nick, data):
+        requested, works = data
+
+        for tag, state, nodes in works:
+            self.__push_work(WorkerStatus(TYPE_MAP, tag, state, nodes))
+
+        # Give back the permits the server was not able to satisfy
+        self.__give_permits(requested - len(works))
+
+    def _on_compute_reduce_batch(self, nick, data):
+        requested, tasks = data
+
+        # Independent merges of the merge phase. They are queued together
+        # with the maps and executed by any available worker. Tasks of the
+        # scoring stage also carry the list of the final files.
+        for task in tasks:
+            self.__push_work(WorkerStatus(TYPE_REDUCE, task[0], tuple(task)))
+
+        self.__give_permits(requested - len(tasks))
+
+    def _on_map_ack_ok(self, nick, data):
+        """
+        The server accepted the output of the map: the files can be reduced
+        """
+        with self.lock:
+            result = self.unconfirmed.pop(data, [])
+
+        with self.reduce_lock:
+            for rid, fid, fsize in result:
+                self.reducing_files[rid].append((fid, fsize))
+
+    def _on_map_ack_discard(self, nick, data):
+        """
+        Another group completed the same map first. The server already took
+        care of removing the output files.
+        """
+        tag, files = data
+
+        with self.lock:
+            self.unconfirmed.pop(tag, None)
+
+        self.info("Output of map %s superseded by a speculative copy" % tag)
+
+    def _on_map_ack_fail(self, nick, data):
+        """
+        The server did not recognize the map. The output is reduced anyway as
+        it was done before the acks were confirmed.
+        """
+        self.error("Map %s not acknowledged by the server" % data[0])
+        self._on_map_ack_ok(nick, data[0])
+
     def _on_keep_alive(self, nick, data):
         msg = {'timeprobe': data, 'status': self.status.serialize()}
         self.__send_req('keep-alive', data=msg, immediate=True)
@@ -213,6 +338,10 @@ class Master(Logger, HTTPClient):
         if nick is None:
             nick = self.nick
 
+        if self.framed:
+            self._add_request(encode_frame(type, nick, data), immediate)
+            return
+
         url = urlparse.urlparse(self.url)
         data = json.dumps({'type': type, 'nick': nick, 'data': data})
         self._add_request("POST %s HTTP/1.1\r\n"               \
@@ -222,10 +351,58 @@ class Master(Logger, HTTPClient):
                           "Content-Length: %d\r\n\r\n%s" %     \
                           (url.path, url.hostname, len(data), data), immediate)
 
+    def __send_registration(self):
+        """
+        Send the registration request proposing the binary framing if enabled
+        together with the DFS nodes of the workers
+        """
+        data = {}
+
+        if self.binary_protocol:
+            data['framing'] = FRAMING_BINARY
+
+        if self.nodes:
+            data['nodes'] = self.nodes.values()
+
+        self.__send_req('registration', data=data or '')
+
+    def __give_permits(self, count):
+        """
+        Give back permits to the requester thread, withholding the ones owed
+        for the workers killed
+        @param count the number of permits
+        """
+        with self.lock:
+            owed = min(count, self.owed_permits)
+            self.owed_permits -= owed
+
+        for _ in xrange(count - owed):
+            self.num_pending_request.release()
+
+    def __take_permits(self, count):
+        """
+        Remove permits from the requester thread. The ones currently held by a
+        request or a map are owed.
+        @param count the number of permits
+        """
+        for _ in xrange(count):
+            if not self.num_pending_request.acquire(False):
+                with self.lock:
+                    self.owed_permits += 1
+
     def __requester_thread(self):
         while not self.ev_finished.is_set():
             self.num_pending_request.acquire()
-            self.__send_req('work-request')
+
+            # Grab as many permits as we can without blocking in order to
+            # request a batch of maps with a single round trip.
+            count = 1
+            limit = self.batch_size or self.communicators.get_total()
+
+            while count < limit and self.num_pending_request.acquire(False):
+                count += 1
+
+            self.__send_req('work-request', data=count)
 
         self.info("Requester thread exited correctly")
 
@@ -238,7 +415,8 @@ class Master(Logger, HTTPClient):
         with self.lock:
             exit = self.end_of_stream == True and \
                    self.num_map == 0 and          \
-                   len(self.map_queue) == 0
+                   len(self.map_queue) == 0 and   \
+                   len(self.unconfirmed) == 0
 
         if exit:
             return exit and self.__finished_reduce()
@@ -253,18 +431,45 @@ class Master(Logger, HTTPClient):
                 return True
         return False
 
-    def __pop_work(self):
+    def __pop_work(self, worker_id):
         """
-        Extract a job from the work_queue
+        Extract a job from the work_queue preferring the ones whose input is
+        already stored on the DFS node of the worker
+        @param worker_id the ID of the worker which will execute the job
         @return a WorkerStatus instance
         """
         with self.lock:
+            node = self.nodes.get(worker_id)
+
             if len(self.map_queue) > 0:
                 self.num_map += 1
-                return self.map_queue.pop(0)
+
+                for pos, wstatus in enumerate(self.map_queue):
+                    if node in wstatus.nodes:
+                        del self.map_queue[pos]
+                        return wstatus
+
+                return self.map_queue.popleft()
 
         return WorkerStatus(TYPE_DUMMY, 0, self.sleep_inter)
 
+    def __receive(self):
+        """
+        Receive the next message of the workers, advertising to the server the
+        DFS node reported by a worker with its first request
+        @return a tuple (worker_id, comm, msg)
+        """
+        idx, comm, msg = self.communicators.receive()
+
+        if comm is not None and msg.command == MSG_AVAILABLE and \
+           msg.result is not None:
+            with self.lock:
+                self.nodes[idx] = msg.result
+
+            self.__send_req('nodes', data=[msg.result])
+
+        return idx, comm, msg
+
     def __push_work(self, wstatus):
         """
         Insert a WorkerStatus object in the map_queue.
@@ -277,16 +482,17 @@ class Master(Logger, HTTPClient):
         """
         Update the status of the master and send back ack to the server.
 
-        The method is also responsible of pushing future reduce work in the
-        reducing_files structure.
+        The output files are kept aside until the server confirms them with a
+        map-ack-ok message.
 
         @param the Message object returned by the generic worker
         """
 
         with self.lock:
             self.num_map -= 1
+            self.unconfirmed[msg.tag] = msg.result
 
-        self.num_pending_request.release()
+        self.__give_permits(1)
 
         # Note: msg.result is a list of tuples representing output files
         #       in the form: (rid, fid, fsize)
@@ -298,7 +504,6 @@ class Master(Logger, HTTPClient):
         for rid, fid, fsize in msg.result:
             nfiles += 1
             filesize += fsize
-            self.reducing_files[rid].append((fid, fsize))
 
         self.status.increase(
             map_finished=1,
@@ -309,6 +514,13 @@ class Master(Logger, HTTPClient):
             time=msg.info[1],
         )
 
+        # Mappers having a combiner also report the records saved
+        if len(msg.info) > 2:
+            self.status.increase(
+                combine_input=msg.info[2],
+                combine_output=msg.info[3],
+            )
+
     def __reduce_finished(self, msg, skip=False):
         """
         Update the status of the master and send back ack to the server.
@@ -355,6 +567,7 @@ class Master(Logger, HTTPClient):
         if to_kill:
             comm.send(Message(MSG_QUIT, 0, None))
             self.communicators.remove(comm)
+            self.__take_permits(2)
 
             total = self.communicators.get_total()
 
@@ -383,15 +596,13 @@ class Master(Logger, HTTPClient):
         """
 
         while not self.__finished():
-            idx, comm = self.communicators.receive()
+            # Here we wait until all the map are assigned and also all the
+            # assigned reduce are finished.
+            idx, comm, msg = self.__receive()
 
             if comm is None:
                 break
 
-            # Here we wait until all the map are assigned and also all the
-            # assigned reduce are finished.
-            msg = comm.recv()
-
             if msg.command == MSG_AVAILABLE:
                 if not self.__got_killed(comm):
                     self.__assign_work(idx, comm)
@@ -412,13 +623,11 @@ class Master(Logger, HTTPClient):
         self.info("We have to execute %d reducer works" % to_assign)
 
         while to_assign > 0:
-            idx, comm = self.communicators.receive()
+            idx, comm, msg = self.__receive()
 
             if comm is None:
                 break
 
-            msg = comm.recv()
-
             if msg.command == MSG_AVAILABLE:
                 if not self.__got_killed(comm):
                     # Here we need to check about the type of assignment made.
@@ -446,19 +655,16 @@ class Master(Logger, HTTPClient):
                 self.reducing_files[reduce_idx] = []
                 self.reduce_started[reduce_idx] = False
 
-        for _ in xrange(self.n_machines):
-            self.num_pending_request.release()
-
+        # The merge tasks are requested with the permits given back by the
+        # maps: like them every task holds one until it is finished
         self.info("Entering in the merge phase")
 
         while not self.ev_finished.is_set():
-            idx, comm = self.communicators.receive()
+            idx, comm, msg = self.__receive()
 
             if comm is None:
                 break
 
-            msg = comm.recv()
-
             if msg.command == MSG_AVAILABLE:
                 if not self.__got_killed(comm):
                     self.__assign_work(idx, comm, True)
@@ -466,10 +672,13 @@ class Master(Logger, HTTPClient):
                     self.info("Worker %d was killed as requested" % idx)
 
             elif msg.command == MSG_FINISHED_REDUCE:
+                with self.lock:
+                    self.num_map -= 1
+
+                # The server takes care of merging the output again
                 self.on_reduce_finished(msg.result)
-                self.__reduce_finished(msg)
-                ###
-                self.num_pending_request.release()
+                self.__reduce_finished(msg, True)
+                self.__give_permits(1)
 
         self.__send_req('all-finished')
 
@@ -477,7 +686,7 @@ class Master(Logger, HTTPClient):
         """
         Assign a job to a generic worker
 
-        @param idx the index as returned by the communicators struct
+        @param idx the worker ID as returned by the communicators struct
         @param comm the MPI Intercommunicator
         @param final_phase True if we have to assign to the reducers all the
                            files available if we are approaching the last phase
@@ -487,7 +696,7 @@ class Master(Logger, HTTPClient):
         wstatus = self._check_threshold(final_phase)
 
         if wstatus is None:
-            wstatus = self.__pop_work()
+            wstatus = self.__pop_work(idx)
         else:
             with self.reduce_lock:
                 self.reduce_started[wstatus.tag] = True
@@ -500,31 +709,41 @@ class Master(Logger, HTTPClient):
 
         if msg == MSG_COMPUTE_MAP:
             self.status.increase(map_ongoing=1)
+
+            # The server measures the duration of the maps from now on
+            if self.speculation:
+                self.__send_req('map-started', data=wstatus.tag)
         elif msg == MSG_COMPUTE_REDUCE:
             self.status.increase(reduce_ongoing=1)
 
         self.debug("Assigning %s as role to worker %d" % (MSG_TO_STR[msg], idx))
-        comm.send(Message(msg, wstatus.tag, wstatus.state), dest=0)
+
+        # The replicas tell the worker whether its local copy of the input is
+        # complete
+        msg = Message(msg, wstatus.tag, wstatus.state)
+        msg.nodes = wstatus.nodes
+
+        # Only maps partition keys, so the boundaries go with the first one
+        if msg.command == MSG_COMPUTE_MAP and self.boundaries is not None \
+           and idx not in self.boundaries_sent:
+            msg.boundaries = self.boundaries
+            self.boundaries_sent.add(idx)
+
+        comm.send(msg, dest=0)
 
         return wstatus.type
 
     def _check_threshold(self, ignore_limits=False):
         """
-        This function has to check the reducing_file_sizes and reducing_files
-        and if a given threshold is met return a WorkerStatus representing a
-        reduce operation.
+        This function has to check the reducing_files and if the merge policy
+        finds files worth merging for an idle reducer return a WorkerStatus
+        representing a reduce operation.
 
         @param ignore_limits True if we have to skip threshold-nfile limit
                              check
         @return a WorkerStatus instance or None if a reduce is not required
         """
 
-        overflow = False
-        valid_found = False
-        reduce_idx = 0
-
-        num_files = 0
-
         with self.reduce_lock:
             for reduce_idx, reduce_list in enumerate(self.reducing_files):
 
@@ -532,41 +751,23 @@ class Master(Logger, HTTPClient):
                 if self.reduce_started[reduce_idx]:
                     continue
 
-                for fid, _ in reduce_list:
-                    num_files += 1
+                assigned = self.merge_policy.select(reduce_list, ignore_limits)
 
-                    if ignore_limits:
-                        continue
-
-                    if num_files >= self.threshold_nfile:
-                        overflow = True
-                        break
-
-                if num_files > 1:
-                    # Try to fill as much as possible the queue of input files
-                    # up to threshold limit.
-                    if ignore_limits:
-                        valid_found = True
+                if assigned:
                     break
-                else:
-                    num_files = 0
-                    overflow = False
-                    continue
-
-        if valid_found:
-            # The last valid reduce_idx will be our target
-            files = self.reducing_files[reduce_idx]
-            self.reducing_files[reduce_idx] = files[num_files:]
-            assigned = files[:num_files]
+            else:
+                return None
 
             files_id = map(lambda x: x[0], assigned)
+            selected = set(files_id)
 
-            self.info("Files to reduce %s [overflow check: %s]" % \
-                     (str(files_id), str(overflow)))
+            self.reducing_files[reduce_idx] = \
+                [f for f in reduce_list if f[0] not in selected]
 
-            return WorkerStatus(TYPE_REDUCE, reduce_idx, (reduce_idx, files_id))
-        else:
-            return None
+        self.info("Files to reduce %s [final phase: %s]" % \
+                 (str(files_id), str(ignore_limits)))
+
+        return WorkerStatus(TYPE_REDUCE, reduce_idx, (reduce_idx, files_id))
 
     ##########################################################################
     # Public functions
@@ -601,6 +802,7 @@ class Master(Logger, HTTPClient):
 
         self.communicators = Muxer(self.unique_id, num_machines, (filename, self.fconf))
         self.status.nproc = num_machines
+        self.__give_permits(2 * num_machines)
 
         self.main_thread.start()
         self.requester_thread.start()
@@ -0,0 +1,238 @@
+"""
+This module holds the policies used by the masters to choose which partial
+files of a reducer have to be merged together while the map phase is still
+running.
+
+A policy receives the list of (fid, fsize) tuples available for a reducer and
+returns the subset that has to be merged by a single reduce work. The policy
+in use is selected through the merge-policy key of the configuration.
+"""
+
+import heapq
+
+class MergePolicy(object):
+    """
+    Base class of the merge policies
+    """
+    def __init__(self, nfile, max_bytes=0):
+        """
+        @param nfile the number of files that triggers a merge and the
+                     maximum number of files merged in a row
+        @param max_bytes the maximum number of bytes read by a single merge
+                         or 0 if there is no limit
+        """
+        self.nfile = nfile
+        self.max_bytes = max_bytes
+
+    def select(self, files, ignore_limits=False):
+        """
+        Choose the files to be merged
+        @param files a list of (fid, fsize) tuples available for a reducer
+        @param ignore_limits True in the final phase where all the files of
+                             the reducer have to be merged at once
+        @return a list of (fid, fsize) tuples or an empty list if no merge is
+                required
+        """
+        if len(files) < 2:
+            return []
+
+        if ignore_limits:
+            return list(files)
+
+        if len(files) < self.nfile:
+            return []
+
+        return self._choose(files)
+
+    def _choose(self, files):
+        "Must be overridden. files contains at least nfile tuples"
+        raise Exception("Not implemented")
+
+class FifoPolicy(MergePolicy):
+    """
+    Merge the files in the same order they have been produced
+    """
+    def _choose(self, files):
+        return files[:self.nfile]
+
+class SmallestFirstPolicy(MergePolicy):
+    """
+    Merge the smallest files first like in the construction of an Huffman
+    tree. Only files of similar size are merged together (the biggest at
+    most ratio times the smallest) so that every byte is rewritten a
+    logarithmic number of times instead of merging big files over and over
+    with the new small ones. Merges that would read more than max_bytes are
+    left for the final phase. Files failing the ratio test are merged anyway
+    once there are 2 * nfile of them.
+    """
+    ratio = 2
+
+    def _choose(self, files):
+        heap = [(fsize, fid) for fid, fsize in files]
+        heapq.heapify(heap)
+
+        assigned = []
+        total = 0
+
+        while heap:
+            fsize, fid = heapq.heappop(heap)
+
+            # Slide the window until it holds files of similar size
+            while assigned and fsize > self.ratio * max(assigned[0][1], 1):
+                total -= assigned.pop(0)[1]
+
+            if self.max_bytes and total + fsize > self.max_bytes:
+                break
+
+            assigned.append((fid, fsize))
+            total += fsize
+
+            if len(assigned) == self.nfile:
+                return assigned
+
+        # Files too different in size are never merged and would pile up
+        # until the final phase. Once they are twice nfile the smallest nfile
+        # ones are merged anyway, so a final reduce opens less than 2 * nfile
+        # files. Falling back as soon as there are nfile files would merge
+        # them all every time, like the FifoPolicy.
+        if len(files) >= 2 * self.nfile:
+            assigned = heapq.nsmallest(self.nfile, files,
+                                       key=lambda item: item[1])
+
+            if not self.max_bytes or \
+               sum(fsize for _, fsize in assigned) <= self.max_bytes:
+                return assigned
+
+        return []
+
+POLICIES = {
+    'fifo': FifoPolicy,
+    'smallest-first': SmallestFirstPolicy,
+}
+
+def create_policy(conf):
+    """
+    Instantiate the merge policy requested in the configuration
+    @param conf the configuration dictionary
+    @return a MergePolicy instance
+    """
+    name = conf.get('merge-policy', 'fifo')
+
+    if name not in POLICIES:
+        raise Exception("Unknown merge policy %s" % name)
+
+    return POLICIES[name](int(conf['threshold-nfile']),
+                          int(conf.get('merge-max-bytes', 0)))
+
+class MergePlan(object):
+    """
+    Plan of the merge phase. The partial files of every reducer are merged as
+    a tree: independent tasks of at most fanin files are spread over all the
+    groups and their outputs are merged again until a single file is left
+    for every reducer.
+    """
+    def __init__(self, reduce_work, fanin):
+        """
+        @param reduce_work a list containing for every reducer the list of
+                           (fid, fsize) tuples to be merged
+        @param fanin the maximum number of files merged by a single task
+        """
+        self.fanin = max(fanin, 2)
+
+        self.ready = [list(files) for files in reduce_work]
+        self.outstanding = [0] * len(reduce_work)
+
+        # nick => [(reduce_idx, [(fid, fsize), ..]), ..]
+        self.pending = {}
+
+    def assign(self, nick, count=1):
+        """
+        Extract up to count merge tasks for a group. Reducers having more
+        files ready to be merged are served first.
+        @param nick the nick of the group
+        @param count the maximum number of tasks to assign
+        @return a list of (reduce_idx, [(fid, fsize), ..]) tuples
+        """
+        tasks = []
+
+        while len(tasks) < count:
+            reduce_idx = self.__next_reducer()
+
+            if reduce_idx is None:
+                break
+
+            # Smallest files first in order to keep the tree balanced
+            ready = sorted(self.ready[reduce_idx], key=lambda f: f[1])
+            files, self.ready[reduce_idx] = ready[:self.fanin], \
+                                            ready[self.fanin:]
+
+            self.outstanding[reduce_idx] += 1
+            self.pending.setdefault(nick, []).append((reduce_idx, files))
+            tasks.append((reduce_idx, files))
+
+        return tasks
+
+    def complete(self, nick, reduce_idx, output, inputs):
+        """
+        Mark a merge task as completed
+        @param nick the nick of the group
+        @param reduce_idx the reducer ID
+        @param output the (fid, fsize) tuple of the merged file
+        @param inputs the list of fids merged
+        @return the list of (fid, fsize) tuples merged or None if there is no
+                such task pending for the group
+        """
+        tasks = self.pending.get(nick, [])
+        inputs = set(inputs)
+
+        for pos, (ridx, files) in enumerate(tasks):
+            if ridx == reduce_idx and set(f[0] for f in files) == inputs:
+                del tasks[pos]
+
+                if not tasks:
+                    del self.pending[nick]
+
+                self.outstanding[reduce_idx] -= 1
+                self.ready[reduce_idx].append(tuple(output))
+                return files
+
+        return None
+
+    def remove_group(self, nick):
+        """
+        Put back the files of the tasks assigned to a dead group
+        @param nick the nick of the group
+        @return the number of tasks recovered
+        """
+        tasks = self.pending.pop(nick, [])
+
+        for reduce_idx, files in tasks:
+            self.outstanding[reduce_idx] -= 1
+            self.ready[reduce_idx].extend(files)
+
+        return len(tasks)
+
+    def done(self, reduce_idx):
+        "@return True if the reducer is left with its final file"
+        return self.outstanding[reduce_idx] == 0 and \
+               len(self.ready[reduce_idx]) <= 1
+
+    def finished(self):
+        "@return True if the merge of every reducer is completed"
+        return all(self.done(idx) for idx in xrange(len(self.ready)))
+
+    def __next_reducer(self):
+        """
+        @return the reducer with the most files ready to be merged or None.
+                A reducer is worth a task if it can fill a whole task or if it
+                has no outstanding task whose output could be merged as well
+        """
+        best = None
+
+        for idx, ready in enumerate(self.ready):
+            if len(ready) >= self.fanin or \
+               (len(ready) > 1 and self.outstanding[idx] == 0):
+                if best is None or len(ready) > len(self.ready[best]):
+                    best = idx
+
+        return best
@@ -45,11 +45,14 @@ class WorkerStatus(object):
     """
     Simple placeholder class to have a more readable code.
     """
-    def __init__(self, type, tag, state):
+    def __init__(self, type, tag, state, nodes=()):
         self.type = type
         self.tag = tag
         self.state = state
 
+        # DFS nodes holding a replica of the input of a map
+        self.nodes = nodes
+
     def __str__(self):
         if self.type == TYPE_MAP:
             return "<Map [%s] (%s)>" % (str(self.tag), str(self.state))
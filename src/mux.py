@@ -4,28 +4,81 @@ communicators.
 """
 
 import sys
-import time
+import cPickle as pickle
 
 from mpi4py import MPI
 from threading import Lock
+from collections import deque
+from utils import Logger
 
-class Muxer(object):
-    def __init__(self, unique_id, nproc, args, interval=0.1):
+# Tag of the message posted on COMM_SELF in order to wake up a receive() that
+# is blocked while the set of channels is being modified by another thread.
+WAKEUP_TAG = 1
+
+# Tag of the messages too large to fit in the buffer of the receives posted by
+# the Muxer. They are announced with an Oversized message sent with the
+# default tag and then received with a blocking receive of any size.
+LARGE_TAG = 2
+
+# Default size in bytes of the buffer of the posted receives
+BUFSIZE = 65536
+
+class Oversized(object):
+    "Announce a message sent with LARGE_TAG"
+    def __init__(self, size):
+        """
+        @param size the size in bytes of the pickled message
+        """
+        self.size = size
+
+def send_message(comm, msg, bufsize=BUFSIZE):
+    """
+    Send a message to the Muxer listening at the other side of comm. Messages
+    not fitting in the buffer of its posted receives are announced first and
+    then sent with LARGE_TAG.
+    @param comm the intercommunicator to the master
+    @param msg the message to send
+    @param bufsize the size of the buffers of the Muxer
+    """
+    size = len(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+
+    if size <= bufsize:
+        comm.send(msg, dest=0)
+    else:
+        comm.send(Oversized(size), dest=0)
+        comm.send(msg, dest=0, tag=LARGE_TAG)
+
+class Muxer(Logger):
+    def __init__(self, unique_id, nproc, args, bufsize=BUFSIZE):
         """
         @param unique_id an unique ID identifying the current master
         @param nproc the number of MPI processes you want use
         @param args the arguments to pass to the MPI_Spawn
-        @param interval the time you want to sleep before starting a new
-               polling cycle of reads from the intercommunicators
+        @param bufsize the size in bytes of the buffer used by each of the
+               non-blocking receives posted on the intercommunicators.
+               Larger messages must be sent through send_message.
         """
+        super(Muxer, self).__init__("Muxer")
+
         self.unique_id = unique_id
         self.last_worker_id = -1
 
-        self.index = 0
+        self.index = -1
         self.channels = []
-        self.interval = interval
+        self.worker_ids = []
+        self.bufsize = bufsize
         self.arguments = args
 
+        # For each channel we keep a pending irecv in the same position of the
+        # requests list. Completed messages waiting to be served are collected
+        # in the ready queue in a round robin fashion.
+        self.requests = []
+        self.ready = deque()
+        self.wakeup = MPI.COMM_SELF.irecv(source=0, tag=WAKEUP_TAG)
+
+        # Non-blocking sends of the wake up messages not yet completed
+        self.wakers = []
+
         self.lock = Lock()
         self.spawn_more(nproc)
 
@@ -46,18 +99,37 @@ class Muxer(object):
                                        args=arguments,
                                        maxprocs=1)
             arguments.pop()
-            new_channels.append(comm)
+            new_channels.append((self.last_worker_id, comm))
 
         with self.lock:
-            self.channels.extend(new_channels)
+            for worker_id, comm in new_channels:
+                self.channels.append(comm)
+                self.worker_ids.append(worker_id)
+                self.requests.append(self.__post(comm))
+
+        self.__wake_up()
 
     def remove(self, comm):
         """
-        Remove a given Intercommunicator from the listening set
+        Remove a given Intercommunicator from the listening set. The messages
+        received on it and not served yet are dropped and logged.
         @param comm a MPI.Intercommunicator
         """
         with self.lock:
-            self.channels.remove(comm)
+            pos = self.__position(comm)
+
+            worker_id = self.worker_ids.pop(pos)
+            self.channels.pop(pos)
+            self.__drain(self.requests.pop(pos), comm, worker_id)
+
+            for item in self.ready:
+                if item[2] is comm:
+                    self.__dropped(worker_id, item[3])
+
+            self.ready = deque(item for item in self.ready
+                               if item[2] is not comm)
+
+        self.__wake_up()
 
     def get_total(self):
         "@return the number of MPI processes used"
@@ -75,35 +147,141 @@ class Muxer(object):
                 comm.send(msg, dest=0)
 
             if remove:
+                for request in self.requests:
+                    request.Cancel()
+
                 self.channels = []
+                self.worker_ids = []
+                self.requests = []
+                self.ready.clear()
+
+        if remove:
+            self.__wake_up()
 
     def receive(self):
         """
         Implement a non-deterministic receive. If you want you can override
         this method providing other policies.
 
-        This function will sleep if the cycle has not returned a communicator
-        to read from.
-        """
-        temp = self.index
+        A non-blocking receive is always posted on every channel and the
+        function blocks until one of them completes. In order to avoid
+        starvation all the channels having a message ready are served in a
+        round robin fashion, starting from the one following the last served.
 
+        @return a tuple (worker_id, comm, msg) or (-1, None, None) if there
+                are no more channels to listen to
+        """
         while True:
-            self.lock.acquire()
-            tot = len(self.channels)
+            with self.lock:
+                if self.ready:
+                    self.index, worker_id, comm, msg = self.ready.popleft()
+                    return (worker_id, comm, msg)
+
+                if not self.channels:
+                    return (-1, None, None)
+
+                channels = list(self.channels)
+                worker_ids = list(self.worker_ids)
+                requests = [self.wakeup] + self.requests
+
+            # The lock must not be held here otherwise spawn_more and remove
+            # would be blocked until a message arrives.
+            completed, msg = MPI.Request.waitany(requests)
 
-            if tot == 0:
-                self.lock.release()
-                return (-1, None)
+            with self.lock:
+                if completed == 0:
+                    self.wakeup = MPI.COMM_SELF.irecv(source=0, tag=WAKEUP_TAG)
+                    continue
 
-            self.index = (self.index + 1) % tot
-            comm = self.channels[self.index]
+                comm = channels[completed - 1]
 
-            if comm.Iprobe():
-                self.lock.release()
-                return (self.index, comm)
+                if not any(chan is comm for chan in self.channels):
+                    # Removed while waiting: remove() could not drain it
+                    if isinstance(msg, Oversized):
+                        msg = comm.recv(source=0, tag=LARGE_TAG)
 
-            if self.index == temp:
-                self.lock.release()
-                time.sleep(self.interval)
+                    self.__dropped(worker_ids[completed - 1], msg)
+                    continue
+
+                self.__collect(comm, msg)
+
+    def __collect(self, comm, msg):
+        """
+        Sweep all the channels starting from the one following the last served
+        and move every completed receive into the ready queue. Must be called
+        with the lock held.
+        @param comm the channel whose receive completed in waitany
+        @param msg the message received on comm
+        """
+        tot = len(self.channels)
+
+        for step in xrange(1, tot + 1):
+            pos = (self.index + step) % tot
+            chan = self.channels[pos]
+
+            if chan is comm:
+                found, value = True, msg
             else:
-                self.lock.release()
+                found, value = self.requests[pos].test()
+
+            if found:
+                if isinstance(value, Oversized):
+                    # The message follows right after its announcement
+                    value = chan.recv(source=0, tag=LARGE_TAG)
+
+                self.requests[pos] = self.__post(chan)
+                self.ready.append((pos, self.worker_ids[pos], chan, value))
+
+    def __drain(self, request, comm, worker_id):
+        """
+        Complete the receive posted on a channel being removed, cancelling it
+        unless a message has already been received. Must be called with the
+        lock held.
+        @param request the request posted on comm
+        @param comm the channel being removed
+        @param worker_id the ID of the worker at the other side of comm
+        """
+        found, value = request.test()
+
+        if not found:
+            request.Cancel()
+
+            status = MPI.Status()
+            value = request.wait(status)
+            found = not status.Is_cancelled()
+
+        # A request completed by the waitany of receive() gives back None:
+        # its message is handled there
+        if found and value is not None:
+            if isinstance(value, Oversized):
+                value = comm.recv(source=0, tag=LARGE_TAG)
+
+            self.__dropped(worker_id, value)
+
+    def __dropped(self, worker_id, msg):
+        "Log a message received on a channel removed before serving it"
+        self.warning("Dropping message %s of removed worker %d" % \
+                     (str(msg), worker_id))
+
+    def __post(self, comm):
+        "@return a non-blocking receive request posted on comm"
+        return comm.irecv(bytearray(self.bufsize), source=0, tag=0)
+
+    def __position(self, comm):
+        "@return the position of comm inside the channels list"
+        for pos, chan in enumerate(self.channels):
+            if chan is comm:
+                return pos
+
+        raise ValueError("Channel not found")
+
+    def __wake_up(self):
+        """
+        Wake up a receive() call blocked on the current set of requests. The
+        send is non-blocking since the receive matching it is posted again
+        only once the previous wake up has been consumed.
+        """
+        with self.lock:
+            self.wakers = [req for req in self.wakers if not req.Test()]
+            self.wakers.append(MPI.COMM_SELF.isend(None, dest=0,
+                                                   tag=WAKEUP_TAG))
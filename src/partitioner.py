@@ -0,0 +1,209 @@
+"""
+This module holds the definition of the partitioners deciding which reducer
+every key emitted by a StreamingMapper is sent to.
+
+The partitioner is selected through the partitioner key of the
+configuration: hash (default), range or the dotted path of a custom class
+(e.g. mymodule.MyPartitioner) taking the configuration as its only argument.
+
+The range partitioner needs the boundaries between the reducers. They are
+computed by the server before the map phase starts by running the mapper on
+a sample of the inputs. They are sent to every group at registration, which
+hands them to its workers along with their first map, and also stored in the
+file indicated by partition-file.
+"""
+
+import os
+import bisect
+import itertools
+import random
+import marshal
+
+from utils import load_module
+
+MARSHAL_VERSION = 2
+
+class Partitioner(object):
+    """
+    Base class of the partitioners
+    """
+    def __init__(self, conf):
+        """
+        @param conf a dictionary corresponding to the parsed json conf file
+        """
+        self.conf = conf
+        self.num_reducer = int(conf['num-reducer'])
+
+    def partition(self, key):
+        """
+        Must be overridden.
+        @param key the key emitted by the mapper
+        @return the reducer ID the key has to be sent to
+        """
+        raise Exception("Not implemented")
+
+class HashPartitioner(Partitioner):
+    """
+    Spread the keys uniformly among the reducers
+    """
+    def partition(self, key):
+        return hash(key) % self.num_reducer
+
+class RangePartitioner(Partitioner):
+    """
+    Assign contiguous ranges of keys to the reducers. The output of the
+    reducers is therefore globally sorted.
+    """
+    def __init__(self, conf, boundaries=None):
+        """
+        @param conf a dictionary corresponding to the parsed json conf file
+        @param boundaries the sorted list of num-reducer - 1 keys separating
+                          the ranges. If None they have to be assigned to
+                          the boundaries attribute before partitioning
+        """
+        super(RangePartitioner, self).__init__(conf)
+        self.boundaries = boundaries
+
+    def partition(self, key):
+        return bisect.bisect_right(self.boundaries, key)
+
+PARTITIONERS = {
+    'hash': HashPartitioner,
+    'range': RangePartitioner,
+}
+
+def create_partitioner(conf):
+    """
+    Instantiate the partitioner requested in the configuration
+    @param conf the configuration dictionary
+    @return a Partitioner instance
+    """
+    name = conf.get('partitioner', 'hash')
+
+    if name in PARTITIONERS:
+        return PARTITIONERS[name](conf)
+
+    if '.' not in name:
+        raise Exception("Unknown partitioner %s" % name)
+
+    mname, cname = name.rsplit('.', 1)
+    return getattr(load_module(mname), cname)(conf)
+
+def get_partition_file(conf):
+    """
+    @return the path of the file holding the range boundaries. A relative
+            path is resolved under the output directory
+    """
+    return os.path.join(conf['datadir'], conf['output-prefix'],
+                        conf.get('partition-file', 'partitions.bin'))
+
+def read_boundaries(fname):
+    "@return the list of boundaries stored in fname"
+    with open(fname, 'rb') as f:
+        return marshal.load(f)
+
+def write_boundaries(fname, boundaries):
+    "Store the list of boundaries in fname"
+    with open(fname + '.tmp', 'wb') as f:
+        marshal.dump(list(boundaries), f, MARSHAL_VERSION)
+
+    os.rename(fname + '.tmp', fname)
+
+class KeySampler(object):
+    """
+    Keep a uniform sample of a stream of keys through reservoir sampling.
+    Every occurrence counts, so frequent keys weigh more in the boundaries.
+    """
+    def __init__(self, size, rnd=None):
+        """
+        @param size the maximum number of keys kept
+        @param rnd the random.Random instance to use
+        """
+        self.size = size
+        self.rnd = rnd or random.Random()
+        self.seen = 0
+        self.sample = []
+
+    def add(self, key):
+        "Offer a key to the sample"
+        self.seen += 1
+
+        if len(self.sample) < self.size:
+            self.sample.append(key)
+        else:
+            pos = self.rnd.randrange(self.seen)
+
+            if pos < self.size:
+                self.sample[pos] = key
+
+    def boundaries(self, num_reducer):
+        """
+        @return the sorted list of at most num_reducer - 1 keys splitting the
+                sample in ranges holding the same number of occurrences
+        """
+        keys = sorted(self.sample)
+        result = []
+
+        for i in xrange(1, num_reducer):
+            if not keys:
+                break
+
+            key = keys[i * len(keys) / num_reducer]
+
+            # A heavy key cannot be split among several reducers
+            if not result or result[-1] < key:
+                result.append(key)
+
+        return result
+
+def sample_inputs(generator, count):
+    """
+    Extract the inputs to sample. Only the first ones are enumerated, as the
+    generator can be arbitrarily long and the order of the inputs is usually
+    unrelated to the keys they hold.
+    @param generator the generator returned by Input.input()
+    @param count the number of inputs to extract
+    @return a list of (fname, docid) tuples
+    """
+    return list(itertools.islice(generator, count))
+
+def build_boundaries(conf, fconf, logger=None):
+    """
+    Compute the range boundaries by running the map function of the
+    application on a sample of the inputs. The Mapper class of map-module must
+    be a StreamingMapper.
+    @param conf the configuration dictionary
+    @param fconf the path to the configuration file
+    @param logger an optional Logger instance
+    @return the sorted list of boundaries
+    """
+    # Imported here since the mappers depend on this module
+    from mapper import StreamingMapper
+
+    mapper_cls = getattr(load_module(conf['map-module']), 'Mapper')
+
+    if not issubclass(mapper_cls, StreamingMapper):
+        raise Exception("Range partitioning needs a StreamingMapper while " \
+                        "the Mapper of %s is a %s" % \
+                        (conf['map-module'], mapper_cls.__name__))
+
+    rnd = random.Random()
+
+    cls = getattr(load_module(conf['input-module']), 'Input')
+    inputs = sample_inputs(cls(fconf).input(),
+                           int(conf.get('sample-inputs', 16)))
+
+    sampler = KeySampler(int(conf.get('sample-size', 100000)), rnd)
+
+    # The boundaries do not exist yet: the keys are captured before being
+    # partitioned
+    mapper = mapper_cls(dict(conf, partitioner='hash'))
+    mapper.emit = lambda key, value: sampler.add(key)
+
+    for inp in inputs:
+        if logger is not None:
+            logger.info("Sampling keys of %s" % inp[0])
+
+        mapper.map((os.path.join(conf['datadir'], inp[0]), inp[1]))
+
+    return sampler.boundaries(int(conf['num-reducer']))
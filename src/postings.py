@@ -0,0 +1,643 @@
+"""
+This module holds readers and writers for the posting files produced by the
+C mapper and reducer of the ri application, together with the k-way merge
+used by the Python reduce engine.
+
+A posting file is a sequence of posting lists sorted by term. Every list is
+stored as (all integers are native 32 bits unsigned):
+
+    termlen | term | count | count x (docid | occurrences) | '\\n'
+
+The lists are sorted by docid. Posting lists are handled as flat sequences of
+integers [docid, occurrences, docid, occurrences, ..] in order to avoid
+creating a tuple for every posting.
+
+If NumPy is installed the MmapPostingReader can also expose every posting
+list as a structured array (see POSTING_DTYPE) sharing the memory of the
+mapped file.
+
+The compact format stores the same lists in a smaller space. A compact file
+starts with the magic string 'PGC', the format version and the codec used to
+compress the blocks (0 none, 1 zlib). It follows a sequence of blocks, each
+one prefixed by its stored and uncompressed lengths (native 32 bits
+unsigned). Once uncompressed a block holds whole lists encoded as varints:
+
+    termlen | term | count | count x (docid delta | occurrences)
+
+The docid deltas are relative to the previous docid of the list, the first
+one to 0. Readers detect the format of a file by its first bytes, so raw and
+compact files can be merged together.
+"""
+
+import os
+import mmap
+import zlib
+import heapq
+import struct
+
+from array import array
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+
+    # A posting as written by the C indexer
+    POSTING_DTYPE = numpy.dtype([('docid', '=u4'), ('occurrences', '=u4')])
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+UINT = struct.Struct('=I')
+TERM_SEPARATOR = '\n'
+
+COMPACT_MAGIC = 'PGC'
+COMPACT_VERSION = 1
+COMPACT_HEADER = struct.Struct('=3sBB')
+BLOCK_HEADER = struct.Struct('=II')
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+CODECS = {
+    'none': CODEC_NONE,
+    'zlib': CODEC_ZLIB,
+}
+
+class PostingReader(object):
+    """
+    Iterate over the (term, postings) lists of a file. The file is read in
+    large chunks which are parsed in place.
+    """
+    def __init__(self, fname, bufsize=4194304):
+        """
+        @param fname the path to the posting file
+        @param bufsize the number of bytes read from the file at once
+        """
+        self.fname = fname
+        self.file = open(fname, 'rb')
+        self.bufsize = bufsize
+
+        self.buffer = ''
+        self.pos = 0
+
+    def __ensure(self, size):
+        """
+        Make at least size bytes available starting from self.pos
+        @return False if the end of file was reached before
+        """
+        if len(self.buffer) - self.pos >= size:
+            return True
+
+        self.buffer = self.buffer[self.pos:] + \
+                      self.file.read(max(self.bufsize, size))
+        self.pos = 0
+
+        return len(self.buffer) >= size
+
+    def __iter__(self):
+        unpack_from = UINT.unpack_from
+
+        while self.__ensure(UINT.size):
+            termlen, = unpack_from(self.buffer, self.pos)
+
+            if not self.__ensure(UINT.size + termlen + UINT.size):
+                raise Exception("Truncated posting file %s" % self.fname)
+
+            start = self.pos + UINT.size
+            term = self.buffer[start:start + termlen]
+            count, = unpack_from(self.buffer, start + termlen)
+
+            size = 2 * count * UINT.size
+            header = UINT.size + termlen + UINT.size
+
+            if not self.__ensure(header + size + 1):
+                raise Exception("Truncated posting file %s" % self.fname)
+
+            start = self.pos + header
+            postings = array('I')
+            postings.fromstring(self.buffer[start:start + size])
+
+            if self.buffer[start + size] != TERM_SEPARATOR:
+                raise Exception("Bogus delimiter in %s" % self.fname)
+
+            self.pos = start + size + 1
+
+            yield term, postings
+
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+class MmapPostingReader(object):
+    """
+    Read a posting file through mmap. Terms are located without copying the
+    posting lists, which are either copied into flat arrays on demand or
+    exposed as NumPy structured arrays sharing the memory of the file. Views
+    must not be used after close() is called.
+    """
+    def __init__(self, fname, views=False):
+        """
+        @param fname the path to the posting file
+        @param views True to iterate over NumPy structured arrays instead of
+                     flat arrays of integers
+        """
+        if views and not NUMPY_AVAILABLE:
+            raise Exception("You need to install numpy in order to use " \
+                            "structured views over the posting lists")
+
+        if is_compact(fname):
+            raise Exception("%s is a compact posting file and cannot be " \
+                            "mapped" % fname)
+
+        self.fname = fname
+        self.views = views
+        self.file = open(fname, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        # Empty files cannot be mapped
+        self.map = None
+
+        if self.size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+    def terms(self):
+        """
+        Iterate over the posting lists without reading them
+        @return a generator of (term, offset, count) tuples where offset is
+                the position in the file of the first posting and count the
+                number of postings of the term
+        """
+        data, size = self.map, self.size
+        unpack_from = UINT.unpack_from
+        pos = 0
+
+        while pos < size:
+            if pos + UINT.size > size:
+                raise Exception("Truncated posting file %s" % self.fname)
+
+            termlen, = unpack_from(data, pos)
+            start = pos + UINT.size
+
+            if start + termlen + UINT.size > size:
+                raise Exception("Truncated posting file %s" % self.fname)
+
+            term = data[start:start + termlen]
+            count, = unpack_from(data, start + termlen)
+
+            offset = start + termlen + UINT.size
+            pos = offset + 2 * count * UINT.size
+
+            if pos >= size or data[pos] != TERM_SEPARATOR:
+                raise Exception("Bogus delimiter in %s" % self.fname)
+
+            pos += 1
+
+            yield term, offset, count
+
+    def postings(self, offset, count):
+        "@return a flat array [docid, occurrences, ..] copied from the file"
+        postings = array('I')
+        postings.fromstring(self.map[offset:offset + 2 * count * UINT.size])
+        return postings
+
+    def view(self, offset, count):
+        "@return a POSTING_DTYPE array sharing the memory of the file"
+        if count == 0:
+            return numpy.empty(0, POSTING_DTYPE)
+
+        return numpy.frombuffer(self.map, POSTING_DTYPE, count, offset)
+
+    def __iter__(self):
+        get = self.view if self.views else self.postings
+
+        for term, offset, count in self.terms():
+            yield term, get(offset, count)
+
+    def validate(self):
+        """
+        Check that terms are sorted and that every posting list is sorted by
+        docid without duplicates
+        @return a list of strings describing the errors found
+        """
+        errors = []
+        last = None
+
+        for term, offset, count in self.terms():
+            if last is not None and term <= last:
+                errors.append("Term %r follows %r" % (term, last))
+
+            last = term
+
+            if NUMPY_AVAILABLE:
+                docids = self.view(offset, count)['docid']
+                ordered = bool((docids[1:] > docids[:-1]).all())
+            else:
+                docids = self.postings(offset, count)[::2]
+                ordered = all(a < b for a, b in zip(docids, docids[1:]))
+
+            if not ordered:
+                errors.append("Postings of %r are not sorted" % term)
+
+        return errors
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+        self.file.close()
+
+class PostingWriter(object):
+    """
+    Write (term, postings) lists to a file object
+    """
+    def __init__(self, file):
+        """
+        @param file a file object opened for writing
+        """
+        self.file = file
+        self.terms = 0
+        self.postings = 0
+        self.offset = 0
+
+    def write(self, term, postings):
+        """
+        Append a posting list. Lists must be written sorted by term
+        @param term a str
+        @param postings a flat sequence [docid, occurrences, ..] sorted by
+                        docid
+        @return the offset of the list in the file
+        """
+        if not isinstance(postings, array):
+            postings = array('I', postings)
+
+        count = len(postings) / 2
+        data = UINT.pack(len(term)) + term + UINT.pack(count) + \
+               postings.tostring() + TERM_SEPARATOR
+
+        self.file.write(data)
+
+        offset = self.offset
+        self.offset += len(data)
+
+        self.terms += 1
+        self.postings += count
+
+        return offset
+
+    def close(self):
+        self.file.close()
+
+def encode_varint(buf, value):
+    "Append value to the bytearray buf as a varint"
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buf.append(value)
+
+def decode_varint(data, pos):
+    """
+    @param data a bytearray
+    @param pos the position of the varint in data
+    @return a (value, position after the varint) tuple
+    """
+    value = shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return value, pos
+
+        shift += 7
+
+class CompactPostingWriter(object):
+    """
+    Write (term, postings) lists to a file object in the compact format.
+    close() must be called in order to flush the last block.
+    """
+    def __init__(self, file, codec='zlib', block_size=65536, level=6):
+        """
+        @param file a file object opened for writing
+        @param codec the name of the codec used to compress the blocks
+        @param block_size the approximate number of uncompressed bytes of a
+                          block
+        @param level the zlib compression level
+        """
+        if codec not in CODECS:
+            raise Exception("Unknown posting codec %s" % codec)
+
+        self.file = file
+        self.codec = CODECS[codec]
+        self.block_size = block_size
+        self.level = level
+
+        self.block = bytearray()
+        self.terms = 0
+        self.postings = 0
+
+        self.file.write(COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION,
+                                            self.codec))
+
+        # Offset of the block being filled
+        self.offset = COMPACT_HEADER.size
+
+    def write(self, term, postings):
+        """
+        Append a posting list. Lists must be written sorted by term
+        @param term a str
+        @param postings a flat sequence [docid, occurrences, ..] sorted by
+                        docid
+        @return the offset of the block holding the list
+        """
+        buf = self.block
+        offset = self.offset
+        count = len(postings) / 2
+
+        encode_varint(buf, len(term))
+        buf.extend(term)
+        encode_varint(buf, count)
+
+        last = 0
+
+        for i in xrange(0, len(postings), 2):
+            docid, occ = postings[i], postings[i + 1]
+            delta = docid - last
+            last = docid
+
+            # Most of the values fit in a single byte
+            if delta < 0x80:
+                buf.append(delta)
+            else:
+                encode_varint(buf, delta)
+
+            if occ < 0x80:
+                buf.append(occ)
+            else:
+                encode_varint(buf, occ)
+
+        self.terms += 1
+        self.postings += count
+
+        if len(buf) >= self.block_size:
+            self.flush()
+
+        return offset
+
+    def flush(self):
+        "Write the current block to the file"
+        if not self.block:
+            return
+
+        data = str(self.block)
+
+        if self.codec == CODEC_ZLIB:
+            data = zlib.compress(data, self.level)
+
+        self.file.write(BLOCK_HEADER.pack(len(data), len(self.block)) + data)
+        self.offset += BLOCK_HEADER.size + len(data)
+        self.block = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class CompactPostingReader(object):
+    """
+    Iterate over the (term, postings) lists of a compact file. Blocks are
+    read and decoded one at a time.
+    """
+    def __init__(self, fname, bufsize=4194304):
+        """
+        @param fname the path to the posting file
+        @param bufsize the size of the read buffer in bytes
+        """
+        self.fname = fname
+        self.file = open(fname, 'rb', bufsize)
+
+        header = self.file.read(COMPACT_HEADER.size)
+
+        if len(header) < COMPACT_HEADER.size:
+            raise Exception("Truncated posting file %s" % fname)
+
+        magic, version, self.codec = COMPACT_HEADER.unpack(header)
+
+        if magic != COMPACT_MAGIC:
+            raise Exception("%s is not a compact posting file" % fname)
+
+        if version > COMPACT_VERSION:
+            raise Exception("Unsupported version %d of posting file %s" % \
+                            (version, fname))
+
+        if self.codec not in CODECS.values():
+            raise Exception("Unknown codec %d in posting file %s" % \
+                            (self.codec, fname))
+
+    def read_block(self):
+        """
+        Read the block starting at the current position of the file
+        @return the uncompressed block as a bytearray or None at the end of
+                the file
+        """
+        header = self.file.read(BLOCK_HEADER.size)
+
+        if not header:
+            return None
+
+        if len(header) < BLOCK_HEADER.size:
+            raise Exception("Truncated posting file %s" % self.fname)
+
+        stored, length = BLOCK_HEADER.unpack(header)
+        data = self.file.read(stored)
+
+        if len(data) < stored:
+            raise Exception("Truncated posting file %s" % self.fname)
+
+        if self.codec == CODEC_ZLIB:
+            data = zlib.decompress(data)
+
+        if len(data) != length:
+            raise Exception("Corrupted block in %s" % self.fname)
+
+        return bytearray(data)
+
+    def block_at(self, offset):
+        "@return the uncompressed block starting at offset"
+        self.file.seek(offset)
+        return self.read_block()
+
+    def blocks(self):
+        "@return a generator of (offset, uncompressed block) tuples"
+        while True:
+            offset = self.file.tell()
+            data = self.read_block()
+
+            if data is None:
+                break
+
+            yield offset, data
+
+    def __iter__(self):
+        for offset, data in self.blocks():
+            for term in decode_block(data):
+                yield term
+
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+def decode_block(data):
+    """
+    @param data an uncompressed block of a compact file
+    @return a generator of the (term, postings) lists of the block
+    """
+    pos, size = 0, len(data)
+
+    while pos < size:
+        termlen, pos = decode_varint(data, pos)
+        term = str(data[pos:pos + termlen])
+        count, pos = decode_varint(data, pos + termlen)
+
+        postings = array('I')
+        append = postings.append
+        last = 0
+
+        for _ in xrange(count):
+            byte = data[pos]
+
+            if byte < 0x80:
+                pos += 1
+            else:
+                byte, pos = decode_varint(data, pos)
+
+            last += byte
+            append(last)
+
+            byte = data[pos]
+
+            if byte < 0x80:
+                pos += 1
+            else:
+                byte, pos = decode_varint(data, pos)
+
+            append(byte)
+
+        yield term, postings
+
+def is_compact(fname):
+    "@return True if fname is stored in the compact format"
+    with open(fname, 'rb') as f:
+        return f.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+
+def open_posting_reader(fname, bufsize=4194304):
+    """
+    @param fname the path to a posting file in either format
+    @param bufsize the size of the read buffer in bytes
+    @return a reader yielding the (term, postings) lists of fname
+    """
+    if is_compact(fname):
+        return CompactPostingReader(fname, bufsize)
+
+    return PostingReader(fname, bufsize)
+
+def create_posting_writer(file, conf):
+    """
+    Instantiate the writer of the format requested in the configuration
+    @param file a file object opened for writing
+    @param conf the configuration dictionary
+    @return a PostingWriter or a CompactPostingWriter
+    """
+    fmt = conf.get('posting-format', 'raw')
+
+    if fmt == 'raw':
+        return PostingWriter(file)
+
+    if fmt == 'compact':
+        return CompactPostingWriter(
+            file, conf.get('posting-codec', 'zlib'),
+            int(conf.get('posting-block-size', 65536)))
+
+    raise Exception("Unknown posting format %s" % fmt)
+
+def merge_lists(lists):
+    """
+    Merge several posting lists of the same term. Occurrences of the same
+    docid are summed.
+    @param lists a list of flat posting lists sorted by docid
+    @return a flat posting list sorted by docid
+    """
+    lists = [lst for lst in lists if lst]
+
+    if len(lists) == 1:
+        return lists[0]
+
+    # Maps work on disjoint ranges of documents: in the common case the
+    # lists do not overlap and can just be concatenated
+    lists.sort(key=lambda lst: lst[0])
+
+    result = array('I')
+    last = -1
+
+    for lst in lists:
+        if lst[0] <= last:
+            break
+
+        result.extend(lst)
+        last = lst[-2]
+    else:
+        return result
+
+    result = array('I')
+    pairs = [zip(lst[::2], lst[1::2]) for lst in lists]
+
+    for docid, occ in heapq.merge(*pairs):
+        if result and result[-2] == docid:
+            result[-1] += occ
+        else:
+            result.append(docid)
+            result.append(occ)
+
+    return result
+
+def merge_postings(readers):
+    """
+    Heap based k-way merge of posting files. Every term costs O(log k) heap
+    operations for every file holding it, regardless of the number of files.
+    @param readers a list of iterables yielding (term, postings) sorted by
+                   term
+    @return a generator of (term, postings) sorted by term. Terms without
+            postings are skipped
+    """
+    heap = []
+
+    for idx, reader in enumerate(readers):
+        it = iter(reader)
+
+        for term, postings in it:
+            heap.append((term, idx, postings, it))
+            break
+
+    heapq.heapify(heap)
+
+    while heap:
+        term, idx, postings, it = heap[0]
+        lists = []
+
+        while heap and heap[0][0] == term:
+            _, idx, postings, it = heap[0]
+            lists.append(postings)
+
+            for nterm, npostings in it:
+                heapq.heapreplace(heap, (nterm, idx, npostings, it))
+                break
+            else:
+                heapq.heappop(heap)
+
+        postings = merge_lists(lists)
+
+        if postings:
+            yield term, postings
@@ -0,0 +1,141 @@
+"""
+This module holds the query engine used to serve the final outputs of the
+ri application through the web interface of the server (see the /query
+handler in server.py).
+
+Every final file has a term dictionary (see index.py). Since the C mapper
+partitions the postings by document, the list of a term is the union of its
+lists in all the files. Decoded lists are kept in a LRU cache and documents
+are ranked with TF-IDF.
+"""
+
+import math
+import heapq
+
+from collections import OrderedDict
+from index import InvertedIndex
+from postings import merge_lists
+
+class LRUCache(object):
+    """
+    A dictionary holding at most size items. The least recently used item
+    is evicted first.
+    """
+    def __init__(self, size):
+        """
+        @param size the maximum number of items
+        """
+        self.size = size
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+def top_k(scores, k):
+    """
+    Select the k highest scores through a heap bounded to k items
+    @param scores a dictionary docid => score
+    @param k the number of results
+    @return a list of (docid, score) tuples sorted by decreasing score
+    """
+    heap = []
+
+    for docid, score in scores.iteritems():
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -docid))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -docid))
+
+    heap.sort(reverse=True)
+    return [(-docid, score) for score, docid in heap]
+
+class QueryEngine(object):
+    """
+    Answer TF-IDF ranked queries over a set of posting files
+    """
+    def __init__(self, fnames, cache_size=1024, documents=0):
+        """
+        @param fnames the list of posting files having a dictionary
+        @param cache_size the maximum number of posting lists cached
+        @param documents the number of documents of the collection. If 0 it
+                         is estimated through the greatest docid
+        """
+        self.indexes = [InvertedIndex(fname) for fname in fnames]
+        self.cache = LRUCache(cache_size)
+        self.documents = documents
+
+        if not self.documents:
+            self.documents = max([index.documents()
+                                  for index in self.indexes] or [0])
+
+    def postings(self, term):
+        "@return the flat posting list of term merged over all the files"
+        postings = self.cache.get(term)
+
+        if postings is None:
+            postings = merge_lists([index.lookup(term)
+                                    for index in self.indexes])
+            self.cache.put(term, postings)
+
+        return postings
+
+    def search(self, terms, k=10, conjunctive=False):
+        """
+        Rank the documents holding the terms
+        @param terms a list of str
+        @param k the maximum number of results
+        @param conjunctive if True only documents holding all the terms are
+                           returned
+        @return a list of (docid, score) tuples sorted by decreasing score
+        """
+        terms = list(OrderedDict.fromkeys(terms))
+        scores = {}
+        matches = {}
+
+        for term in terms:
+            postings = self.postings(term)
+            df = len(postings) / 2
+
+            if df == 0:
+                if conjunctive:
+                    return []
+                continue
+
+            idf = math.log(float(max(self.documents, df)) / df) + 1
+
+            for i in xrange(0, len(postings), 2):
+                docid = postings[i]
+                scores[docid] = scores.get(docid, 0) + \
+                                (1 + math.log(postings[i + 1])) * idf
+                matches[docid] = matches.get(docid, 0) + 1
+
+        if conjunctive:
+            scores = dict((docid, score) for docid, score in scores.iteritems()
+                          if matches[docid] == len(terms))
+
+        return top_k(scores, k)
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
@@ -0,0 +1,65 @@
+"""
+This module holds the definition of the file format used by the streaming
+mappers and reducers to exchange intermediate results.
+
+A record file is a sequence of records sorted by key. Every record is made
+of a 4 bytes big endian length followed by the marshalled tuple
+(key, [value, ...]) grouping all the values of a key. Keys and values can be
+any object supported by the marshal module.
+"""
+
+import struct
+import marshal
+
+RECORD_HEADER = struct.Struct('!I')
+MARSHAL_VERSION = 2
+
+class RecordWriter(object):
+    """
+    Write (key, values) records to a file object
+    """
+    def __init__(self, file):
+        """
+        @param file a file object opened for writing
+        """
+        self.file = file
+        self.records = 0
+
+    def write(self, key, values):
+        """
+        Append a record to the file. Records must be written sorted by key
+        @param key the key of the record
+        @param values a list of values
+        """
+        payload = marshal.dumps((key, values), MARSHAL_VERSION)
+        self.file.write(RECORD_HEADER.pack(len(payload)) + payload)
+        self.records += 1
+
+class RecordReader(object):
+    """
+    Iterate over the (key, values) records of a file
+    """
+    def __init__(self, fname, bufsize=1048576):
+        """
+        @param fname the path to the file
+        @param bufsize the size of the read buffer in bytes
+        """
+        self.file = open(fname, 'rb', bufsize)
+
+    def __iter__(self):
+        read = self.file.read
+        size = RECORD_HEADER.size
+
+        while True:
+            header = read(size)
+
+            if len(header) < size:
+                break
+
+            length, = RECORD_HEADER.unpack(header)
+            yield marshal.loads(read(length))
+
+        self.file.close()
+
+    def close(self):
+        self.file.close()
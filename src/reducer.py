@@ -4,8 +4,20 @@ executing the reduce function both on the results of the mappers and on the
 results of the reducer. Therefore it should be able to re-reduce output files
 """
 
+import os
+import time
+import heapq
 import os.path
-from utils import Logger
+
+from operator import itemgetter
+from itertools import groupby
+from records import RecordReader, RecordWriter
+from postings import open_posting_reader, create_posting_writer, \
+                     merge_postings
+from index import IndexWriter, build_index, get_index_name
+from scoring import TfIdfScorer, global_frequencies, idf_weights, \
+                    save_frequencies, load_frequencies
+from utils import Logger, create_file, get_id, get_file_name
 
 class Reducer(Logger):
     def __init__(self, conf, name="Reducer"):
@@ -59,3 +71,216 @@ class Reducer(Logger):
         @return a tuple
         """
         raise Exception("Not implemented")
+
+class StreamingReducer(Reducer):
+    """
+    A Reducer executing the reduce function directly inside the worker
+    process over the record files produced by a StreamingMapper. The inputs
+    are merged by key and reduce() is called once for every key with all its
+    values. The values emitted are written in a record file having the same
+    format, therefore reduce() must be able to re-reduce its own outputs.
+    """
+    def __init__(self, conf, name="StreamingReducer"):
+        super(StreamingReducer, self).__init__(conf, name)
+
+        self.values = None
+
+    def reduce(self, key, values):
+        """
+        This method must be overriden. It is called once for every key in
+        sorted order and it is expected to call emit() for every value
+        produced.
+        @param key the key
+        @param values the list of all the values of the key
+        """
+        raise Exception("Not implemented")
+
+    def emit(self, value):
+        """
+        Produce an output value for the key being reduced
+        @param value the value. It must be an object supported by marshal
+        """
+        self.values.append(value)
+
+    def execute(self, result):
+        reduce_idx, fids = result
+        start = time.time()
+
+        self.vfs.pull_remote_files(reduce_idx, fids)
+
+        readers = [
+            self.__tag(i, RecordReader(
+                get_file_name(self.output_path, reduce_idx, fid)))
+            for i, fid in enumerate(fids)
+        ]
+
+        handle = create_file(self.output_path, reduce_idx,
+                             self.vfs.master_id, self.vfs.worker_id)
+        writer = RecordWriter(handle)
+
+        for key, group in groupby(heapq.merge(*readers), itemgetter(0)):
+            self.values = []
+
+            values = []
+            for _, _, vals in group:
+                values.extend(vals)
+
+            self.reduce(key, values)
+
+            if self.values:
+                writer.write(key, self.values)
+
+        handle.close()
+
+        fname = handle.name
+        fsize = os.path.getsize(fname)
+
+        self.vfs.push_local_file(os.path.basename(fname), True)
+        self.info("Reduce finished. %d records written to %s" % \
+                  (writer.records, fname))
+
+        return ((fsize, time.time() - start), [(get_id(fname), fsize)] + fids)
+
+    def __tag(self, idx, reader):
+        """
+        Decorate the records with the position of the reader in order to
+        never compare the values while merging
+        """
+        for key, values in reader:
+            yield (key, idx, values)
+
+class PostingReducer(Reducer):
+    """
+    A Reducer merging the posting files of the ri application directly
+    inside the worker process (see postings.py). The inputs are merged with a
+    heap, therefore the cost of every posting list grows logarithmically with
+    the number of files being merged.
+    """
+    def __init__(self, conf, name="PostingReducer"):
+        super(PostingReducer, self).__init__(conf, name)
+
+        self.bufsize = int(self.conf.get('reduce-buffer-size', 4194304))
+        self.write_index = bool(self.conf.get('posting-index', False))
+        self.batch_size = int(self.conf.get('tfidf-batch-size', 1048576))
+
+    def execute(self, result):
+        # Tasks of the scoring stage carry a third item: the list of the
+        # final files for the one computing the document frequencies, which
+        # has no input, or the ID of the frequencies file for the others
+        if len(result) > 2 and not result[1]:
+            return self.frequencies(*result)
+        elif len(result) > 2:
+            return self.score(*result)
+
+        reduce_idx, fids = result
+        start = time.time()
+
+        self.vfs.pull_remote_files(reduce_idx, fids)
+
+        readers = [
+            open_posting_reader(get_file_name(self.output_path, reduce_idx,
+                                              fid), self.bufsize)
+            for fid in fids
+        ]
+
+        handle = create_file(self.output_path, reduce_idx,
+                             self.vfs.master_id, self.vfs.worker_id)
+        writer = create_posting_writer(handle, self.conf)
+
+        if self.write_index:
+            index = IndexWriter(handle.name,
+                                self.conf.get('posting-format', 'raw'),
+                                int(self.conf.get('skip-interval', 128)))
+
+            for term, postings in merge_postings(readers):
+                index.add(term, writer.write(term, postings), postings)
+
+            index.close()
+        else:
+            for term, postings in merge_postings(readers):
+                writer.write(term, postings)
+
+        writer.close()
+
+        fname = handle.name
+        fsize = os.path.getsize(fname)
+
+        self.vfs.push_local_file(os.path.basename(fname), True)
+
+        if self.write_index:
+            self.vfs.push_local_file(os.path.basename(index.index_name), True)
+        self.info("Reduce finished. %d terms, %d postings written to %s" % \
+                  (writer.terms, writer.postings, fname))
+
+        return ((fsize, time.time() - start), [(get_id(fname), fsize)] + fids)
+
+    def frequencies(self, reduce_idx, fids, files):
+        """
+        Write the frequencies file used by the scoring tasks (see scoring.py)
+        @param reduce_idx the reducer ID the file is named after
+        @param fids an empty list
+        @param files the list of (reduce_idx, fid) tuples of all the final
+                     files, used to compute the document frequencies
+        """
+        start = time.time()
+        fnames = []
+
+        for ridx, fid in files:
+            fname = get_file_name(self.output_path, ridx, fid)
+
+            # Outputs of the C reducer have no dictionary
+            if not os.path.exists(get_index_name(fname)):
+                self.vfs.pull_remote_files(ridx, [fid])
+                build_index(fname)
+
+            fnames.append(fname)
+
+        terms, df, documents = global_frequencies(fnames)
+
+        handle = create_file(self.output_path, reduce_idx,
+                             self.vfs.master_id, self.vfs.worker_id,
+                             prefix="frequencies")
+        save_frequencies(handle, terms, df, documents)
+        handle.close()
+
+        fsize = os.path.getsize(handle.name)
+
+        self.vfs.push_local_file(os.path.basename(handle.name), True)
+        self.info("Document frequencies of %d terms written to %s" % \
+                  (len(terms), handle.name))
+
+        return ((fsize, time.time() - start), [(get_id(handle.name), fsize)])
+
+    def score(self, reduce_idx, fids, frequencies):
+        """
+        Write the TF-IDF scored version of a final file (see scoring.py)
+        @param reduce_idx the reducer ID
+        @param fids a list holding the ID of the final file
+        @param frequencies the ID of the frequencies file
+        """
+        start = time.time()
+
+        self.vfs.pull_remote_files(reduce_idx, fids)
+        self.vfs.pull_remote_files(0, [frequencies], "frequencies")
+
+        terms, df, documents = load_frequencies(
+            get_file_name(self.output_path, 0, frequencies, "frequencies"))
+        documents = int(self.conf.get('query-documents', 0)) or documents
+
+        scorer = TfIdfScorer(terms, idf_weights(df, documents),
+                             self.batch_size, self.bufsize)
+
+        fname = get_file_name(self.output_path, reduce_idx, fids[0])
+        handle = create_file(self.output_path, reduce_idx,
+                             self.vfs.master_id, self.vfs.worker_id,
+                             prefix="scored")
+
+        nterms, npostings = scorer.score(fname, handle)
+        handle.close()
+
+        self.vfs.push_local_file(os.path.basename(handle.name), True)
+        self.info("Scoring finished. %d terms, %d postings written to %s" % \
+                  (nterms, npostings, handle.name))
+
+        return ((os.path.getsize(fname), time.time() - start),
+                [(get_id(handle.name), os.path.getsize(handle.name))] + fids)
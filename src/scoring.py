@@ -0,0 +1,294 @@
+"""
+This module holds the TF-IDF scoring stage executed after the merge phase
+when tfidf-scoring is enabled. Every final file is scored by a reduce task
+assigned by the server through a ScorePlan, like the merges of the merge
+phase.
+
+The document frequencies are global: a first task sums the counts stored in
+the dictionaries of all the final files (see index.py) and writes them to a
+frequencies file ("frequencies-r..-p..") loaded by every scoring task. The
+postings of the final file are then read in batches converted to NumPy
+arrays, twice: the first pass computes the norm of every document, the
+second writes the normalized weights
+
+    weight = (1 + log(occurrences)) * idf / norm(document)
+    idf = log(documents / df) + 1
+
+to a scored file ("scored-r..-p..") which has the layout of a raw posting
+file where the occurrences are replaced by float32 weights:
+
+    termlen | term | count | count x (docid | weight) | '\\n'
+
+The norms are computed over the documents held by the file. This is exact
+as long as the postings are partitioned by document, like the C mapper does.
+"""
+
+from postings import UINT, TERM_SEPARATOR, open_posting_reader
+from index import InvertedIndex
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+
+    # A posting of a scored file
+    SCORED_DTYPE = numpy.dtype([('docid', '=u4'), ('weight', '=f4')])
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# The fid of the task computing the document frequencies
+FREQUENCIES = None
+
+class ScorePlan(object):
+    """
+    Plan of the scoring stage: a first task computing the document
+    frequencies and then a task for every final file
+    """
+    def __init__(self, files):
+        """
+        @param files the list of final (reduce_idx, fid) tuples
+        """
+        self.files = list(files)
+        self.ready = [(0, FREQUENCIES)] if self.files else []
+
+        # nick => [(reduce_idx, fid), ..]
+        self.pending = {}
+
+        # (fid, fsize) of the frequencies file once computed
+        self.frequencies = None
+
+        # reduce_idx => (fid, fsize) of the scored file
+        self.completed = {}
+
+    def assign(self, nick, count=1):
+        """
+        Extract up to count scoring tasks for a group
+        @param nick the nick of the group
+        @param count the maximum number of tasks to assign
+        @return a list of (reduce_idx, fid) tuples where fid is FREQUENCIES
+                for the task computing the document frequencies
+        """
+        tasks, self.ready = self.ready[:count], self.ready[count:]
+
+        if tasks:
+            self.pending.setdefault(nick, []).extend(tasks)
+
+        return tasks
+
+    def complete(self, nick, reduce_idx, output):
+        """
+        Mark a scoring task as completed
+        @param nick the nick of the group
+        @param reduce_idx the reducer ID
+        @param output the (fid, fsize) tuple of the scored file
+        @return False if there is no such task pending for the group
+        """
+        tasks = self.pending.get(nick, [])
+
+        for pos, (ridx, fid) in enumerate(tasks):
+            if ridx == reduce_idx:
+                del tasks[pos]
+
+                if not tasks:
+                    del self.pending[nick]
+
+                if fid is FREQUENCIES:
+                    # Every final file can be scored from now on
+                    self.frequencies = tuple(output)
+                    self.ready.extend(self.files)
+                else:
+                    self.completed[reduce_idx] = tuple(output)
+
+                return True
+
+        return False
+
+    def remove_group(self, nick):
+        """
+        Put back the tasks assigned to a dead group
+        @param nick the nick of the group
+        @return the number of tasks recovered
+        """
+        tasks = self.pending.pop(nick, [])
+        self.ready.extend(tasks)
+        return len(tasks)
+
+    def finished(self):
+        "@return True if every final file has been scored"
+        return not self.ready and not self.pending
+
+def global_frequencies(fnames):
+    """
+    Sum the document frequencies stored in the dictionaries of the final
+    files
+    @param fnames the paths to the final files
+    @return a (terms, df, documents) tuple where terms is the sorted array of
+            the terms, df the array of their frequencies and documents the
+            greatest docid plus one
+    """
+    if not NUMPY_AVAILABLE:
+        raise Exception("You need to install numpy in order to use the " \
+                        "TF-IDF scoring stage")
+
+    terms, counts = [], []
+    documents = 0
+
+    for fname in fnames:
+        index = InvertedIndex(fname)
+        fterms, fcounts = index.dictionary()
+
+        terms.extend(fterms)
+        counts.extend(fcounts)
+        documents = max(documents, index.documents())
+
+        index.close()
+
+    terms, inverse = numpy.unique(numpy.array(terms, dtype=str),
+                                  return_inverse=True)
+    df = numpy.bincount(inverse, weights=numpy.array(counts, numpy.float64))
+
+    return terms, df, documents
+
+def save_frequencies(output, terms, df, documents):
+    """
+    Write the result of global_frequencies to a frequencies file
+    @param output a file object opened for writing
+    """
+    numpy.savez(output, terms=terms, df=df,
+                documents=numpy.array([documents], numpy.int64))
+
+def load_frequencies(fname):
+    """
+    Read a frequencies file written by save_frequencies
+    @param fname the path to the file
+    @return a (terms, df, documents) tuple like global_frequencies
+    """
+    if not NUMPY_AVAILABLE:
+        raise Exception("You need to install numpy in order to use the " \
+                        "TF-IDF scoring stage")
+
+    data = numpy.load(fname)
+
+    try:
+        return data['terms'], data['df'], int(data['documents'][0])
+    finally:
+        data.close()
+
+def idf_weights(df, documents):
+    "@return the array of the idf of terms having the frequencies df"
+    df = numpy.maximum(df, 1)
+    return numpy.log(numpy.maximum(documents, df) / df) + 1
+
+class TfIdfScorer(object):
+    """
+    Score the posting lists of a file in vectorized batches
+    """
+    def __init__(self, terms, idf, batch_size=1048576, bufsize=4194304):
+        """
+        @param terms the sorted array of the terms of the collection
+        @param idf the array of their idf
+        @param batch_size the approximate number of postings of a batch
+        @param bufsize the number of bytes read from the file at once
+        """
+        if not NUMPY_AVAILABLE:
+            raise Exception("You need to install numpy in order to use the " \
+                            "TF-IDF scoring stage")
+
+        self.terms = terms
+        self.idf = idf
+        self.batch_size = batch_size
+        self.bufsize = bufsize
+
+    def __batches(self, fname):
+        """
+        @return a generator of (terms, counts, docids, weights) tuples where
+                the weights are not normalized yet
+        """
+        names, counts, lists = [], [], []
+        size = 0
+
+        for term, postings in open_posting_reader(fname, self.bufsize):
+            names.append(term)
+            counts.append(len(postings) / 2)
+            lists.append(postings.tostring())
+            size += len(postings) / 2
+
+            if size >= self.batch_size:
+                yield self.__weights(names, counts, lists)
+                names, counts, lists = [], [], []
+                size = 0
+
+        if names:
+            yield self.__weights(names, counts, lists)
+
+    def __weights(self, names, counts, lists):
+        data = ''.join(lists)
+
+        # Lists of the C reducer may be empty
+        if data:
+            postings = numpy.frombuffer(data, numpy.uint32)
+        else:
+            postings = numpy.zeros(0, numpy.uint32)
+
+        docids, tf = postings[0::2], postings[1::2]
+
+        idf = self.idf[numpy.searchsorted(self.terms,
+                                          numpy.array(names, dtype=str))]
+        weights = (1 + numpy.log(numpy.maximum(tf, 1))) * \
+                  numpy.repeat(idf, counts)
+
+        return names, counts, docids, weights
+
+    def norms(self, fname):
+        """
+        @return a (docids, norms) tuple of arrays sorted by docid
+        """
+        # Running sums of the squared weights indexed by docid. Every batch
+        # only costs its own postings plus the growth of the array
+        sums = numpy.zeros(0, numpy.float64)
+
+        for _, _, docids, weights in self.__batches(fname):
+            if not len(docids):
+                continue
+
+            batch = numpy.bincount(docids, weights * weights)
+
+            # Grow geometrically in order to copy the sums a few times only
+            if len(batch) > len(sums):
+                grown = numpy.zeros(max(len(batch), 2 * len(sums)),
+                                    numpy.float64)
+                grown[:len(sums)] = sums
+                sums = grown
+
+            sums[:len(batch)] += batch
+
+        # Weights are positive: every document of the file has a sum
+        docids = numpy.flatnonzero(sums).astype(numpy.uint32)
+        return docids, numpy.sqrt(sums[docids])
+
+    def score(self, fname, output):
+        """
+        Write the scored lists of a file
+        @param fname the path to the posting file
+        @param output a file object opened for writing
+        @return a (terms, postings) tuple with the number of items written
+        """
+        docs, norms = self.norms(fname)
+        nterms = npostings = 0
+
+        for names, counts, docids, weights in self.__batches(fname):
+            scored = numpy.empty(len(docids), SCORED_DTYPE)
+            scored['docid'] = docids
+            scored['weight'] = weights / norms[numpy.searchsorted(docs, docids)]
+
+            pos = 0
+
+            for term, count in zip(names, counts):
+                output.write(UINT.pack(len(term)) + term + UINT.pack(count) +
+                             scored[pos:pos + count].tostring() +
+                             TERM_SEPARATOR)
+                pos += count
+
+            nterms += len(names)
+            npostings += len(docids)
+
+        return nterms, npostings
@@ -6,15 +6,26 @@ import os
 import json
 import time
 import logging
+import urlparse
+import cStringIO
 
 from status import ApplicationStatus
-from utils import Logger, load_module, get_file_name
+from utils import Logger, get_file_name, get_id, load_module
+from input import create_input, input_files
+from cursor import InputCursor
+from merge import MergePlan
+from partitioner import build_boundaries, write_boundaries, get_partition_file
+from index import get_index_name
+from query import QueryEngine
+from scoring import ScorePlan, FREQUENCIES
 from message import WorkerStatus, TYPE_MAP
 
 from jinja2 import Environment, FileSystemLoader
 from threading import Thread, Lock, Event
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from httpserver import RequestHandler, Server
+from framing import FRAMING_BINARY, FRAME_HEADER, check_frame_size, \
+                    encode_frame, decode_frame
 
 try:
     from filesystem import Filesystem
@@ -34,6 +45,9 @@ class Handler(RequestHandler):
     This object handles http requests
     """
 
+    # Set to True once the binary framing has been negotiated with the master
+    framed = False
+
     def __init__(self, conn, addr, server):
         RequestHandler.__init__(self, conn, addr, server)
 
@@ -47,6 +61,34 @@ class Handler(RequestHandler):
 
         self.eos_sent = False
 
+        # The DFS nodes of the group. Used to hand out local maps
+        self.nodes = set()
+
+    def reset(self):
+        if not self.framed:
+            RequestHandler.reset(self)
+            return
+
+        # Once the binary framing has been negotiated there are no more HTTP
+        # requests on this connection but just length prefixed frames.
+        self.set_terminator(FRAME_HEADER.size)
+        self.found_terminator = self.handle_frame_header
+        self.rfile = cStringIO.StringIO()
+
+    def handle_frame_header(self):
+        "Called when the length header of a frame has been received"
+        size = check_frame_size(FRAME_HEADER.unpack(self.rfile.getvalue())[0])
+
+        self.set_terminator(size)
+        self.found_terminator = self.handle_frame
+        self.rfile = cStringIO.StringIO()
+
+    def handle_frame(self):
+        "Called when the payload of a frame has been received"
+        code, type, nick, data = decode_frame(self.rfile.getvalue())
+        self.reset()
+        self._dispatch(type, nick, data)
+
     def handle_close(self):
         RequestHandler.handle_close(self)
 
@@ -85,6 +127,8 @@ class Handler(RequestHandler):
             self.send_header('Content-Length', len(data))
             self.end_headers()
             self.wfile.write(data)
+        elif self.path.startswith("/query?"):
+            self._query(urlparse.parse_qs(urlparse.urlparse(self.path).query))
         elif self.path == "/favicon.ico":
             # Don't worry it's not a shellcode. Just a little pomegranate.
             data = "\x1f\x8b\x08\x00\x1a\x5c\xbd\x4e\x02\xff\x7d\x93\x5d\x48" \
@@ -154,6 +198,45 @@ class Handler(RequestHandler):
             self.end_headers()
             self.wfile.write(data)
 
+    def _query(self, args):
+        """
+        Serve /query?q=<terms>[&k=<results>][&mode=and] against the final
+        output files.
+        """
+        engine = self.server.query_engine
+        terms = self.server.analyze(' '.join(args.get('q', [])))
+
+        try:
+            k = int(args.get('k', [10])[0])
+        except ValueError:
+            k = 0
+
+        if engine is None:
+            code, res = 503, {'error': 'Query serving is not available'}
+        elif not terms:
+            code, res = 400, {'error': 'Missing q parameter'}
+        elif k < 1:
+            code, res = 400, {'error': 'k must be a positive integer'}
+        else:
+            start = time.time()
+            results = engine.search(terms, k,
+                                    args.get('mode', ['or'])[0] == 'and')
+
+            code, res = 200, {
+                'terms': terms,
+                'results': results,
+                'time': time.time() - start,
+                'cache': (engine.cache.hits, engine.cache.misses),
+            }
+
+        data = json.dumps(res)
+
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
     def do_POST(self):
         """
         The method manages masters requests by calling the appropriate _on_*
@@ -162,10 +245,15 @@ class Handler(RequestHandler):
         clen = self.headers.getheader('content-length')
         request = json.loads(self.rfile.read(int(clen)))
 
-        type = request['type']
-        nick = request['nick']
-        data = request['data']
+        self._dispatch(request['type'], request['nick'], request['data'])
 
+    def _dispatch(self, type, nick, data):
+        """
+        Call the appropriate _on_* method for the given message
+        @param type the message type
+        @param nick the nick of the master sending the message
+        @param data payload of the message
+        """
         meth = None
 
         try:
@@ -203,7 +291,37 @@ class Handler(RequestHandler):
             server.masters[nick] = self
 
             server.last_id += 1
-            self.__send_data('registration-ok', data=server.last_id)
+
+            if isinstance(data, dict):
+                self.nodes = set(data.get('nodes', ()))
+
+            framed = isinstance(data, dict) and \
+                     data.get('framing') == FRAMING_BINARY
+
+            # The boundaries of the range partitioner are shipped to the
+            # group, which hands them to its workers with their maps. Groups
+            # report the start of their maps only if they are speculated.
+            speculation = bool(server.speculator.factor)
+
+            if framed or speculation or server.boundaries is not None:
+                reply = {'id': server.last_id}
+
+                if framed:
+                    reply['framing'] = FRAMING_BINARY
+
+                if speculation:
+                    reply['speculation'] = True
+
+                if server.boundaries is not None:
+                    reply['boundaries'] = server.boundaries
+
+                self.__send_data('registration-ok', data=reply)
+            else:
+                self.__send_data('registration-ok', data=server.last_id)
+
+            if framed:
+                self.__start_framing()
+
             server.info("Group %s ID=%d succesfully registered" % \
                         (nick, server.last_id))
 
@@ -228,6 +346,13 @@ class Handler(RequestHandler):
             self.__send_data('change-nick')
             server.warning("Collision. Group %s already registered." % nick)
 
+    def _on_nodes(self, server, type, nick, data):
+        """
+        A group advertises the DFS nodes of the workers it spawned
+        """
+        if nick in server.masters:
+            self.nodes.update(data)
+
     def _on_work_request(self, server, type, nick, data):
         """
         This method is responsible to return to the requestor a work to
@@ -236,80 +361,173 @@ class Handler(RequestHandler):
          - If we are in the merge phase _assing_merge_work is executed
          - If it is not the case _assign_generic_work is executed
         """
+        # The payload is the number of maps the master is willing to accept.
+        # Older masters just send an empty payload asking for a single map.
+        # Replies not carrying any map echo it so that the permits can be
+        # given back.
+        count = data if isinstance(data, int) else 0
+
         if not nick in server.masters:
-            self.__send_data('registration-needed')
+            self.__send_data('registration-needed', data=count)
             return
 
         if server.status.phase == server.status.PHASE_MERGE:
-            self._assign_merge_work(server, nick)
+            self._assign_merge_work(server, nick, count)
         else:
-            self._assign_generic_work(server, nick)
+            self._assign_generic_work(server, nick, count)
 
-    def _assign_merge_work(self, server, nick):
+    def _assign_merge_work(self, server, nick, count=0):
         """
-        The method is responsible to assign a reduce work which is used to
-        merge partial results to produce the final output file.
+        The method is responsible to assign the reduce works which are used
+        to merge partial results to produce the final output files. Several
+        independent merges of the same reducer are spread over all the groups
+        and their outputs are merged again until a file per reducer is left.
         """
+        plan = server.merge_plan
 
-        if nick in server.reduce_mark:
-            self.__send_data('try-later')
-            server.info("Sending try-later to %s. Already assigned" % nick)
+        if plan.finished() and self._assign_score_work(server, nick, count):
             return
 
-        lst = server.reduce_dict[nick]
+        if plan.finished():
+            server.info("Sending termination message to %s" % nick)
+            self.__send_data('plz-die')
 
-        if lst:
-            server.status.reduce_assigned += 1
-            server.reduce_mark.add(nick)
-            server.info("Assigning merge work %s to %s" % \
-                        (str(lst), nick))
-            self.__send_data('reduce-recovery', data=lst)
-        else:
-            # Ok probably we were just lucky. Do a final check in the
-            # dead_reduce_dict and only in the event of empty list send
-            # termination message.
-            server.info("Checking for possible zombie mergers")
+            # The check is internal
+            server.print_results()
+            return
 
-            try:
-                zombie, lst = server.dead_reduce_dict.popitem()
-                server.info("Reassinging merge job from %s to %s -> %s" % \
-                            (zombie, nick, str(lst)))
-                self.__send_data('reduce-recovery', data=lst)
-                server.status.reduce_assigned += 1
-                server.reduce_mark.add(nick)
+        requested = max(count, 1)
+        tasks = plan.assign(nick, requested)
+
+        if not tasks:
+            # Waiting for the outputs of the merges running elsewhere
+            self.__send_data('try-later', data=count)
+            return
 
-                if zombie in server.reduce_mark:
-                    server.reduce_mark.remove(zombie)
+        server.status.reduce_assigned += len(tasks)
+        server.info("Assigning merge works %s to %s" % (str(tasks), nick))
 
-            except KeyError:
-                server.info("Sending termination message to %s" % nick)
-                self.__send_data('plz-die')
+        self.__send_data('compute-reduce-batch', data=(requested, [
+            (reduce_idx, [fid for fid, _ in files])
+                for reduce_idx, files in tasks
+        ]))
 
-            # The check is internal
-            server.print_results()
+    def _assign_score_work(self, server, nick, count=0):
+        """
+        Once the merge is completed assign the TF-IDF scoring of the final
+        files, if tfidf-scoring is enabled. The tasks are reduce works with a
+        third item: the list of all the final files for the first one, which
+        computes the document frequencies, and the ID of the resulting
+        frequencies file for the others.
+        @return False if there is nothing left to score
+        """
+        if not server.tfidf_scoring:
+            return False
+
+        if server.score_plan is None:
+            server.score_plan = ScorePlan([
+                (reduce_idx, get_id(output[1]))
+                    for reduce_idx, output in enumerate(server.reduce_files)
+                    if isinstance(output, tuple)
+            ])
+
+        plan = server.score_plan
+
+        if plan.finished():
+            return False
+
+        requested = max(count, 1)
+        tasks = plan.assign(nick, requested)
+
+        if not tasks:
+            # Waiting for the scoring running elsewhere
+            self.__send_data('try-later', data=count)
+            return True
+
+        server.status.reduce_assigned += len(tasks)
+        server.info("Assigning scoring works %s to %s" % (str(tasks), nick))
 
-    def _assign_generic_work(self, server, nick):
+        self.__send_data('compute-reduce-batch', data=(requested, [
+            (reduce_idx, [], plan.files) if fid is FREQUENCIES else
+            (reduce_idx, [fid], plan.frequencies[0])
+                for reduce_idx, fid in tasks
+        ]))
+
+        return True
+
+    def _assign_generic_work(self, server, nick, count=0):
         """
         The method is responsible to assign a generic (MAP or REDUCE) work
         to the requester. In case the work_queue is empty the method
         _check_recovery_or_sleep
+
+        @param count the number of maps requested in a single batch or 0 if
+                     the master only understands single compute-map replies
         """
 
-        wstatus = server.work_queue.pop()
+        works = []
 
-        if wstatus is not None:
-            server.pending_works[nick].append(wstatus)
+        for _ in xrange(max(count, 1)):
+            wstatus = server.work_queue.pop(self.nodes)
+
+            if wstatus is None:
+                break
+
+            server.pending_works.add(nick, wstatus)
             server.status.map_assigned += 1
 
+            if server.cursor is not None:
+                server.cursor.assigned(wstatus.tag, nick)
+
             server.info("Assigning work %s (tag: %s) to %s" % \
                         (str(wstatus.state), str(wstatus.tag), nick))
 
+            works.append(wstatus)
+
+        if not works and not server.work_queue.deferred():
+            works = self._speculate(server, nick)
+
+        if not works and server.work_queue.deferred():
+            # Works are waiting for a group holding a replica of their input
+            self.__send_data('try-later', data=count)
+        elif not works:
+            self._check_recovery_or_sleep(server, nick, count)
+        elif count > 0:
+            self.__send_data('compute-map-batch', data=(count, [
+                (wstatus.tag, wstatus.state, wstatus.nodes)
+                for wstatus in works
+            ]))
+        else:
+            wstatus = works[0]
             self.__send_data('compute-map', wstatus.tag, wstatus.state)
 
-        else:
-            self._check_recovery_or_sleep(server, nick)
+    def _speculate(self, server, nick):
+        """
+        Duplicate on the requester a map which is running well beyond the
+        median duration on another group.
+        @return a list containing the backup WorkerStatus or an empty list
+        """
+        wstatus = server.speculator.pick(server.pending_works, nick,
+                                         server.status.get_throughput)
 
-    def _check_recovery_or_sleep(self, server, nick):
+        if wstatus is None:
+            return []
+
+        backup = WorkerStatus(TYPE_MAP, wstatus.tag, wstatus.state,
+                              wstatus.nodes)
+
+        server.speculator.speculated.add(backup.tag)
+        server.pending_works.add(nick, backup)
+
+        if server.cursor is not None:
+            server.cursor.assigned(backup.tag, nick)
+
+        server.info("Speculating work %s (tag: %s) on %s" % \
+                    (str(backup.state), str(backup.tag), nick))
+
+        return [backup]
+
+    def _check_recovery_or_sleep(self, server, nick, count=0):
         """
         Check if we have to handle recovery situations or just sleep. In case
         everything is fine the method is also responsible to switch to the
@@ -318,54 +536,15 @@ class Handler(RequestHandler):
 
         # If there are still waiting for acks we cannot proceed
         if len(server.pending_works) != 0:
-            self.__send_data('try-later')
+            self.__send_data('try-later', data=count)
             return
 
-        completed = self._reduce_completed()
-        need_recovery = self._need_recovery()
-
-        # In case we finished everything and there's nothing to recover
-        # compute the merge assignment for the merge phase.
-        if completed and not need_recovery:
+        # In case we finished everything compute the merge assignment for
+        # the merge phase. Partial files of dead groups are merged as well.
+        if self._reduce_completed():
             server.info("Group %s triggered the merge assignment" % nick)
             self._compute_merge_assignment()
-
-            lst = server.reduce_dict[nick]
-
-            if lst:
-                if nick in server.reduce_mark:
-                    # Cannot happen but just to be sure since it is the group
-                    # which triggered the event :)
-                    self.__send_data('try-later')
-                else:
-                    server.reduce_mark.add(nick)
-                    server.status.reduce_assigned += 1
-                    server.info("Assigning merge work %s to %s" % \
-                                (str(lst), nick))
-                    self.__send_data('reduce-recovery', data=lst)
-            else:
-                # Note here we can also keep the master alive without kill
-                server.info("Group %s unneeded for the merge" % nick)
-                self.__send_data('plz-die')
-
-        # In case there are still jobs that needs recovery reassign to the
-        # living requester.
-        elif completed and need_recovery:
-            if nick in server.reduce_mark:
-                self.__send_data('try-later')
-            else:
-                # This will converge slowly but better than nothing
-                zombie, lst = server.dead_reduce_dict.popitem()
-                server.info("Reassinging jobs from %s to %s -> %s" % \
-                            (zombie, nick, str(lst)))
-
-                if zombie in server.reduce_mark:
-                    server.reduce_mark.remove(zombie)
-
-                server.reduce_mark.add(nick)
-                server.reduce_dict[nick] = lst
-                server.status.reduce_assigned += 1
-                self.__send_data('reduce-recovery', data=lst)
+            self._assign_merge_work(server, nick, count)
 
         else:
             # If we are here the map jobs have been exhausthed and correctly
@@ -377,16 +556,16 @@ class Handler(RequestHandler):
 
             if not self.eos_sent:
                 server.info("Stream completed. It is time for the reducers")
-                self.__send_data('end-of-stream')
+                self.__send_data('end-of-stream', data=count)
                 self.eos_sent = True
             else:
-                self.__send_data('try-later')
+                self.__send_data('try-later', data=count)
 
     def _compute_merge_assignment(self):
         """
-        The method is in charge of reconstruct the reduce_dict attribute which
-        will be used to derive the merge phase. The scheduling is done in a
-        round robin fashion.
+        The method is in charge of collecting all the partial files of every
+        reducer, including the ones left by dead groups, into the MergePlan
+        used to drive the merge phase.
         """
         server = self.server
 
@@ -396,34 +575,32 @@ class Handler(RequestHandler):
         server.status.phase = server.status.PHASE_MERGE
 
         reduce_work = []
+        owners = {}
+
         for _ in range(server.num_reducer):
             reduce_work.append([])
 
-        # Extract all the works from the reduce dict
-        for _, reducers in server.reduce_dict.items():
+        # Extract all the works from the reduce dicts
+        groups = server.reduce_dict.items() + server.dead_reduce_dict.items()
+
+        for nick, reducers in groups:
+            if not reducers:
+                continue
+
             for reduce_idx, reduce_lst in enumerate(reducers):
-                reduce_work[reduce_idx].extend(reduce_lst)
+                if reduce_lst:
+                    reduce_work[reduce_idx].extend(reduce_lst)
+                    owners[reduce_idx] = nick
 
-        # Recreate it
-        pos = 0
-        nicks = server.masters.keys()
-        maxnick = len(nicks)
         server.reduce_dict = defaultdict(list)
+        server.dead_reduce_dict = defaultdict(list)
 
         for reduce_idx, files in enumerate(reduce_work):
-            jobs = [(), ] * server.num_reducer
-            jobs[reduce_idx] = files
-
-            if len(files) > 1:
-                server.reduce_dict[nicks[pos]] = jobs
-            else:
-                if len(files) == 1:
-                    server.retrieve_file(nicks[pos], reduce_idx, files[0])
-                server.reduce_dict[nicks[pos]] = None
+            if len(files) == 1:
+                server.retrieve_file(owners[reduce_idx], reduce_idx, files[0])
 
-            pos = (pos + 1) % maxnick
-
-        server.info("After the merge we have %s" % str(server.reduce_dict))
+        server.merge_plan = MergePlan(reduce_work, server.merge_fanin)
+        server.info("Merge plan: %s" % str(reduce_work))
 
     def _reduce_completed(self):
         """
@@ -441,17 +618,6 @@ class Handler(RequestHandler):
 
         return True
 
-    def _need_recovery(self):
-        """
-        Return a boolean indicating if there are reduce works to recovery.
-        This is of course implemented with a check in the dead structure.
-        """
-
-        if self.server.dead_reduce_dict:
-            return True
-        else:
-            return False
-
     def __send_data(self, type, nick='', data='', code=200):
         """
         Utility function to send back to requester a proper message
@@ -460,6 +626,10 @@ class Handler(RequestHandler):
         @param data payload of the message
         @param code the HTTP response code to use in the reply
         """
+        if self.framed:
+            self.push(encode_frame(type, nick, data, code))
+            return
+
         payload = json.dumps({
             "type": type,
             "nick": nick,
@@ -471,6 +641,45 @@ class Handler(RequestHandler):
         self.end_headers()
         self.wfile.write(payload)
 
+    def __push_data(self, type, data):
+        """
+        Push an unsolicited message to the master through the producer fifo
+        @param type the message type
+        @param data payload of the message
+        """
+        if self.framed:
+            self.push(encode_frame(type, self.nick, data))
+            return
+
+        payload = json.dumps({
+            'type': type,
+            'nick': self.nick,
+            'data': data,
+        })
+
+        self.push("HTTP/1.1 200 OK\r\n"                \
+                  "Content-type: application/json\r\n" \
+                  "Connection: keep-alive\r\n"         \
+                  "Content-Length: %d\r\n\r\n%s" %     \
+                  (len(payload), payload))
+
+    def __start_framing(self):
+        """
+        Switch the connection to the binary framing. Replies and frames share
+        the producer fifo so the HTTP reply already queued is sent first. The
+        switch of the parser happens as soon as the current request is
+        finished.
+        """
+        self.framed = True
+
+    def _on_map_started(self, server, type, nick, data):
+        """
+        A group started executing the map having the tag given as payload.
+        Until then the map was waiting in the queue of the group.
+        """
+        if nick in server.masters:
+            server.pending_works.start(nick, data)
+
     def _on_map_ack(self, server, type, nick, data):
         """
         The method is triggered whenever a master wants to communicate that a
@@ -485,16 +694,10 @@ class Handler(RequestHandler):
         tag  = data[0]
         files = data[1]
 
-        jobs = server.pending_works[nick]
-        found = False
-
-        # The first thing to do is to iterate over the pending_works structure
-        # to extract the WorkerStatus object assigned to the master
-
-        for pos, wstatus in enumerate(jobs):
-            if tag == wstatus.tag:
-                found = True
-                break
+        # The first thing to do is to extract from the pending_works structure
+        # the WorkerStatus object assigned to the master
+        since = server.pending_works.started(nick, tag)
+        wstatus = server.pending_works.remove(nick, tag)
 
         # If we found a proper object matching the just communicated tag we
         # simply remove from the structure. Then all the files produced are put
@@ -504,11 +707,15 @@ class Handler(RequestHandler):
         # the produced files without having to worry about contacting again the
         # server to request a reduce job.
 
-        if found:
-            del server.pending_works[nick][pos]
+        if wstatus is not None:
+            if since is not None:
+                server.speculator.record(time.time() - since)
 
-            if not server.pending_works[nick]:
-                del server.pending_works[nick]
+            # This ack wins. The copies still running elsewhere are losers
+            for other in list(server.pending_works.owners(tag)):
+                server.pending_works.remove(other, tag)
+                server.speculator.losers.add((other, tag))
+                server.info("Group %s lost the race for tag %s" % (other, tag))
 
             nfile = 0
             size = 0
@@ -518,15 +725,29 @@ class Handler(RequestHandler):
                 nfile += 1
                 server.reduce_dict[nick][rid].append((fid, fsize))
 
+            if server.cursor is not None:
+                server.cursor.mapped(tag, nick, files)
+
             server.status.map_completed += 1
             server.status.map_file += nfile
             server.status.map_file_size += size
             server.status.add_graph_point()
 
             server.info("Map acknowledged correctly for group %s" % (nick))
+            self.__send_data('map-ack-ok', data=tag)
+
+        elif (nick, tag) in server.speculator.losers:
+            server.speculator.losers.remove((nick, tag))
+
+            for rid, fid, fsize in files:
+                server.remove_file(rid, fid)
+
+            server.info("Discarding output of tag %s from %s" % (tag, nick))
+            self.__send_data('map-ack-discard', data=(tag, files))
+
         else:
             server.error("No work found with tag %d %s for group %s" % \
-                            (tag, str(jobs), nick))
+                            (tag, str(server.pending_works.get(nick)), nick))
 
             self.__send_data('map-ack-fail', nick, data)
 
@@ -549,11 +770,19 @@ class Handler(RequestHandler):
         to_add     = data[1][0] # NB: This is a tuple (fid, fsize)
         to_delete  = data[1][1:] # NB: This is instead a sequence of [fid, ..]
 
-        if nick in server.reduce_mark:
-            server.reduce_mark.remove(nick)
+        if server.score_plan is not None:
+            self._score_completed(server, nick, reduce_idx, to_add, to_delete)
+            return
+
+        if server.status.phase == server.status.PHASE_MERGE:
+            self._merge_completed(server, nick, reduce_idx, to_add, to_delete)
+            return
 
         jobs = server.reduce_dict[nick][reduce_idx]
 
+        if server.cursor is not None:
+            server.cursor.reduced(nick, reduce_idx, to_add, to_delete)
+
         server.info("Received %s from %s" % (str(data), nick))
         server.info("Jobs for the reducer %d is %s" % (reduce_idx, str(jobs)))
 
@@ -568,17 +797,7 @@ class Handler(RequestHandler):
                 dfid = to_delete[dpos]
 
                 if ofid == dfid:
-                    fname = get_file_name(server.path, reduce_idx, dfid)
-
-                    if server.use_dfs:
-                        try:
-                            server.work_queue.fs.nukeFile(fname)
-                            server.info("Nuking map file %s from DFS" % fname)
-                        except:
-                            pass
-                    else:
-                        server.info("Removing map output file %s" % fname)
-                        os.unlink(fname)
+                    server.remove_file(reduce_idx, dfid)
 
                     del to_delete[dpos]
                     del jobs[opos]
@@ -591,11 +810,7 @@ class Handler(RequestHandler):
 
         # Execute it anyway. It will be buffered.
         server.retrieve_file(nick, reduce_idx, tuple(to_add))
-
-        if server.status.phase == server.status.PHASE_MERGE:
-            server.reduce_dict[nick] = None
-        else:
-            jobs.append(tuple(to_add))
+        jobs.append(tuple(to_add))
 
         server.status.reduce_assigned += 1
         server.status.reduce_completed += 1
@@ -607,6 +822,57 @@ class Handler(RequestHandler):
             server.error("Failed to remove reduce files %s" % str(to_delete))
             self.__send_data('reduce-ack-fail', nick, data)
 
+    def _merge_completed(self, server, nick, reduce_idx, to_add, to_delete):
+        """
+        Handle the reduce-ack of a merge task: the merged files are removed
+        and the output is made available for the next level of the tree.
+        """
+        server.info("Received merge %s of reducer %d from %s" % \
+                    (str(to_add), reduce_idx, nick))
+
+        files = server.merge_plan.complete(nick, reduce_idx, to_add, to_delete)
+
+        if files is None:
+            server.error("No merge work %s of reducer %d found for group %s" \
+                         % (str(to_delete), reduce_idx, nick))
+            self.__send_data('reduce-ack-fail', nick, (reduce_idx,
+                                                       [to_add] + to_delete))
+            return
+
+        for fid, _ in files:
+            server.remove_file(reduce_idx, fid)
+
+        if server.cursor is not None:
+            server.cursor.reduced(nick, reduce_idx, to_add,
+                                  [fid for fid, _ in files])
+
+        if server.merge_plan.done(reduce_idx):
+            server.retrieve_file(nick, reduce_idx, tuple(to_add))
+
+        server.status.reduce_completed += 1
+        server.status.reduce_file += 1
+        server.status.reduce_file_size += to_add[1]
+        server.status.add_graph_point()
+
+    def _score_completed(self, server, nick, reduce_idx, to_add, to_delete):
+        """
+        Handle the reduce-ack of a scoring task. The final file is kept.
+        """
+        server.info("Received scoring %s of reducer %d from %s" % \
+                    (str(to_add), reduce_idx, nick))
+
+        if not server.score_plan.complete(nick, reduce_idx, to_add):
+            server.error("No scoring work of reducer %d found for group %s" \
+                         % (reduce_idx, nick))
+            self.__send_data('reduce-ack-fail', nick, (reduce_idx,
+                                                       [to_add] + to_delete))
+            return
+
+        server.status.reduce_completed += 1
+        server.status.reduce_file += 1
+        server.status.reduce_file_size += to_add[1]
+        server.status.add_graph_point()
+
     def _on_keep_alive(self, server, type, nick, data):
         """
         The event is triggered whenever a master is replying to a keep-alive
@@ -643,18 +909,7 @@ class Handler(RequestHandler):
 
         if self.par_degree_changed == CHANGE_REQUESTED:
             self.par_degree_changed = CHANGE_SENT
-
-            data = json.dumps({
-                'type': 'change-degree',
-                'nick': self.nick,
-                'data': self.par_degree,
-            })
-
-            self.push("HTTP/1.1 200 OK\r\n"                \
-                      "Content-type: application/json\r\n" \
-                      "Connection: keep-alive\r\n"         \
-                      "Content-Length: %d\r\n\r\n%s" %     \
-                      (len(data), data))
+            self.__push_data('change-degree', self.par_degree)
 
         with self.server.lock:
             if not self.waiting_ping_response and \
@@ -662,20 +917,9 @@ class Handler(RequestHandler):
                 self.server.timestamps[nick][0] == PING_EXECUTE:
                 self.time_probe = time.time()
 
-                data = json.dumps({
-                    'type': 'keep-alive',
-                    'nick': self.nick,
-                    'data': self.time_probe,
-                })
-
                 #self.server.info("Requesting RTT for %s" % self.nick)
 
-                self.push("HTTP/1.1 200 OK\r\n"                \
-                          "Content-type: application/json\r\n" \
-                          "Connection: keep-alive\r\n"         \
-                          "Content-Length: %d\r\n\r\n%s" %     \
-                          (len(data), data))
-
+                self.__push_data('keep-alive', self.time_probe)
                 self.waiting_ping_response = True
 
         return RequestHandler.writable(self)
@@ -685,8 +929,15 @@ class WorkQueue(object):
     The object is able to merge a generator and a queue and trasparently expose
     a simple interface for retrieving objects. The generator is prioritized
     with respect to the queue, which is used as a backup in some sense.
+
+    If a locality delay is given and the DFS is in use, a window of works is
+    kept aside and each work is preferably handed to a requester holding a
+    replica of its input. A work is handed to any requester only after
+    having waited for the given delay.
     """
-    def __init__(self, logger, gen, use_dfs=False, dfs_conf=None):
+    def __init__(self, logger, gen, use_dfs=False, dfs_conf=None,
+                 locality_delay=0, locality_window=64, cursor=None,
+                 source=None):
         """
         Initialize a WorkQueue instance
         @param logger a logger object
@@ -694,12 +945,25 @@ class WorkQueue(object):
         @param use_dfs boolean indicating whether to use a DFS or not
         @param dfs_conf a dictionary containing the necessary parameters for
                         the DFS Master initialization.
+        @param locality_delay seconds a work waits for a requester holding a
+                              replica of its input. 0 disables the locality
+        @param locality_window maximum number of works kept aside
+        @param cursor an optional InputCursor recording the works extracted
+        @param source the object producing gen. Its position attribute, if
+                      any, is recorded by the cursor with every input
         """
         self.logger = logger
         self.generator = gen
-        self.dead_queue = []
+        self.dead_queue = deque()
         self.last_tag = 0
         self.use_dfs = use_dfs
+        self.cursor = cursor
+        self.source = source
+
+        # The replicas are looked up once, when the work enters the window
+        self.window = deque() # [(WorkerStatus, since:float, replicas), ..]
+        self.locality_delay = locality_delay if use_dfs else 0
+        self.locality_window = locality_window
 
         if use_dfs and not DFS_AVAILABLE:
             raise Exception("You need to install fsdfs in order to use the" \
@@ -720,38 +984,266 @@ class WorkQueue(object):
 
         self.dead_queue.append(item)
 
-    def next(self):
+    def replicas(self, wstatus):
         """
-        Extract the next value from the WorkQueue
-        @return an object or None if the retrieve is not possible
+        @param wstatus a WorkerStatus object
+        @return a set containing the DFS nodes holding a replica of the input
+        """
+        if not self.use_dfs:
+            return set()
+
+        try:
+            return set(self.fs.filedb.getNodes(wstatus.state[0]))
+        except Exception:
+            return set()
+
+    def deferred(self):
+        """
+        @return True if there are works waiting for a requester holding a
+                replica of their input
+        """
+        return len(self.window) > 0
+
+    def __fetch(self):
+        """
+        Extract the next value from the generator or from the dead_queue
+        @return a WorkerStatus object or None if the retrieve is not possible
         """
         self.last_tag += 1
 
         try:
-            # Here value is a tuple (path to file, file id)
-            fname, fid = self.generator.next()
+            # Here value is a tuple (path to file, file id[, parts])
+            value = self.generator.next()
 
             if self.use_dfs:
-                self.logger.info("Publishing file '%s' from '%s'" % \
-                                 (fname, self.datadir))
+                for fname in input_files(value):
+                    self.logger.info("Publishing file '%s' from '%s'" % \
+                                     (fname, self.datadir))
 
-                self.fs.importFile(os.path.join(self.datadir, fname), fname)
+                    self.fs.importFile(os.path.join(self.datadir, fname),
+                                       fname)
 
-            return WorkerStatus(TYPE_MAP, self.last_tag, (fname, fid))
+            if self.cursor is not None:
+                self.cursor.extracted(self.last_tag, tuple(value), True,
+                                      getattr(self.source, 'position', None))
+
+            return WorkerStatus(TYPE_MAP, self.last_tag, tuple(value))
 
         except StopIteration:
             if self.dead_queue:
-                value = self.dead_queue.pop(0)
+                value = self.dead_queue.popleft()
+
+                if self.cursor is not None:
+                    self.cursor.extracted(self.last_tag, value, False)
+
                 return WorkerStatus(TYPE_MAP, self.last_tag, value)
             else:
                 return None
 
-    def pop(self):
+    def next(self, nodes=()):
+        """
+        Extract the next value from the WorkQueue
+        @param nodes the DFS nodes of the requester
+        @return an object or None if the retrieve is not possible
+        """
+        if not self.locality_delay:
+            return self.__fetch()
+
+        while len(self.window) < self.locality_window:
+            wstatus = self.__fetch()
+
+            if wstatus is None:
+                break
+
+            self.window.append((wstatus, time.time(), self.replicas(wstatus)))
+
+        if nodes:
+            for pos, (wstatus, _, replicas) in enumerate(self.window):
+                if replicas & nodes:
+                    del self.window[pos]
+                    wstatus.nodes = tuple(replicas)
+                    return wstatus
+
+        # The oldest work has waited enough. Give it to anybody
+        if self.window and \
+           time.time() - self.window[0][1] >= self.locality_delay:
+            wstatus, _, replicas = self.window.popleft()
+            wstatus.nodes = tuple(replicas)
+            return wstatus
+
+        return None
+
+    def pop(self, nodes=()):
         """
         An alias for the next method
+        @param nodes the DFS nodes of the requester
         @return an object
         """
-        return self.next()
+        return self.next(nodes)
+
+class PendingWorks(object):
+    """
+    Keep track of the maps assigned to every group and not acknowledged yet.
+    The works of a group are indexed by tag in order to find them in constant
+    time on acks, while the assignment order is kept for the recovery. The
+    same tag may be pending on several groups if it has been speculated.
+    """
+    def __init__(self):
+        # since is the time at which the work started executing on a worker,
+        # None while it is waiting in the map_queue of the master
+        self.groups = {} # nick => OrderedDict(tag => (WorkerStatus, since))
+        self.tags = defaultdict(set) # tag => set([nick, ..])
+
+    def __len__(self):
+        "@return the number of groups having at least one pending work"
+        return len(self.groups)
+
+    def add(self, nick, wstatus):
+        """
+        Mark a work as assigned to a group
+        @param nick the nick of the group
+        @param wstatus the WorkerStatus object assigned
+        """
+        works = self.groups.get(nick)
+
+        if works is None:
+            works = self.groups[nick] = OrderedDict()
+
+        works[wstatus.tag] = (wstatus, None)
+        self.tags[wstatus.tag].add(nick)
+
+    def start(self, nick, tag):
+        """
+        Mark a work as started on a worker of the group
+        @param nick the nick of the group
+        @param tag the tag of the work
+        """
+        works = self.groups.get(nick, {})
+
+        if tag in works:
+            works[tag] = (works[tag][0], time.time())
+
+    def get(self, nick):
+        "@return the list of works pending for the given group"
+        return [wstatus for wstatus, _ in self.groups.get(nick, {}).values()]
+
+    def items(self):
+        "@return an iterator over (nick, WorkerStatus, start time or None)"
+        for nick, works in self.groups.items():
+            for wstatus, since in works.values():
+                yield nick, wstatus, since
+
+    def started(self, nick, tag):
+        "@return the time at which the work started executing or None"
+        works = self.groups.get(nick, {})
+        return works[tag][1] if tag in works else None
+
+    def owners(self, tag):
+        "@return the set of groups the work is pending on"
+        return self.tags.get(tag, set())
+
+    def remove(self, nick, tag):
+        """
+        Remove an acknowledged work
+        @param nick the nick of the group
+        @param tag the tag of the work
+        @return the WorkerStatus object or None if no such work is pending
+        """
+        works = self.groups.get(nick)
+
+        if works is None or tag not in works:
+            return None
+
+        wstatus, _ = works.pop(tag)
+        self.__forget(nick, tag)
+
+        if not works:
+            del self.groups[nick]
+
+        return wstatus
+
+    def remove_group(self, nick):
+        """
+        Remove all the works pending for a group
+        @param nick the nick of the group
+        @return the list of works in assignment order
+        """
+        works = self.groups.pop(nick, {})
+
+        for tag in works:
+            self.__forget(nick, tag)
+
+        return [wstatus for wstatus, _ in works.values()]
+
+    def __forget(self, nick, tag):
+        owners = self.tags[tag]
+        owners.discard(nick)
+
+        if not owners:
+            del self.tags[tag]
+
+class Speculator(object):
+    """
+    Keep track of the duration of the maps in order to pick stragglers to be
+    executed again on another group once the WorkQueue is drained. The first
+    ack received for a speculated map wins while the outputs of the others
+    are discarded.
+    """
+    def __init__(self, factor, samples=1000):
+        """
+        @param factor a map is a straggler if it has been running for more
+                      than factor times the median duration. 0 disables
+                      the speculation
+        @param samples the number of durations used to compute the median
+        """
+        self.factor = factor
+        self.durations = deque(maxlen=samples)
+
+        self.speculated = set() # tags having a backup
+        self.losers = set() # (nick, tag) whose output has to be discarded
+
+    def record(self, duration):
+        "Record the duration in seconds of a completed map"
+        self.durations.append(duration)
+
+    def median(self):
+        "@return the median duration of the completed maps"
+        durations = sorted(self.durations)
+        return durations[len(durations) / 2]
+
+    def remove_group(self, nick):
+        """
+        Forget the copies of a dead group which lost a race
+        @param nick the nick of the group
+        """
+        self.losers = set(item for item in self.losers if item[0] != nick)
+
+    def pick(self, pending, nick, throughput):
+        """
+        Pick the map to duplicate on the requesting group. The oldest
+        straggler running on a group not faster than the requester is chosen.
+        @param pending the PendingWorks object
+        @param nick the nick of the requesting group
+        @param throughput a function returning the throughput of a group
+        @return a WorkerStatus object or None
+        """
+        if not self.factor or not self.durations:
+            return None
+
+        limit = time.time() - self.factor * self.median()
+        best, best_since = None, None
+
+        # Maps still queued on their group are not running late
+        for owner, wstatus, since in pending.items():
+            if owner == nick or wstatus.tag in self.speculated or \
+               since is None or since > limit or \
+               throughput(owner) > throughput(nick):
+                continue
+
+            if best is None or since < best_since:
+                best, best_since = wstatus, since
+
+        return best
 
 class PushHandler(logging.Handler):
     """
@@ -792,32 +1284,75 @@ class MasterServer(Server, Logger):
         #   [
         #   ] => Reduce-1
         # ]
-        self.reduce_mark = set()
         self.reduce_dict = defaultdict(list)
         self.dead_reduce_dict = defaultdict(list)
 
         # This is a dictionary nick => Handler instance
         self.masters = {}
         self.last_id = -1
-        self.pending_works = defaultdict(list) # nick => [work, ...]
+        self.pending_works = PendingWorks() # nick => {tag: work, ...}
+        self.speculator = Speculator(float(conf.get('speculative-factor', 0)))
 
         self.ping_max = int(conf["ping-max"])
         self.ping_interval = int(conf["ping-interval"])
         self.num_reducer = int(conf["num-reducer"])
 
+        # Maximum number of files merged by a single task of the merge phase
+        self.merge_fanin = int(conf.get('merge-fanin', conf['threshold-nfile']))
+        self.merge_plan = None
+
+        # Scoring stage executed after the merge phase
+        self.tfidf_scoring = bool(conf.get('tfidf-scoring', False))
+        self.score_plan = None
+
         # This will just keep track of the name of the files
         self.reduce_files = []
         self.results_printed = False
 
+        # Serve the final files through /query once the job is finished
+        self.query_serving = bool(conf.get('query-serving', False))
+        self.query_cache_size = int(conf.get('query-cache-size', 1024))
+        self.query_documents = int(conf.get('query-documents', 0))
+        self.query_engine = None
+
+        # Queries are turned into terms by the analyze function of the map
+        # module, if any, in order to match the indexed terms
+        self.analyzer = None
+
+        if self.query_serving:
+            self.analyzer = getattr(load_module(conf['map-module']),
+                                    'analyze', None)
+
         for _ in range(self.num_reducer):
             self.reduce_files.append("N/A")
 
-        # Load the input module and assing the generator to the work_queue
-        module = load_module(conf["input-module"])
-        cls = getattr(module, "Input", None)
+        # The boundaries of the range partitioner are computed before any
+        # map is assigned
+        self.boundaries = None
+
+        if conf.get('partitioner') == 'range':
+            self.info("Sampling the input to compute the partitions")
+            self.boundaries = build_boundaries(conf, fconf, self)
+            write_boundaries(get_partition_file(conf), self.boundaries)
+            self.info("Range boundaries are %s" % str(self.boundaries))
+
+        # Load the input module and assing the generator to the work_queue.
+        # Inputs are split in tasks of input-split-size bytes if given
+        inp = create_input(conf, fconf)
+
+        # The scheduling state is journaled in input-cursor if given. Inputs
+        # consumed before a restart are skipped
+        if conf.get('input-cursor'):
+            self.cursor = InputCursor(
+                conf['input-cursor'],
+                float(conf.get('journal-sync-interval', 0.05)),
+                int(conf.get('journal-snapshot-records', 100000)))
+            generator = inp.resume(self.cursor.position)
+        else:
+            self.cursor = None
+            generator = inp.input()
 
         # Some code for the DFS
-        generator = cls(fconf).input()
         self.use_dfs = use_dfs = conf['dfs-enabled']
 
         if use_dfs:
@@ -832,7 +1367,13 @@ class MasterServer(Server, Logger):
                 os.path.join(conf['datadir'], conf['output-prefix'])
             )
 
-        self.work_queue = WorkQueue(self.logger, generator, use_dfs, dfsconf)
+        self.work_queue = WorkQueue(self.logger, generator, use_dfs, dfsconf,
+                                    conf.get('locality-delay', 0),
+                                    conf.get('locality-window', 64),
+                                    self.cursor, inp)
+
+        if self.cursor is not None:
+            self.resume()
 
         # Lock to synchronize access to the timestamps dictionary
         self.lock = Lock()
@@ -847,6 +1388,24 @@ class MasterServer(Server, Logger):
         self.addrinfo = (conf['master-host'], conf['master-port'])
         Server.__init__(self, self.addrinfo[0], self.addrinfo[1], handler)
 
+    def resume(self):
+        """
+        Restore the state replayed by the cursor. The works never
+        acknowledged are executed again while the partial files are handed
+        back to their groups when they register again, like the ones of a
+        dead group.
+        """
+        self.work_queue.last_tag = self.cursor.last_tag
+
+        for state in self.cursor.works():
+            self.work_queue.push(state)
+
+        for nick, lst in self.cursor.groups(self.num_reducer).items():
+            self.dead_reduce_dict[nick] = lst
+
+        self.info("Resuming from input %s with %d works to execute again" % \
+                  (str(self.cursor.position), len(self.cursor.pending)))
+
     def run(self):
         "Start the server"
 
@@ -869,6 +1428,36 @@ class MasterServer(Server, Logger):
         if self.work_queue.use_dfs:
             self.work_queue.fs.stop()
 
+        if self.cursor is not None:
+            self.cursor.close()
+
+    def remove_file(self, reduce_idx, fid):
+        """
+        Remove an intermediate file which is not needed anymore
+        @param reduce_idx the reducer ID
+        @param fid the unique file ID
+        """
+        fname = get_file_name(self.path, reduce_idx, fid)
+
+        if self.use_dfs:
+            try:
+                self.work_queue.fs.nukeFile(fname)
+                self.info("Nuking map file %s from DFS" % fname)
+            except:
+                pass
+
+            # Dictionaries only exist for the outputs of the Python engine
+            try:
+                self.work_queue.fs.nukeFile(get_index_name(fname))
+            except:
+                pass
+        else:
+            self.info("Removing map output file %s" % fname)
+            os.unlink(fname)
+
+            if os.path.exists(get_index_name(fname)):
+                os.unlink(get_index_name(fname))
+
     def retrieve_file(self, nick, reduce_idx, file):
         fid, fsize = file
         fname = get_file_name(self.path, reduce_idx, fid)
@@ -878,15 +1467,72 @@ class MasterServer(Server, Logger):
         if self.results_printed:
             return
 
-        if not self.reduce_mark and not self.dead_reduce_dict and \
-           self.status.phase == self.status.PHASE_MERGE:
+        if self.status.phase == self.status.PHASE_MERGE and \
+           self.merge_plan.finished():
 
             self.results_printed = True
 
-            for nick, fname, fsize in self.reduce_files:
+            for output in self.reduce_files:
+                if not isinstance(output, tuple):
+                    continue
+
+                nick, fname, fsize = output
                 self.info("Group %s produced %s [%d bytes] output file" % \
                           (nick, fname, fsize))
 
+            if self.score_plan is not None and \
+               self.score_plan.frequencies is not None:
+                self.info("Document frequencies file %s [%d bytes]" % \
+                          (get_file_name(self.path, 0,
+                                         self.score_plan.frequencies[0],
+                                         "frequencies"),
+                           self.score_plan.frequencies[1]))
+
+            if self.score_plan is not None:
+                scored = self.score_plan.completed
+
+                for reduce_idx, (fid, fsize) in sorted(scored.items()):
+                    self.info("Scored file %s [%d bytes]" % \
+                              (get_file_name(self.path, reduce_idx, fid,
+                                             "scored"), fsize))
+
+            if self.query_serving:
+                self.start_query_engine()
+
+    def analyze(self, text):
+        """
+        Turn the text of a query into terms
+        @param text a str
+        @return a list of terms
+        """
+        if self.analyzer is not None:
+            return self.analyzer(text)
+
+        return text.lower().split()
+
+    def start_query_engine(self):
+        "Open the final files in order to serve queries through /query"
+        if self.use_dfs:
+            self.warning("Query serving needs the final files on the local "
+                         "filesystem. Disabled since DFS is enabled")
+            return
+
+        # Reducers which did not receive any key have no output
+        fnames = [output[1] for output in self.reduce_files
+                  if isinstance(output, tuple)]
+
+        try:
+            # The analyzer fails early if it cannot work, e.g. without stemmer
+            self.analyze('')
+            self.query_engine = QueryEngine(fnames, self.query_cache_size,
+                                            self.query_documents)
+        except Exception, exc:
+            self.error("Unable to serve queries: %s" % str(exc))
+            return
+
+        self.info("Serving queries on http://%s:%d/query?q=" % \
+                  self.addrinfo)
+
     def on_group_died(self, nick, is_error):
         """
         Called whenever a master disconnected from the server
@@ -901,13 +1547,28 @@ class MasterServer(Server, Logger):
         self.status.update_master_status(nick, {'status': 'dead'})
         self.status.faults += 1
 
+        if self.cursor is not None:
+            self.cursor.died(nick)
+
         # Remove any pending map activity
-        lst = self.pending_works[nick]
-        del self.pending_works[nick]
+        lst = self.pending_works.remove_group(nick)
 
         for wstatus in lst:
             self.status.map_faulted += 1
-            self.work_queue.push(wstatus.state)
+
+            # A speculated copy is still running somewhere else
+            if not self.pending_works.owners(wstatus.tag):
+                self.speculator.speculated.discard(wstatus.tag)
+                self.work_queue.push(wstatus.state)
+
+        self.speculator.remove_group(nick)
+
+        # Give back the merges assigned to the group
+        if self.status.phase == self.status.PHASE_MERGE:
+            self.status.reduce_faulted += self.merge_plan.remove_group(nick)
+
+        if self.score_plan is not None:
+            self.status.reduce_faulted += self.score_plan.remove_group(nick)
 
         # Remove any pending reduce activity
         lst = self.reduce_dict[nick]
@@ -933,6 +1594,10 @@ class MasterServer(Server, Logger):
 
             time.sleep(self.ping_interval)
 
+            # Records appended after the last batch still have to be synced
+            if self.cursor is not None:
+                self.cursor.sync()
+
             # Here we do not do anything if a given master overflows a specific
             # the specified limit but just warn the user about the violation.
 
@@ -58,6 +58,7 @@ class ApplicationStatus(object):
             'finished': (0, 0),
             'ongoing': (0, 0),
             'files': ((0, 0), (0, 0)),
+            'combined': (0, 0),
             'status': 'online',
             'avg': 0,
         })
@@ -68,6 +69,10 @@ class ApplicationStatus(object):
 
         self.masters[nick] = empty
 
+    def get_throughput(self, nick):
+        "@return the average throughput in bytes/sec reported by a master"
+        return self.masters.get(nick, {}).get('avg', 0)
+
     def push_log(self, record):
         self.lastlog.append(record.getMessage())
 
@@ -132,6 +137,7 @@ class ApplicationStatus(object):
                 "%s files, %s MBs" % (
                     get_triple(d['files'][0]),
                     size_str),
+                "%d/%d" % tuple(d['combined']),
                 status
             ])
 
@@ -197,6 +203,10 @@ class MasterStatus(object):
         self._reduce_file = 0
         self._reduce_file_size = 0
 
+        # Records entering and leaving the combiners of the mappers
+        self._combine_input = 0
+        self._combine_output = 0
+
         self._time = 0
         self._bandwidth = 0
 
@@ -229,5 +239,6 @@ class MasterStatus(object):
                 "finished": (self._map_finished, self._reduce_finished),
                 "ongoing": (self._map_ongoing, self._reduce_ongoing),
                 "files": ((self._map_file, self._reduce_file),
-                          (self._map_file_size, self._reduce_file_size))
+                          (self._map_file_size, self._reduce_file_size)),
+                "combined": (self._combine_input, self._combine_output),
             }
@@ -72,15 +72,21 @@ def load_module(mod):
     return module
 
 
-def create_file(directory, reducer, prefix="output", delete=False):
+def create_file(directory, reducer, master_id=0, worker_id=0, prefix="output",
+                delete=False):
     """
-    Utility function to create a unique named temporary file
+    Utility function to create a unique named temporary file. The name
+    follows the same scheme used by the C indexer so that the unique file ID
+    is made of the master ID, the worker ID and 6 random digits.
     @param directory the output directory in which the file will be created
     @param reducer the reducer number
+    @param master_id the ID of the master the worker belongs to
+    @param worker_id the ID of the worker creating the file
     @param delete if you wish to delete the file after .close()
     @return a file object
     """
-    fname = "{:s}-r{:06d}-p".format(prefix, reducer)
+    fname = "{:s}-r{:06d}-p{:06d}{:06d}".format(prefix, reducer,
+                                                 master_id, worker_id)
     return tempfile.NamedTemporaryFile(prefix=fname, bufsize=1048576, dir=directory, delete=delete)
 
 def get_id(fname):
@@ -90,15 +96,33 @@ def get_id(fname):
     """
     return int(os.path.basename(fname).split('-', 3)[2][1:])
 
-def get_file_name(path, reduce_idx, fid):
+def get_file_name(path, reduce_idx, fid, prefix="output"):
     """
     Construct a filename starting from various components
     @param path the path containing the file
     @param reduce_idx the id of the reducer
     @param fid the unique file ID
+    @param prefix the prefix of the file name
     @return a str representing the full path to the file
     """
-    return os.path.join(path, "output-r{:06d}-p{:018d}".format(reduce_idx, fid))
+    return os.path.join(path, "{:s}-r{:06d}-p{:018d}".format(prefix,
+                                                             reduce_idx, fid))
+
+def dfs_node(conf, worker_id):
+    """
+    Return the address of the DFS node of a worker. A wildcard dfs-host is
+    replaced with the name of the machine the worker is running on, as other
+    nodes and the server could not reach it otherwise.
+    @param conf the configuration dictionary
+    @param worker_id the ID of the worker
+    @return a str in the form host:port
+    """
+    host = conf['dfs-host']
+
+    if host in ('', '0.0.0.0', '::'):
+        host = MPI.Get_processor_name()
+
+    return '%s:%d' % (host, conf['dfs-startport'] + int(worker_id))
 
 def count_machines(fname):
     """
@@ -14,7 +14,8 @@ import os.path
 from mpi4py import MPI
 
 from pomegranate.message import *
-from pomegranate.utils import Logger, load_module
+from pomegranate.mux import send_message
+from pomegranate.utils import Logger, load_module, dfs_node
 
 try:
     from filesystem import Filesystem
@@ -37,6 +38,16 @@ class Worker(Logger):
         self.input_prefix = self.conf['input-prefix']
         self.output_prefix = self.conf['output-prefix']
 
+        # Address of the DFS node of the worker, advertised to the master
+        self.node = None
+
+        # Files of the local DFS node known to be complete
+        self.complete = set()
+
+        # file name => DFS nodes holding a replica of the input of the map
+        # being executed, as reported by the server
+        self.replicas = {}
+
         if use_dfs and not DFS_AVAILABLE:
             raise Exception("You need to install fsdfs in order to use the" \
                             " distributed mode. Otherwise just toggle it "  \
@@ -44,8 +55,7 @@ class Worker(Logger):
         elif use_dfs:
             dconf = conf['dfs-conf']
 
-            host = '%s:%d' % (conf['dfs-host'],
-                              conf['dfs-startport'] + int(worker_id))
+            host = self.node = dfs_node(conf, worker_id)
 
             self.datadir = os.path.join(
                 self.datadir,
@@ -82,11 +92,21 @@ class Worker(Logger):
         self.mapper.setup(self)
         self.reducer.setup(self)
 
+        # The first request also carries the DFS node of the worker
+        node = self.node
+
         while not finished:
-            self.comm.send(Message(MSG_AVAILABLE, 0, None), dest=0)
+            send_message(self.comm, Message(MSG_AVAILABLE, 0, node))
+            node = None
             msg = self.comm.recv()
 
+            # The first map also carries the range boundaries, if any
+            if getattr(msg, 'boundaries', None) is not None and \
+               hasattr(self.mapper, 'partitioner'):
+                self.mapper.partitioner.boundaries = msg.boundaries
+
             if msg.command == MSG_COMPUTE_MAP:
+                self.replicas = {msg.result[0]: getattr(msg, 'nodes', ())}
                 info, result = self.mapper.execute(msg.result)
 
                 msg = Message(MSG_FINISHED_MAP, msg.tag, result)
@@ -95,7 +115,7 @@ class Worker(Logger):
                 self.info("Map performance: %.2f" % \
                            (info[0] / (1024 ** 2 * info[1])))
 
-                self.comm.send(msg, dest=0)
+                send_message(self.comm, msg)
 
             elif msg.command == MSG_COMPUTE_REDUCE:
                 info, result = self.reducer.execute(msg.result)
@@ -106,7 +126,7 @@ class Worker(Logger):
                 self.info("Reduce performance: %.2f" % \
                           (info[0] / (1024 ** 2 * info[1])))
 
-                self.comm.send(msg, dest=0)
+                send_message(self.comm, msg)
 
             elif msg.command == MSG_SLEEP:
                 time.sleep(msg.result)
@@ -123,38 +143,54 @@ class Worker(Logger):
         module = load_module(mname)
         return getattr(module, fname)
 
-    def pull_remote_files(self, reduce_idx, file_ids):
+    def pull_remote_files(self, reduce_idx, file_ids, prefix="output"):
         """
         Pull a set of files from the global DFS
         @param reduce_idx the reducer ID
         @param file_ids an iterable object containing integers (they will be
                         casted to int())
+        @param prefix the prefix of the file names
         """
         if not self.use_dfs:
             return
 
         for fileid in file_ids:
-            fname = "output-r{:06d}-p{:018d}".format(reduce_idx, int(fileid))
+            fname = "{:s}-r{:06d}-p{:018d}".format(prefix, reduce_idx,
+                                                   int(fileid))
             fname = os.path.join(self.output_prefix, fname)
 
             full_path = os.path.join(self.datadir, fname)
             self.info("Checking %s" % full_path)
 
-            if os.path.exists(full_path):
+            if fname in self.complete:
                 self.info("Skipping %s. It is already present" % fname)
                 continue
 
             self.info("Worker worker_id=%d is downloading file '%s'" % \
                       (self.worker_id, fname))
 
-            downloaded = False
+            self.download(fname)
+
+    def download(self, fname):
+        """
+        Download a file from the global DFS, retrying until it succeeds. A file
+        left by a previous attempt is never trusted as it might be partial.
+        @param fname the name of the file relative to the datadir
+        """
+        full_path = os.path.join(self.datadir, fname)
+        downloaded = False
+
+        while not downloaded:
+            if os.path.exists(full_path):
+                os.unlink(full_path)
 
-            while not downloaded:
-                try:
-                    downloaded = self.fs.downloadFile(fname)
-                except:
-                    self.info("Failed to download %s. Retrying in 2 sec" % fname)
-                    sleep(2)
+            try:
+                downloaded = self.fs.downloadFile(fname)
+            except:
+                self.info("Failed to download %s. Retrying in 2 sec" % fname)
+                time.sleep(2)
+
+        self.complete.add(fname)
 
     def pull_remote_file(self, inp):
         """
@@ -163,17 +199,13 @@ class Worker(Logger):
         """
         filename, fileid = inp
 
-        if self.use_dfs:
+        if self.use_dfs and (filename in self.complete or
+                             self.node in self.replicas.get(filename, ())):
+            self.info("Skipping %s. A replica is already present" % filename)
+        elif self.use_dfs:
             self.info("Worker worker_id=%d is downloading file '%s'" % \
                       (self.worker_id, filename))
-            downloaded = False
-
-            while not downloaded:
-                try:
-                    downloaded = self.fs.downloadFile(filename)
-                except:
-                    self.info("Failed to download %s. Retrying in 2 sec" % fname)
-                    sleep(2)
+            self.download(filename)
 
         return (os.path.join(self.datadir, filename), fileid)
 
@@ -189,6 +221,7 @@ class Worker(Logger):
         fname = os.path.join(self.output_prefix, fname)
         self.info("Pushing file '%s' into global DFS" % fname)
         self.fs.importFile(os.path.join(self.datadir, fname), fname)
+        self.complete.add(fname)
 
         if push:
             ret = self.fs.pushFile(fname)